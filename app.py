@@ -1,10 +1,145 @@
-import joblib
-from flask import Flask, request, json, jsonify, render_template
+import os
+import tempfile
+from io import BytesIO
+import time
+from functools import partial
+from itertools import chain
+from flask import Flask, Request, request, json, jsonify, render_template, Response, stream_with_context, g
 from werkzeug.exceptions import HTTPException
-from cerf_sanglier_detection.yolo_inference import detect_animal, YOLO_WEIGHTS_PATH
+from cerf_sanglier_detection.yolo_inference import detect_animal, iter_detections, YOLO_WEIGHTS_PATH, DEVICE, BOXES_LAYOUTS
+from cerf_sanglier_detection import model_registry
+from cerf_sanglier_detection.batching import MicroBatcher
+from cerf_sanglier_detection.fetch import FetchError, PixelBudgetError, MAX_IMAGE_BYTES
+from cerf_sanglier_detection.result_cache import ResultCache
+from cerf_sanglier_detection.jobs import JobStore, JobManager
+from cerf_sanglier_detection.admission import AdmissionController
+from cerf_sanglier_detection.backends import resolve_weights
+from cerf_sanglier_detection.tiling import TilingError, MIN_TILE_SIZE, MAX_TILE_OVERLAP
+from cerf_sanglier_detection.video import analyze_video, VideoError, MOTION_THRESHOLD, SEGMENT_SECONDS
+from cerf_sanglier_detection.response_formats import RESPONSE_FORMATS, DEFAULT_RESPONSE_FORMAT, to_msgpack, to_multipart
+from cerf_sanglier_detection import metrics
+
+
+class UploadRequest(Request):
+    # Images uploaded to /predict stay in memory (bounded by their own limit)
+    # instead of being spooled to temporary files, videos keep the default
+    # spooling so that their size does not matter
+    @property
+    def max_content_length(self):
+        if self.endpoint == "predict":
+            return MAX_UPLOAD_BYTES * MAX_UPLOAD_FILES
+        if self.endpoint == "predict_video":
+            return MAX_VIDEO_BYTES
+        return super().max_content_length
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint == "predict":
+            return BytesIO()
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
 
 
 app = Flask(__name__)
+app.request_class = UploadRequest
+
+# Images sent directly to /predict (multipart form or raw image body)
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", MAX_IMAGE_BYTES))
+MAX_UPLOAD_FILES = int(os.environ.get("MAX_UPLOAD_FILES", 16))
+# Videos sent to /predict/video, spooled to disk
+MAX_VIDEO_BYTES = int(os.environ.get("MAX_VIDEO_BYTES", 4 * 1024 ** 3))
+
+# Images are decoded at a reduced size, their long side staying at least the
+# model input size (0 to decode them at full resolution), and the images of a
+# request may decode to at most MAX_REQUEST_PIXELS pixels (0 for no limit)
+DECODE_MAX_SIDE = int(os.environ.get("DECODE_MAX_SIDE", 640)) or None
+MAX_REQUEST_PIXELS = int(os.environ.get("MAX_REQUEST_PIXELS", 50_000_000)) or None
+
+# Inference engine: torch (.pt weights), onnx or openvino, exported on first use
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "torch")
+INFERENCE_INT8 = os.environ.get("INFERENCE_INT8", "0") == "1"
+WEIGHTS_PATH = resolve_weights(YOLO_WEIGHTS_PATH, INFERENCE_BACKEND, INFERENCE_INT8)
+
+# Micro-batching window: images of concurrent requests are run together
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 8))
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", 10))
+
+# Cache of the detections of images already seen (0 entries to disable it)
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 1024))
+RESULT_CACHE_TTL_S = float(os.environ["RESULT_CACHE_TTL_S"]) if "RESULT_CACHE_TTL_S" in os.environ else None
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR")
+
+# Background jobs for large batches of urls
+JOBS_DB_PATH = os.environ.get("JOBS_DB_PATH", "jobs.sqlite")
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+JOB_PAGE_SIZE = 50
+# Set by gunicorn.conf.py: the workers of the server share the jobs database
+PREFORK_SERVER = os.environ.get("PREFORK_SERVER") == "1"
+
+# Admission control of the detection endpoints, per process: requests over the
+# limits get a 503 instead of waiting behind the others
+MAX_INFLIGHT_REQUESTS = int(os.environ.get("MAX_INFLIGHT_REQUESTS", 8))
+MAX_QUEUED_REQUESTS = int(os.environ.get("MAX_QUEUED_REQUESTS", 16))
+ADMISSION_TIMEOUT_S = float(os.environ.get("ADMISSION_TIMEOUT_S", 2))
+ADMITTED_ENDPOINTS = {"predict", "predict_video", "create_job"}
+
+# Load (and warm up) the model once at startup, every request then reuses it
+model_registry.get_model(WEIGHTS_PATH, DEVICE)
+batcher = MicroBatcher(partial(model_registry.predict, WEIGHTS_PATH, device=DEVICE),
+                       max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS)
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL_S, RESULT_CACHE_DIR) if RESULT_CACHE_SIZE > 0 else None
+job_manager = JobManager(JobStore(JOBS_DB_PATH),
+                         partial(detect_animal, YOLO_WEIGHTS_PATH=WEIGHTS_PATH, batcher=batcher, cache=result_cache,
+                                 decode_side=DECODE_MAX_SIDE, max_pixels=MAX_REQUEST_PIXELS),
+                         max_workers=JOB_WORKERS, interrupt_unfinished=not PREFORK_SERVER)
+admission = AdmissionController(MAX_INFLIGHT_REQUESTS, MAX_QUEUED_REQUESTS, ADMISSION_TIMEOUT_S)
+
+
+@app.before_request
+def start_timer():
+    g.start_time = time.perf_counter()
+    g.timings_token = metrics.start_request_timings()
+    g.admitted = False
+    if request.endpoint in ADMITTED_ENDPOINTS:
+        if not admission.acquire():
+            raise ServerBusy()
+        g.admitted = True
+
+
+@app.teardown_request
+def release_admission(exception=None):
+    # After the response is sent, so that streamed responses keep their slot
+    if g.get("admitted"):
+        g.admitted = False
+        admission.release()
+
+
+def record_metrics(endpoint, method, status, start_time, timings_token):
+    # Count a finished request, and get its duration and stage timings
+    duration = time.perf_counter() - start_time
+    timings = metrics.stop_request_timings(timings_token)
+    metrics.REQUESTS.inc(endpoint=endpoint, method=method, status=status)
+    metrics.REQUEST_SECONDS.observe(duration, endpoint=endpoint)
+    return duration, timings
+
+
+@app.after_request
+def record_request(response):
+    """Count the request and add the optional Server-Timing header (asked with
+    the 'timing' query parameter).
+    """
+    endpoint = request.endpoint or "unknown"
+    if response.is_streamed:
+        # The body is only produced once this hook has returned: the request is
+        # recorded when it is closed (without Server-Timing, the headers are sent by then)
+        response.call_on_close(partial(record_metrics, endpoint, request.method, response.status_code,
+                                       g.start_time, g.timings_token))
+        return response
+
+    duration, timings = record_metrics(endpoint, request.method, response.status_code, g.start_time,
+                                       g.timings_token)
+    if request.args.get("timing"):
+        timings["total"] = duration
+        response.headers["Server-Timing"] = metrics.server_timing_header(timings)
+    return response
 
 
 @app.errorhandler(HTTPException)
@@ -12,6 +147,7 @@ def handle_exception(e):
     """Return JSON instead of HTML for HTTP errors (which is the basic error
     response with Flask).
     """
+    metrics.ERRORS.inc(code=e.code, name=e.name)
     # Start with the correct headers and status code from the error
     response = e.get_response()
     # Replace the body with JSON
@@ -53,6 +189,86 @@ class BadType(HTTPException):
     description = "the input must be a string or a list of strings "
 
 
+class ImageFetchError(HTTPException):
+    # We can define our own error for images we cannot download or decode
+    code = 424
+    name = "Image fetch error"
+    description = "an input image could not be downloaded or decoded"
+
+
+class JobNotFound(HTTPException):
+    # We can define our own error for unknown job ids
+    code = 404
+    name = "Job not found"
+    description = "there is no job with this id"
+
+
+class BadResponseFormat(HTTPException):
+    # We can define our own error for an unknown response format
+    code = 422
+    name = "Response format error"
+    description = f"the format must be one of {', '.join(RESPONSE_FORMATS)}"
+
+
+class MissingVideo(HTTPException):
+    # We can define our own error for a missing video file
+    code = 400
+    name = "Missing video"
+    description = "Missing video file 'video'."
+
+
+class BadVideo(HTTPException):
+    # We can define our own error for videos we cannot read
+    code = 422
+    name = "Video error"
+    description = "the video could not be read"
+
+
+class BadTiling(HTTPException):
+    # We can define our own error for invalid tiling parameters
+    code = 422
+    name = "Tiling error"
+    description = (f"'tile_size' must be an integer of at least {MIN_TILE_SIZE} and 'tile_overlap' a number in "
+                   f"[0, {MAX_TILE_OVERLAP}]")
+
+
+class MissingImage(HTTPException):
+    # We can define our own error for an upload without image
+    code = 400
+    name = "Missing image"
+    description = "Missing image: send files 'image' in a multipart form, or an image/* body."
+
+
+class TooManyImages(HTTPException):
+    # We can define our own error for too many uploaded images
+    code = 413
+    name = "Too many images"
+    description = f"at most {MAX_UPLOAD_FILES} images can be uploaded at once, of at most {MAX_UPLOAD_BYTES} bytes each"
+
+
+class BadImage(HTTPException):
+    # We can define our own error for uploaded images we cannot decode
+    code = 422
+    name = "Image decode error"
+    description = "an uploaded image could not be decoded"
+
+
+class TooManyPixels(HTTPException):
+    # We can define our own error for requests whose images are too large once decoded
+    code = 413
+    name = "Too many pixels"
+
+
+class ServerBusy(HTTPException):
+    # We can define our own error for requests over the admission limits
+    code = 503
+    name = "Server busy"
+    description = "too many requests are being processed, retry later"
+
+    def get_headers(self, environ=None, scope=None):
+        return super().get_headers(environ, scope) + [("Retry-After", "1")]
+
+
 def good_format(input):
     try:
         return sum([isinstance(i,str) for i in input])==len(input)
@@ -62,9 +278,116 @@ def good_format(input):
 def is_str(x):
     return isinstance(x,str)
 
+def get_tiling(json_input):
+    # Sliced inference is asked with 'tile_size' (and optionally 'tile_overlap')
+    if "tile_size" not in json_input:
+        return None
+    tile_size = json_input["tile_size"]
+    overlap = json_input.get("tile_overlap", 0.2)
+    if (not isinstance(tile_size, int) or isinstance(tile_size, bool) or tile_size < MIN_TILE_SIZE
+            or not isinstance(overlap, (int, float)) or not 0 <= overlap <= MAX_TILE_OVERLAP):
+        raise BadTiling()
+    return {"tile_size": tile_size, "overlap": float(overlap)}
+
+def get_boxes_layout(json_input):
+    # Boxes as a list of dicts (default) or as a dict of lists
+    boxes_layout = json_input.get("boxes_layout", "records")
+    if boxes_layout not in BOXES_LAYOUTS:
+        raise BadResponseFormat(description=f"'boxes_layout' must be one of {', '.join(BOXES_LAYOUTS)}")
+    return boxes_layout
+
+def stream_detections(input, response_format, tiling=None, boxes_layout="records"):
+    # One JSON line per image, sent as soon as the image is processed
+    def generate():
+        try:
+            for index, detection_result in iter_detections(input, WEIGHTS_PATH, confidence=0.25,
+                                                           response_format=response_format,
+                                                           batcher=batcher, cache=result_cache, tiling=tiling,
+                                                           boxes_layout=boxes_layout, decode_side=DECODE_MAX_SIDE,
+                                                           max_pixels=MAX_REQUEST_PIXELS):
+                yield json.dumps(dict(detection_result, index=index)) + "\n"
+        except FetchError as e:
+            # The status code is already sent, the error ends the stream
+            error_class = TooManyPixels if isinstance(e, PixelBudgetError) else ImageFetchError
+            error = error_class(description=str(e))
+            yield json.dumps({"code": error.code, "name": error.name, "description": error.description}) + "\n"
+        except TilingError as e:
+            error = BadTiling(description=str(e))
+            yield json.dumps({"code": error.code, "name": error.name, "description": error.description}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+def make_response_body(prediction, response_format):
+    # Binary formats carry the raw image buffers, the others are plain JSON
+    if response_format == 'msgpack':
+        return Response(to_msgpack(prediction), mimetype='application/msgpack')
+    if response_format == 'multipart':
+        body, content_type = to_multipart(prediction)
+        return Response(body, content_type=content_type)
+    return jsonify(prediction)
+
+
+def get_uploaded_images():
+    # Encoded bytes of the uploaded images, and the options of the request
+    if request.mimetype.startswith("image/"):
+        images = [request.get_data(cache=False)]
+        options = request.args
+    else:
+        images = [file.read() for file in request.files.getlist("image")]
+        options = request.form
+    images = [image for image in images if image]
+    if not images:
+        raise MissingImage()
+    if len(images) > MAX_UPLOAD_FILES or max(len(image) for image in images) > MAX_UPLOAD_BYTES:
+        raise TooManyImages()
+
+    # Options are strings, they are checked like the JSON ones
+    json_options = {"format": options.get("format", DEFAULT_RESPONSE_FORMAT),
+                    "boxes_layout": options.get("boxes_layout", "records"),
+                    "stream": options.get("stream", "0").lower() in ("1", "true")}
+    if "tile_size" in options:
+        json_options["tile_size"] = options.get("tile_size", type=int)
+        json_options["tile_overlap"] = options.get("tile_overlap", 0.2, type=float)
+    return images, json_options
+
+def run_prediction(input, json_input, fetch_error=ImageFetchError):
+    # Detect the animals of the input (urls, paths or uploaded bytes) with the options of the request
+    response_format = json_input.get("format", DEFAULT_RESPONSE_FORMAT)
+    if response_format not in RESPONSE_FORMATS:
+        raise BadResponseFormat()
+
+    tiling = get_tiling(json_input)
+    boxes_layout = get_boxes_layout(json_input)
+    stream = json_input.get("stream", False)
+    if stream and response_format in ("msgpack", "multipart"):
+        raise BadResponseFormat(description="the format of a stream must be one of boxes, jpeg, png, list")
+
+    metrics.IMAGES_PER_REQUEST.observe(len(input) if isinstance(input, list) else 1)
+    if stream:
+        return stream_detections(input, response_format, tiling, boxes_layout), 200
+    try:
+        prediction = detect_animal(input, WEIGHTS_PATH, confidence=0.25, response_format=response_format,
+                                   batcher=batcher, cache=result_cache, tiling=tiling, boxes_layout=boxes_layout,
+                                   decode_side=DECODE_MAX_SIDE, max_pixels=MAX_REQUEST_PIXELS)
+    except PixelBudgetError as e:
+        raise TooManyPixels(description=str(e))
+    except FetchError as e:
+        raise fetch_error(description=str(e))
+    except TilingError as e:
+        raise BadTiling(description=str(e))
+    # Return prediction
+    with metrics.timed("serialize"):
+        response = make_response_body(prediction, response_format)
+    return response, 200
+
 
 @app.route("/predict", methods=["POST"])
 def predict():
+    # Images sent directly, decoded in memory
+    if request.mimetype == "multipart/form-data" or request.mimetype.startswith("image/"):
+        images, json_options = get_uploaded_images()
+        return run_prediction(images, json_options, fetch_error=BadImage)
+
     # Check parameters
     if request.json:
         # Get JSON as dictionnary
@@ -74,15 +397,13 @@ def predict():
             raise MissingKeyError()
         
         input=json_input["input"]
+
         # check the input and call our predict function that handle loading model and making a        
         if good_format(input):
             # prediction
             #print(json_input["input"])
             print('input')
-            prediction = detect_animal(input, YOLO_WEIGHTS_PATH, confidence=0.25)
-            # Return prediction
-            # response = json.dump(prediction)
-            return prediction, 200
+            return run_prediction(input, json_input)
 
         else : 
             raise BadInputType()
@@ -90,6 +411,110 @@ def predict():
     raise MissingJSON()
 
 
+@app.route("/predict/video", methods=["POST"])
+def predict_video():
+    """Detect animals in an uploaded video, one JSON event per line (segment
+    counts and box tracks, see `video.analyze_video`).
+    """
+    if "video" not in request.files:
+        raise MissingVideo()
+    # Invalid numbers fall back to the defaults
+    stride = max(request.form.get("stride", 1, type=int), 1)
+    motion_threshold = request.form.get("motion_threshold", MOTION_THRESHOLD, type=float)
+    segment_seconds = max(request.form.get("segment_seconds", SEGMENT_SECONDS, type=float), 1.)
+
+    # OpenCV reads videos from files, the upload is spooled to disk
+    upload = request.files["video"]
+    suffix = os.path.splitext(upload.filename or "")[1] or ".mp4"
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as video_file:
+        upload.save(video_file)
+    video_path = video_file.name
+
+    events = analyze_video(video_path, WEIGHTS_PATH, confidence=0.25, device=DEVICE, stride=stride,
+                           motion_threshold=motion_threshold, segment_seconds=segment_seconds)
+    try:
+        # Reading the first event opens the video, before the status code is sent
+        first_event = next(events)
+    except VideoError as e:
+        os.remove(video_path)
+        raise BadVideo(description=str(e))
+
+    def generate():
+        try:
+            for event in chain([first_event], events):
+                yield json.dumps(event) + "\n"
+        finally:
+            events.close()
+            os.remove(video_path)
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson"), 200
+
+
+@app.route("/jobs", methods=["POST"])
+def create_job():
+    # Same input as /predict, but the images are processed in the background
+    if request.json:
+        json_input = request.get_json()
+        if "input" not in json_input:
+            raise MissingKeyError()
+
+        input = json_input["input"]
+        response_format = json_input.get("format", DEFAULT_RESPONSE_FORMAT)
+        # Job results are stored as JSON
+        if response_format not in RESPONSE_FORMATS or response_format in ("msgpack", "multipart"):
+            raise BadResponseFormat(description="the format of a job must be one of boxes, jpeg, png, list")
+
+        if not good_format(input):
+            raise BadInputType()
+        inputs = [input] if is_str(input) else input
+        job_id = job_manager.submit(inputs, confidence=0.25, response_format=response_format,
+                                    tiling=get_tiling(json_input), boxes_layout=get_boxes_layout(json_input))
+        return jsonify({"job_id": job_id, "status": "queued", "total": len(inputs)}), 202
+
+    raise MissingJSON()
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    # A page holds 1 to JOB_PAGE_SIZE results (SQLite reads a negative limit as no limit)
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = min(max(request.args.get("limit", JOB_PAGE_SIZE, type=int), 1), JOB_PAGE_SIZE)
+    job = job_manager.store.get_job(job_id, offset=offset, limit=limit)
+    if job is None:
+        raise JobNotFound()
+    return jsonify(job)
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    gauges = metrics.render_gauges("animal_detection_batcher", batcher.stats())
+    if result_cache is not None:
+        gauges += metrics.render_gauges("animal_detection_cache", result_cache.stats())
+    gauges += metrics.render_gauges("animal_detection_admission", admission.stats())
+    return Response(metrics.render_metrics(gauges), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/stats/admission", methods=["GET"])
+def admission_stats():
+    return jsonify(admission.stats())
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    # The model is loaded at import, a process answering is ready
+    return jsonify({"status": "ok", "pid": os.getpid()})
+
+
+@app.route("/stats/batching", methods=["GET"])
+def batching_stats():
+    return jsonify(batcher.stats())
+
+
+@app.route("/stats/cache", methods=["GET"])
+def cache_stats():
+    return jsonify(result_cache.stats() if result_cache is not None else {})
+
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -0,0 +1,79 @@
+import threading
+import time
+
+
+class AdmissionController:
+    """
+    Bound the number of requests a process works on at the same time.
+
+    At most `max_inflight` requests run together; up to `max_queued` more wait
+    for a slot, each for at most `timeout_s`. Other requests are rejected right
+    away, so that an overloaded server answers quickly (e.g. with a 503)
+    instead of letting the latency of every request grow.
+    """
+
+    def __init__(self, max_inflight=8, max_queued=16, timeout_s=1.):
+        """
+        Parameters:
+        - max_inflight (int): Maximum number of requests running at the same time.
+        - max_queued (int): Maximum number of requests waiting for a slot.
+        - timeout_s (float): Maximum time a request waits for a slot.
+        """
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.timeout_s = timeout_s
+
+        self._condition = threading.Condition()
+        self._inflight = 0
+        self._queued = 0
+        self._admitted = 0
+        self._rejected = 0
+
+    def acquire(self):
+        """
+        Wait for a slot.
+
+        Returns:
+        - bool: Whether the request is admitted (it must then call `release`).
+        """
+        with self._condition:
+            if self._inflight >= self.max_inflight:
+                if self._queued >= self.max_queued:
+                    self._rejected += 1
+                    return False
+                self._queued += 1
+                deadline = time.monotonic() + self.timeout_s
+                try:
+                    while self._inflight >= self.max_inflight:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._rejected += 1
+                            return False
+                        self._condition.wait(remaining)
+                finally:
+                    self._queued -= 1
+            self._inflight += 1
+            self._admitted += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self._inflight -= 1
+            self._condition.notify()
+
+    def stats(self):
+        """
+        Get the admission metrics since the controller was created.
+
+        Returns:
+        - dict: Requests running and waiting now, admitted and rejected so far.
+        """
+        with self._condition:
+            return {
+                'inflight': self._inflight,
+                'queued': self._queued,
+                'admitted': self._admitted,
+                'rejected': self._rejected,
+                'max_inflight': self.max_inflight,
+                'max_queued': self.max_queued,
+            }
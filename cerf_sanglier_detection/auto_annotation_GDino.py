@@ -1,14 +1,19 @@
 from tqdm import tqdm
+import argparse
+import json
 import os
 import sys
-HOME = os.getcwd()
-HOME = os.path.dirname(HOME)
-sys.path.append(f'{HOME}/GroundingDINO')
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from settings import GROUNDING_DINO_PATH, IMG_FOLDER
+sys.path.append(GROUNDING_DINO_PATH)
 
-from groundingdino.util.inference import load_model, load_image, predict
+# torch and GroundingDino are imported by the functions using them, so that
+# importing this module (or running it with --help) stays fast
 from setup_grounding_dino import CONFIG_PATH, WEIGHTS_PATH
-from download_images import IMG_FOLDER
 from utils import get_image_names
+from dataset_catalog import update_catalog, query_images, default_catalog_path
 
 
 def annotate(model, image_name, img_folder, class_name, box_threshold=0.35, text_threshold=0.25):
@@ -26,6 +31,8 @@ def annotate(model, image_name, img_folder, class_name, box_threshold=0.35, text
     Returns:
     - tuple: Tuple containing bounding boxes and phrases.
     """
+    from groundingdino.util.inference import load_image, predict
+
     image_path = os.path.join(img_folder, image_name)
 
     _, image = load_image(image_path)
@@ -87,6 +94,8 @@ def yolo_annotation(img_folder, config_path, weights_path, box_threshold=0.35, t
     Returns:
     - tuple: Tuple containing dictionary of labels and list of non-annotated images.
     """
+    from groundingdino.util.inference import load_model
+
     model = load_model(config_path, weights_path)
 
     image_names = get_image_names(img_folder)
@@ -119,5 +128,246 @@ def yolo_annotation(img_folder, config_path, weights_path, box_threshold=0.35, t
     return dict_labels, non_annotated_imgs
 
 
+def decode_image(image_path):
+    """
+    Load and preprocess an image for GroundingDino (run in the decoder processes).
+
+    Parameters:
+    - image_path (str): Path to the image.
+
+    Returns:
+    - torch.Tensor: Preprocessed image.
+    """
+    from groundingdino.util.inference import load_image
+
+    _, image = load_image(image_path)
+    return image
+
+
+def predict_batch(model, images, caption, box_threshold=0.35, text_threshold=0.25, device="cuda"):
+    """
+    Run GroundingDino on a batch of images sharing the same caption. The images
+    can have different sizes, the model pads them and masks the padding.
+
+    Parameters:
+    - model: GroundingDino model.
+    - images (list): List of preprocessed images.
+    - caption (str): Caption (class name) searched in every image.
+    - box_threshold (float): Bounding box threshold.
+    - text_threshold (float): Text threshold.
+    - device (str): Device used for inference.
+
+    Returns:
+    - list: List of (boxes, phrases) tuples, one per image.
+    """
+    import torch
+    from groundingdino.util.inference import preprocess_caption
+    from groundingdino.util.utils import get_phrases_from_posmap
+
+    caption = preprocess_caption(caption=caption)
+    model = model.to(device)
+    images = [image.to(device) for image in images]
+
+    with torch.no_grad():
+        outputs = model(images, captions=[caption] * len(images))
+
+    tokenizer = model.tokenizer
+    tokenized = tokenizer(caption)
+    results = []
+    for prediction_logits, prediction_boxes in zip(outputs["pred_logits"].cpu().sigmoid(), outputs["pred_boxes"].cpu()):
+        mask = prediction_logits.max(dim=1)[0] > box_threshold
+        logits = prediction_logits[mask]
+        boxes = prediction_boxes[mask]
+        phrases = [get_phrases_from_posmap(logit > text_threshold, tokenized, tokenizer).replace('.', '')
+                   for logit in logits]
+        results.append((boxes, phrases))
+    return results
+
+
+def load_manifest(manifest_path):
+    """
+    Load the checkpoint manifest of the annotation pipeline.
+
+    Parameters:
+    - manifest_path (str): Path to the manifest file.
+
+    Returns:
+    - dict: Manifest with the labels dictionary and the failed images.
+    """
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as file:
+            return json.load(file)
+    return {'dict_labels': {'boar': 0, 'deer': 1}, 'failed': []}
+
+
+def save_manifest(manifest, manifest_path):
+    """
+    Save the checkpoint manifest, replacing the previous one atomically.
+
+    Parameters:
+    - manifest (dict): Manifest with the labels dictionary and the failed images.
+    - manifest_path (str): Path to the manifest file.
+    """
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def iter_decoded(executor, image_paths, prefetch):
+    """
+    Decode images in the process pool, keeping at most `prefetch` images ahead
+    of the consumer.
+
+    Parameters:
+    - executor (ProcessPoolExecutor): Decoder processes.
+    - image_paths (list): Paths to the images.
+    - prefetch (int): Maximum number of images decoded ahead.
+
+    Yields:
+    - tuple: Tuple containing the image index and its decoded image (or the exception raised).
+    """
+    pending = deque()
+    paths = iter(enumerate(image_paths))
+    for index, image_path in paths:
+        pending.append((index, executor.submit(decode_image, image_path)))
+        if len(pending) >= prefetch:
+            break
+    while pending:
+        index, future = pending.popleft()
+        next_path = next(paths, None)
+        if next_path is not None:
+            pending.append((next_path[0], executor.submit(decode_image, next_path[1])))
+        try:
+            yield index, future.result()
+        except Exception as e:
+            yield index, e
+
+
+def yolo_annotation_pipeline(img_folder, config_path, weights_path, box_threshold=0.35, text_threshold=0.25,
+                             batch_size=8, num_workers=4, device="cuda"):
+    """
+    Perform YOLO annotation on a folder of images using GroundingDino model,
+    with a pipeline: images are decoded by a process pool, run through the
+    model in batches grouped by caption (class name) and their labels are
+    written by a background writer. Images which already have a label file are
+    skipped, so an interrupted run can be started again where it stopped.
+
+    Parameters:
+    - img_folder (str): Path to the folder containing images.
+    - config_path (str): Path to the GroundingDino configuration file.
+    - weights_path (str): Path to the GroundingDino weights file.
+    - box_threshold (float): Bounding box threshold.
+    - text_threshold (float): Text threshold.
+    - batch_size (int): Number of images per forward pass.
+    - num_workers (int): Number of decoder processes.
+    - device (str): Device used for inference.
+
+    Returns:
+    - tuple: Tuple containing dictionary of labels and list of non-annotated images.
+    """
+    data_folder = os.path.dirname(img_folder)
+    annotations_folder = os.path.join(data_folder, "labels")
+    os.makedirs(annotations_folder, exist_ok=True)
+    manifest_path = os.path.join(data_folder, "annotation_manifest.json")
+
+    manifest = load_manifest(manifest_path)
+    dict_labels = manifest['dict_labels']
+
+    # Checkpoint: skip the images already labeled by a previous run
+    catalog_path = default_catalog_path(img_folder)
+    update_catalog(img_folder, annotations_folder, catalog_path)
+    image_names = query_images(catalog_path)
+    todo_by_class = {}
+    for image_name in query_images(catalog_path, annotated=False):
+        class_name = image_name.split('_')[0]
+        if class_name not in dict_labels:
+            dict_labels[class_name] = max(dict_labels.values()) + 1
+        todo_by_class.setdefault(class_name, []).append(image_name)
+    nb_todo = sum(len(names) for names in todo_by_class.values())
+    print(f'{len(image_names) - nb_todo} images already annotated, {nb_todo} to annotate')
+
+    from groundingdino.util.inference import load_model
+
+    model = load_model(config_path, weights_path)
+    failed = set()
+    # Images can fail in the main thread (decoding, inference) or in the writer
+    failed_lock = threading.Lock()
+
+    def fail(image_name, e):
+        print(f"Error processing image '{image_name}': {e}")
+        with failed_lock:
+            failed.add(image_name)
+
+    def write(image_name, boxes, phrases):
+        try:
+            yolo_annotation = transform_to_yolo_annotation(phrases, boxes, dict_labels)
+            filename = os.path.splitext(image_name)[0] + '.txt'
+            save_annotation(yolo_annotation, os.path.join(annotations_folder, filename))
+        except Exception as e:
+            fail(image_name, e)
+
+    def run_batch(class_name, batch):
+        names = [name for name, _ in batch]
+        images = [image for _, image in batch]
+        try:
+            results = predict_batch(model, images, class_name, box_threshold, text_threshold, device)
+        except Exception:
+            # Fall back to one image at a time so that one bad image only fails itself
+            results = []
+            for name, image in zip(names, images):
+                try:
+                    results.extend(predict_batch(model, [image], class_name, box_threshold, text_threshold, device))
+                except Exception as e:
+                    fail(name, e)
+                    results.append(None)
+        for name, result in zip(names, results):
+            if result is not None:
+                writer.submit(write, name, *result)
+        with failed_lock:
+            manifest['failed'] = sorted(failed)
+        writer.submit(save_manifest, json.loads(json.dumps(manifest)), manifest_path)
+
+    with ProcessPoolExecutor(max_workers=num_workers) as decoders, ThreadPoolExecutor(max_workers=1) as writer:
+        progress = tqdm(total=nb_todo)
+        for class_name, names in todo_by_class.items():
+            paths = [os.path.join(img_folder, name) for name in names]
+            batch = []
+            for index, image in iter_decoded(decoders, paths, prefetch=2 * batch_size):
+                if isinstance(image, Exception):
+                    fail(names[index], image)
+                    progress.update(1)
+                    continue
+                batch.append((names[index], image))
+                if len(batch) == batch_size:
+                    run_batch(class_name, batch)
+                    progress.update(len(batch))
+                    batch = []
+            if batch:
+                run_batch(class_name, batch)
+                progress.update(len(batch))
+        progress.close()
+
+    manifest['failed'] = sorted(failed)
+    save_manifest(manifest, manifest_path)
+
+    non_annotated_imgs = sorted(failed)
+    if nb_todo:
+        success_rate = round((1 - len(non_annotated_imgs) / nb_todo) * 100, 2)
+        print(f'Success rate: {success_rate}%')
+    return dict_labels, non_annotated_imgs
+
+
 if __name__ == "__main__":
-    yolo_annotation(IMG_FOLDER, CONFIG_PATH, WEIGHTS_PATH)
+    parser = argparse.ArgumentParser(description="Annotate the images folder with GroundingDino.")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=4, help="number of decoder processes")
+    parser.add_argument("--device", default="cuda")
+    parser.add_argument("--sequential", action="store_true", help="annotate one image at a time (no checkpoint)")
+    args = parser.parse_args()
+
+    if args.sequential:
+        yolo_annotation(IMG_FOLDER, CONFIG_PATH, WEIGHTS_PATH)
+    else:
+        yolo_annotation_pipeline(IMG_FOLDER, CONFIG_PATH, WEIGHTS_PATH, batch_size=args.batch_size,
+                                 num_workers=args.workers, device=args.device)
@@ -0,0 +1,203 @@
+import argparse
+import os
+import numpy as np
+from cerf_sanglier_detection import model_registry
+from cerf_sanglier_detection.fetch import fetch_image
+from cerf_sanglier_detection.settings import YOLO_WEIGHTS_PATH
+from cerf_sanglier_detection.yolo_inference import format_result
+
+# Inference engines able to run the trained weights, 'torch' runs the .pt file
+BACKENDS = ('torch', 'onnx', 'openvino')
+EXPORT_IMG_SIZE = 640
+
+
+def exported_weights_path(weights_path, backend, int8=False):
+    """
+    Get the path of the weights exported for a backend (following the naming
+    of ultralytics' exporter).
+
+    Parameters:
+    - weights_path (str): Path to the yolo(.pt) weight file.
+    - backend (str): One of BACKENDS.
+    - int8 (bool): Whether to get the int8-quantized weights.
+
+    Returns:
+    - str: Path to the weights file (or folder for OpenVINO).
+    """
+    root = os.path.splitext(weights_path)[0]
+    if backend == 'torch':
+        return weights_path
+    if backend == 'onnx':
+        return f'{root}_int8.onnx' if int8 else f'{root}.onnx'
+    if backend == 'openvino':
+        return f'{root}_int8_openvino_model' if int8 else f'{root}_openvino_model'
+    raise ValueError(f"Unknown backend '{backend}', must be one of {', '.join(BACKENDS)}")
+
+
+def export_weights(weights_path, backend, int8=False, img_size=EXPORT_IMG_SIZE, data=None):
+    """
+    Export trained weights for a faster CPU backend. Exports have a dynamic
+    batch size so that micro-batches run in one forward pass.
+
+    Parameters:
+    - weights_path (str): Path to the yolo(.pt) weight file.
+    - backend (str): 'onnx' or 'openvino'.
+    - int8 (bool): Whether to quantize the weights to int8 (dynamic quantization
+      for ONNX, calibrated post-training quantization for OpenVINO).
+    - img_size (int): Input size of the exported model.
+    - data (str): Dataset config used to calibrate the OpenVINO int8 quantization.
+
+    Returns:
+    - str: Path to the exported weights.
+    """
+    if backend not in ('onnx', 'openvino'):
+        raise ValueError(f"Cannot export to '{backend}', must be 'onnx' or 'openvino'")
+
+    from ultralytics import YOLO
+
+    model = YOLO(weights_path)
+    if backend == 'onnx':
+        onnx_path = model.export(format='onnx', imgsz=img_size, dynamic=True)
+        if not int8:
+            return onnx_path
+        # onnxruntime is only needed to quantize
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        int8_path = exported_weights_path(weights_path, 'onnx', int8=True)
+        quantize_dynamic(onnx_path, int8_path, weight_type=QuantType.QUInt8)
+        return int8_path
+
+    return model.export(format='openvino', imgsz=img_size, dynamic=True, int8=int8, data=data)
+
+
+def resolve_weights(weights_path, backend='torch', int8=False):
+    """
+    Get the weights to load for a backend, exporting them if they do not exist yet.
+
+    Parameters:
+    - weights_path (str): Path to the yolo(.pt) weight file.
+    - backend (str): One of BACKENDS.
+    - int8 (bool): Whether to use the int8-quantized weights.
+
+    Returns:
+    - str: Path to the weights to give to `model_registry` or `detect_animal`.
+    """
+    path = exported_weights_path(weights_path, backend, int8)
+    if not os.path.exists(path):
+        path = export_weights(weights_path, backend, int8)
+    return path
+
+
+def box_iou(boxes1, boxes2):
+    """
+    Compute the IoU between two sets of boxes.
+
+    Parameters:
+    - boxes1 (np.ndarray): Boxes (x1, y1, x2, y2) of shape (n, 4).
+    - boxes2 (np.ndarray): Boxes (x1, y1, x2, y2) of shape (m, 4).
+
+    Returns:
+    - np.ndarray: IoU matrix of shape (n, m).
+    """
+    top_left = np.maximum(boxes1[:, None, :2], boxes2[None, :, :2])
+    bottom_right = np.minimum(boxes1[:, None, 2:], boxes2[None, :, 2:])
+    inter = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area1 = np.prod(boxes1[:, 2:] - boxes1[:, :2], axis=1)
+    area2 = np.prod(boxes2[:, 2:] - boxes2[:, :2], axis=1)
+    return inter / (area1[:, None] + area2[None, :] - inter + 1e-9)
+
+
+def compare_boxes(reference_boxes, boxes, min_iou=0.9, max_score_diff=0.05):
+    """
+    Greedily match the boxes found by a backend to the reference ones.
+
+    Parameters:
+    - reference_boxes (list): Box dicts of the reference (PyTorch) backend.
+    - boxes (list): Box dicts of the compared backend.
+    - min_iou (float): Minimum IoU of two matched boxes.
+    - max_score_diff (float): Maximum score difference of two matched boxes.
+
+    Returns:
+    - dict: Number of matched, missing and extra boxes, and max score difference.
+    """
+    keys = ['x1', 'y1', 'x2', 'y2']
+    reference = np.array([[box[key] for key in keys] for box in reference_boxes]).reshape(-1, 4)
+    compared = np.array([[box[key] for key in keys] for box in boxes]).reshape(-1, 4)
+    ious = box_iou(reference, compared)
+
+    matched, max_diff = 0, 0.
+    used = set()
+    for i, reference_box in enumerate(reference_boxes):
+        for j in np.argsort(-ious[i]):
+            box = boxes[j]
+            if (j in used or ious[i, j] < min_iou or box['class_id'] != reference_box['class_id']
+                    or abs(box['score'] - reference_box['score']) > max_score_diff):
+                continue
+            used.add(j)
+            matched += 1
+            max_diff = max(max_diff, abs(box['score'] - reference_box['score']))
+            break
+
+    return {
+        'matched': matched,
+        'missing': len(reference_boxes) - matched,
+        'extra': len(boxes) - matched,
+        'max_score_diff': max_diff,
+    }
+
+
+def check_parity(weights_path, backend, sources, int8=False, confidence=0.25, device='cpu', min_iou=0.9,
+                 max_score_diff=0.05):
+    """
+    Check that a backend finds the same boxes as the PyTorch weights.
+
+    Parameters:
+    - weights_path (str): Path to the yolo(.pt) weight file.
+    - backend (str): One of BACKENDS.
+    - sources (list): Urls or paths of the images to compare on.
+    - int8 (bool): Whether to check the int8-quantized weights.
+    - confidence (float): Confidence threshold for detections.
+    - device (str): Device used for inference.
+    - min_iou (float): Minimum IoU of two matched boxes.
+    - max_score_diff (float): Maximum score difference of two matched boxes.
+
+    Returns:
+    - tuple: Tuple containing whether every box matched and the comparison of each image.
+    """
+    dict_labels = {'boar': 0, 'deer': 1}
+    backend_path = resolve_weights(weights_path, backend, int8)
+
+    comparisons = []
+    for source in sources:
+        img, _, _ = fetch_image(source)
+        reference = format_result(model_registry.predict(weights_path, img, device=device, conf=confidence)[0],
+                                  dict_labels)
+        result = format_result(model_registry.predict(backend_path, img, device=device, conf=confidence)[0],
+                               dict_labels)
+        comparison = compare_boxes(reference['boxes'], result['boxes'], min_iou, max_score_diff)
+        comparison['source'] = source
+        comparison['same_counts'] = reference['number_of_detections_by_class'] == result['number_of_detections_by_class']
+        comparisons.append(comparison)
+
+    ok = all(c['missing'] == 0 and c['extra'] == 0 and c['same_counts'] for c in comparisons)
+    return ok, comparisons
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the YOLO weights for a CPU backend and check its parity.")
+    parser.add_argument("command", choices=["export", "parity"])
+    parser.add_argument("--weights", default=YOLO_WEIGHTS_PATH, help="PyTorch weights to export")
+    parser.add_argument("--backend", default="onnx", choices=["onnx", "openvino"])
+    parser.add_argument("--int8", action="store_true", help="quantize the weights to int8")
+    parser.add_argument("--data", default=None, help="dataset config used to calibrate OpenVINO int8")
+    parser.add_argument("--images", nargs="+", default=["wild-boar.jpg"], help="images used by the parity check")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        print(export_weights(args.weights, args.backend, args.int8, data=args.data))
+    else:
+        ok, comparisons = check_parity(args.weights, args.backend, args.images, int8=args.int8)
+        for comparison in comparisons:
+            print(comparison)
+        print("Parity OK" if ok else "Parity FAILED")
+        raise SystemExit(0 if ok else 1)
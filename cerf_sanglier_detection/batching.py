@@ -0,0 +1,157 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """
+    Collect images submitted by concurrent requests and run them through the
+    model as one batch.
+
+    A batch is sent to the model as soon as it holds `max_batch_size` images or
+    when the oldest image has waited `max_wait_ms`, whichever comes first.
+    Images submitted with different prediction arguments (e.g. confidence) are
+    never mixed in the same forward pass.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=8, max_wait_ms=10):
+        """
+        Parameters:
+        - predict_fn (callable): Called as `predict_fn(sources, **kwargs)`, it must
+          return one result per source, in the same order.
+        - max_batch_size (int): Maximum number of images in a forward pass.
+        - max_wait_ms (float): Maximum time an image waits for a batch to fill.
+        """
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._nb_batches = 0
+        self._nb_images = 0
+        self._fill_ratio_sum = 0.
+        self._queue_wait_sum = 0.
+        self._queue_wait_max = 0.
+
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._worker.start()
+
+    def submit(self, source, **predict_kwargs):
+        """
+        Queue one image for the next batch.
+
+        Parameters:
+        - source: Image accepted by `predict_fn` (array, path or url).
+        - **predict_kwargs: Prediction arguments of this image.
+
+        Returns:
+        - Future: Future of the result of this image.
+        """
+        if self._closed:
+            raise RuntimeError("The batcher is closed")
+        future = Future()
+        self._queue.put((source, predict_kwargs, future, time.perf_counter()))
+        return future
+
+    def predict(self, sources, **predict_kwargs):
+        """
+        Queue several images and wait for their results.
+
+        Parameters:
+        - sources (list): Images accepted by `predict_fn`.
+        - **predict_kwargs: Prediction arguments of these images.
+
+        Returns:
+        - list: One result per source, in the same order.
+        """
+        futures = [self.submit(source, **predict_kwargs) for source in sources]
+        return [future.result() for future in futures]
+
+    def stats(self):
+        """
+        Get the batching metrics since the batcher was created.
+
+        Returns:
+        - dict: Number of batches and images, mean batch size and fill ratio
+          (batch size / max batch size), mean and max queue wait in ms.
+        """
+        with self._stats_lock:
+            nb_batches = max(self._nb_batches, 1)
+            nb_images = max(self._nb_images, 1)
+            return {
+                'batches': self._nb_batches,
+                'images': self._nb_images,
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000,
+                'mean_batch_size': self._nb_images / nb_batches,
+                'mean_fill_ratio': self._fill_ratio_sum / nb_batches,
+                'mean_queue_wait_ms': self._queue_wait_sum / nb_images * 1000,
+                'max_queue_wait_ms': self._queue_wait_max * 1000,
+                'queued': self._queue.qsize(),
+            }
+
+    def close(self):
+        """
+        Stop the worker once the images already queued are processed.
+        """
+        self._closed = True
+        self._queue.put(None)
+        self._worker.join()
+
+    def _collect(self, first_item):
+        # Wait for more images until the batch is full or the oldest image
+        # (the first one) has waited long enough
+        items = [first_item]
+        deadline = first_item[3] + self.max_wait
+        while len(items) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            items.append(item)
+        return items
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            items = self._collect(item)
+
+            # Group images sharing the same prediction arguments
+            groups = {}
+            for item in items:
+                key = tuple(sorted(item[1].items()))
+                groups.setdefault(key, []).append(item)
+
+            for group in groups.values():
+                self._run_batch(group)
+
+    def _run_batch(self, items):
+        start = time.perf_counter()
+        queue_waits = [start - item[3] for item in items]
+        with self._stats_lock:
+            self._nb_batches += 1
+            self._nb_images += len(items)
+            self._fill_ratio_sum += len(items) / self.max_batch_size
+            self._queue_wait_sum += sum(queue_waits)
+            self._queue_wait_max = max(self._queue_wait_max, *queue_waits)
+
+        try:
+            results = self.predict_fn([item[0] for item in items], **items[0][1])
+        except Exception as e:
+            for item in items:
+                item[2].set_exception(e)
+            return
+
+        for item, result in zip(items, results):
+            item[2].set_result(result)
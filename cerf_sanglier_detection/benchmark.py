@@ -0,0 +1,469 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from io import BytesIO
+import numpy as np
+from PIL import Image
+from cerf_sanglier_detection import model_registry
+from cerf_sanglier_detection.backends import resolve_weights
+from cerf_sanglier_detection.fetch import fetch_image
+from cerf_sanglier_detection.settings import PROJECT_ROOT, YOLO_WEIGHTS_PATH, DEVICE
+from cerf_sanglier_detection.yolo_inference import detect_animal
+
+CORPUS_IMAGES = [os.path.join(PROJECT_ROOT, "wild-boar.jpg")]
+RESOLUTIONS = [(640, 480), (1280, 720), (1920, 1080)]
+# Photos of the decode suite, besides the corpus (20 MP, a camera photo)
+DECODE_RESOLUTIONS = [(5472, 3648)]
+# Long side of the reduced decoding (None: full resolution)
+DECODE_SIDES = [None, 640]
+
+SCRIPTS_FOLDER = os.path.join(PROJECT_ROOT, "cerf_sanglier_detection")
+# Commands timed by the startup suite: (command, working directory). Importing
+# the app loads and warms up the model, which is the cold start of the API.
+STARTUP_COMMANDS = {
+    "import_app": ([sys.executable, "-c", "import app"], PROJECT_ROOT),
+    "help_benchmark": ([sys.executable, "-m", "cerf_sanglier_detection.benchmark", "--help"], PROJECT_ROOT),
+    "help_backends": ([sys.executable, "-m", "cerf_sanglier_detection.backends", "--help"], PROJECT_ROOT),
+    "help_video": ([sys.executable, "-m", "cerf_sanglier_detection.video", "--help"], PROJECT_ROOT),
+    "help_load_test": ([sys.executable, "-m", "cerf_sanglier_detection.load_test", "--help"], PROJECT_ROOT),
+    "help_split": ([sys.executable, "test_validation_split.py", "--help"], SCRIPTS_FOLDER),
+    "help_annotation": ([sys.executable, "auto_annotation_GDino.py", "--help"], SCRIPTS_FOLDER),
+    "help_train": ([sys.executable, "yolo_train.py", "--help"], SCRIPTS_FOLDER),
+    "help_evaluate": ([sys.executable, "evaluate.py", "--help"], SCRIPTS_FOLDER),
+}
+# Runs a command (its arguments) and prints its duration and its own ru_maxrss. A
+# process inherits the peak RSS of its parent across fork and exec: the command
+# must be the child of a small process, not of the benchmark.
+COMMAND_LAUNCHER = ("import os, subprocess, sys, time; start = time.perf_counter(); "
+                    "process = subprocess.Popen(sys.argv[1:], stdout=subprocess.DEVNULL); "
+                    "_, status, usage = os.wait4(process.pid, 0); "
+                    "print(time.perf_counter() - start, usage.ru_maxrss); "
+                    "sys.exit(os.waitstatus_to_exitcode(status))")
+# Modules that must not be imported until they are used (they take seconds to import)
+HEAVY_MODULES = ["ultralytics", "torch", "torchvision", "cv2", "sklearn", "groundingdino"]
+LIGHT_MODULES = ["cerf_sanglier_detection.yolo_inference", "cerf_sanglier_detection.video",
+                 "cerf_sanglier_detection.backends", "cerf_sanglier_detection.benchmark"]
+
+
+# Interval between two samples of the resident memory during a scenario (seconds)
+RSS_SAMPLE_INTERVAL = 0.005
+
+
+def maxrss_mb(maxrss):
+    """
+    Convert a ru_maxrss to MB.
+
+    Parameters:
+    - maxrss (int): ru_maxrss of a resource usage.
+
+    Returns:
+    - float: Peak RSS in MB.
+    """
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    return maxrss / 1024 ** 2 if platform.system() == "Darwin" else maxrss / 1024
+
+
+def process_peak_rss_mb():
+    """
+    Get the peak resident memory of the process since it started (so it never
+    goes down from one scenario to the next).
+
+    Returns:
+    - float: Peak RSS in MB.
+    """
+    return maxrss_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def current_rss_mb():
+    """
+    Get the current resident memory of the process.
+
+    Returns:
+    - float: RSS in MB, None where /proc is not available (e.g. macOS).
+    """
+    try:
+        with open("/proc/self/statm") as file:
+            pages = int(file.read().split()[1])
+    except OSError:
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+
+
+class RssSampler:
+    """
+    Background thread sampling the resident memory of the process, to get the
+    peak of one scenario rather than the peak of the whole process.
+    """
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        """
+        Parameters:
+        - interval (float): Interval between two samples (seconds).
+        """
+        self.interval = interval
+        self.peak_mb = current_rss_mb()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, current_rss_mb())
+
+    def __enter__(self):
+        if self.peak_mb is not None:
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.peak_mb is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.peak_mb = max(self.peak_mb, current_rss_mb())
+
+
+def synthetic_frame(width, height, seed=0):
+    """
+    Build a reproducible synthetic BGR frame (smooth noise, so that it encodes
+    like a photo rather than like white noise).
+
+    Parameters:
+    - width (int): Width of the frame.
+    - height (int): Height of the frame.
+    - seed (int): Random seed.
+
+    Returns:
+    - np.ndarray: BGR image.
+    """
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 256, size=(max(height // 16, 1), max(width // 16, 1), 3), dtype=np.uint8)
+    return np.asarray(Image.fromarray(small).resize((width, height), Image.BILINEAR))
+
+
+def load_corpus(image_paths=CORPUS_IMAGES, resolutions=RESOLUTIONS):
+    """
+    Load the benchmark images: the local corpus and one synthetic frame per resolution.
+
+    Parameters:
+    - image_paths (list): Paths to local images.
+    - resolutions (list): (width, height) of the synthetic frames.
+
+    Returns:
+    - dict: Dictionary mapping an image name to its BGR image.
+    """
+    corpus = {}
+    for path in image_paths:
+        corpus[os.path.basename(path)] = fetch_image(path)[0]
+    for i, (width, height) in enumerate(resolutions):
+        corpus[f"synthetic_{width}x{height}"] = synthetic_frame(width, height, seed=i)
+    return corpus
+
+
+def measure(fn, nb_images, repeats=10, warmup=2):
+    """
+    Time repeated calls of a function.
+
+    Parameters:
+    - fn (callable): Function to time, called without arguments.
+    - nb_images (int): Number of images processed by one call.
+    - repeats (int): Number of timed calls.
+    - warmup (int): Number of calls made before timing.
+
+    Returns:
+    - dict: Latency percentiles (ms), throughput, peak RSS of the timed calls
+      (None without /proc) and peak RSS of the process since it started.
+    """
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    with RssSampler() as rss:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            fn()
+            latencies.append(time.perf_counter() - start)
+    return dict(latency_stats(latencies, nb_images), peak_rss_mb=rss.peak_mb,
+                process_peak_rss_mb=process_peak_rss_mb())
+
+
+def latency_stats(latencies, nb_images):
+    """
+    Summarize the latencies of repeated calls.
+
+    Parameters:
+    - latencies (list): Latency of each call (seconds).
+    - nb_images (int): Number of images processed by one call.
+
+    Returns:
+    - dict: Latency percentiles (ms) and throughput.
+    """
+    latencies = np.array(latencies) * 1000
+    return {
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "mean_ms": float(latencies.mean()),
+        "images_per_s": float(nb_images * len(latencies) / (latencies.sum() / 1000)),
+    }
+
+
+def run_command(command, cwd):
+    """
+    Run a command and get its duration and its own peak resident memory.
+
+    Parameters:
+    - command (list): Command and its arguments.
+    - cwd (str): Working directory of the command.
+
+    Returns:
+    - tuple: (duration in seconds, peak RSS of the command in MB).
+    """
+    output = subprocess.run([sys.executable, "-c", COMMAND_LAUNCHER] + command, cwd=cwd, check=True,
+                            capture_output=True, text=True).stdout
+    seconds, maxrss = output.split()
+    return float(seconds), maxrss_mb(int(maxrss))
+
+
+def bench_inference(weights_path, corpus, backends, batch_sizes, repeats, warmup, confidence=0.25):
+    """
+    Benchmark the forward pass for each backend, batch size and image.
+
+    Returns:
+    - list: One result dict per scenario.
+    """
+    results = []
+    for backend in backends:
+        backend_path = resolve_weights(weights_path, backend)
+        model_registry.get_model(backend_path, DEVICE)
+        for name, img in corpus.items():
+            for batch_size in batch_sizes:
+                batch = [img] * batch_size
+                stats = measure(lambda: model_registry.predict(backend_path, batch, device=DEVICE, conf=confidence,
+                                                               verbose=False),
+                                batch_size, repeats, warmup)
+                results.append(dict(stats, name="inference", backend=backend, image=name,
+                                    resolution=list(img.shape[1::-1]), batch_size=batch_size))
+                print(results[-1])
+    return results
+
+
+def bench_detect_animal(weights_path, corpus, formats, repeats, warmup, confidence=0.25):
+    """
+    Benchmark `detect_animal` (post-processing and encoding included) for each
+    response format and image.
+
+    Returns:
+    - list: One result dict per scenario.
+    """
+    results = []
+    for name, img in corpus.items():
+        for response_format in formats:
+            stats = measure(lambda: detect_animal(img, weights_path, confidence=confidence,
+                                                  response_format=response_format),
+                            1, repeats, warmup)
+            results.append(dict(stats, name="detect_animal", image=name, resolution=list(img.shape[1::-1]),
+                                format=response_format))
+            print(results[-1])
+    return results
+
+
+def bench_endpoint(corpus, formats, batch_sizes, repeats, warmup):
+    """
+    Benchmark POST /predict through the Flask test client, the images being
+    sent as local paths.
+
+    Returns:
+    - list: One result dict per scenario.
+    """
+    # Repeated images would only measure the result cache
+    os.environ.setdefault("RESULT_CACHE_SIZE", "0")
+    # Importing the app loads the model of the serving configuration
+    from app import app
+
+    client = app.test_client()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, img in corpus.items():
+            path = os.path.join(tmp_dir, f"{name}.jpg")
+            Image.fromarray(img[..., ::-1]).save(path, quality=90)
+            for response_format in formats:
+                for batch_size in batch_sizes:
+                    body = {"input": [path] * batch_size, "format": response_format}
+
+                    def post():
+                        response = client.post("/predict", json=body)
+                        assert response.status_code == 200, response.data[:200]
+                        return response.data
+
+                    stats = measure(post, batch_size, repeats, warmup)
+                    stats["response_bytes"] = len(post())
+                    results.append(dict(stats, name="endpoint", image=name, resolution=list(img.shape[1::-1]),
+                                        format=response_format, batch_size=batch_size))
+                    print(results[-1])
+    return results
+
+
+def bench_decode(corpus, repeats, warmup, decode_sides=DECODE_SIDES, resolutions=DECODE_RESOLUTIONS):
+    """
+    Benchmark the decoding of uploaded JPEG images, at full resolution and at
+    a reduced size (see `fetch.decode_chunks`).
+
+    Returns:
+    - list: One result dict per scenario.
+    """
+    images = dict(corpus)
+    for i, (width, height) in enumerate(resolutions):
+        images[f"synthetic_{width}x{height}"] = synthetic_frame(width, height, seed=len(corpus) + i)
+
+    results = []
+    for name, img in images.items():
+        buffer = BytesIO()
+        Image.fromarray(img[..., ::-1]).save(buffer, format="JPEG", quality=90)
+        encoded = buffer.getvalue()
+        for decode_side in decode_sides:
+            decoded = fetch_image(encoded, max_bytes=len(encoded), max_side=decode_side)[0]
+            stats = measure(lambda: fetch_image(encoded, max_bytes=len(encoded), max_side=decode_side), 1, repeats,
+                            warmup)
+            results.append(dict(stats, name="decode", image=name, resolution=list(img.shape[1::-1]),
+                                decode_side=decode_side, decoded_mb=decoded.nbytes / 2 ** 20))
+            print(results[-1])
+    return results
+
+
+def imported_heavy_modules(module):
+    """
+    List the heavy modules (see HEAVY_MODULES) imported by importing a module,
+    in a fresh interpreter.
+
+    Parameters:
+    - module (str): Name of the module.
+
+    Returns:
+    - list: Names of the heavy modules imported.
+    """
+    code = (f"import importlib, json, sys; importlib.import_module({module!r}); "
+            f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))")
+    output = subprocess.run([sys.executable, "-c", code], cwd=PROJECT_ROOT, check=True, capture_output=True, text=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def bench_startup(repeats, warmup=1):
+    """
+    Benchmark the cold start of the API (importing the app, model loading
+    included) and the time of the CLI tools to print their --help, each in a
+    fresh interpreter. Also check that the light modules do not import heavy
+    dependencies.
+
+    Returns:
+    - list: One result dict per command or module.
+    """
+    results = []
+    for name, (command, cwd) in STARTUP_COMMANDS.items():
+        for _ in range(warmup):
+            run_command(command, cwd)
+        latencies, peaks = zip(*(run_command(command, cwd) for _ in range(repeats)))
+        stats = dict(latency_stats(latencies, 1), peak_rss_mb=max(peaks))
+        results.append(dict(stats, name="startup", command=name))
+        print(results[-1])
+    for module in LIGHT_MODULES:
+        heavy_modules = imported_heavy_modules(module)
+        if heavy_modules:
+            print(f"WARNING: importing {module} imports {', '.join(heavy_modules)}")
+        results.append({"name": "imports", "module": module, "heavy_modules": heavy_modules})
+    return results
+
+
+def scenario_key(result):
+    """
+    Build the key identifying the scenario of a result (everything but the measures).
+    """
+    measures = {"p50_ms", "p95_ms", "p99_ms", "mean_ms", "images_per_s", "peak_rss_mb", "process_peak_rss_mb",
+                "response_bytes", "heavy_modules", "decoded_mb"}
+    return json.dumps({k: v for k, v in result.items() if k not in measures}, sort_keys=True)
+
+
+def compare_reports(baseline_path, new_path, threshold=0.1):
+    """
+    Compare two benchmark reports and print the regressions.
+
+    Parameters:
+    - baseline_path (str): Path to the baseline report.
+    - new_path (str): Path to the new report.
+    - threshold (float): Relative change above which a scenario is a regression.
+
+    Returns:
+    - list: Regressed scenarios with their p50 and throughput changes.
+    """
+    with open(baseline_path) as file:
+        baseline = {scenario_key(r): r for r in json.load(file)["results"]}
+    with open(new_path) as file:
+        new = {scenario_key(r): r for r in json.load(file)["results"]}
+
+    regressions = []
+    for key in sorted(baseline.keys() & new.keys()):
+        if "p50_ms" not in new[key]:
+            continue
+        p50_change = new[key]["p50_ms"] / baseline[key]["p50_ms"] - 1
+        throughput_change = new[key]["images_per_s"] / baseline[key]["images_per_s"] - 1
+        flag = p50_change > threshold or throughput_change < -threshold
+        print(f"{'REGRESSION ' if flag else ''}{key}: p50 {p50_change:+.1%}, images/s {throughput_change:+.1%}")
+        if flag:
+            regressions.append({"scenario": json.loads(key), "p50_change": p50_change,
+                                "images_per_s_change": throughput_change})
+    for key in sorted(baseline.keys() ^ new.keys()):
+        print(f"only in {'baseline' if key in baseline else 'new report'}: {key}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the inference path and the /predict endpoint.")
+    parser.add_argument("--weights", default=YOLO_WEIGHTS_PATH)
+    parser.add_argument("--suites", nargs="+", default=["inference", "detect_animal", "endpoint"],
+                        choices=["inference", "detect_animal", "endpoint", "decode", "startup"])
+    parser.add_argument("--backends", nargs="+", default=["torch"])
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 4, 8])
+    parser.add_argument("--formats", nargs="+", default=["boxes", "jpeg", "list"])
+    parser.add_argument("--images", nargs="+", default=CORPUS_IMAGES, help="local images of the corpus")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--output", default="benchmark.json", help="where to write the JSON report")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "NEW"),
+                        help="compare two reports instead of running the benchmark")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change flagged as a regression")
+    args = parser.parse_args()
+
+    if args.compare:
+        regressions = compare_reports(*args.compare, threshold=args.threshold)
+        raise SystemExit(1 if regressions else 0)
+
+    corpus = load_corpus(args.images) if set(args.suites) - {"startup"} else {}
+    results = []
+    if "inference" in args.suites:
+        results += bench_inference(args.weights, corpus, args.backends, args.batch_sizes, args.repeats, args.warmup)
+    if "detect_animal" in args.suites:
+        results += bench_detect_animal(args.weights, corpus, args.formats, args.repeats, args.warmup)
+    if "endpoint" in args.suites:
+        results += bench_endpoint(corpus, args.formats, args.batch_sizes, args.repeats, args.warmup)
+    if "decode" in args.suites:
+        results += bench_decode(corpus, args.repeats, args.warmup)
+    if "startup" in args.suites:
+        results += bench_startup(args.repeats)
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "weights": args.weights,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Report saved to {args.output}")
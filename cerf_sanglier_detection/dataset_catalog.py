@@ -0,0 +1,203 @@
+import hashlib
+import os
+import sqlite3
+from PIL import Image
+from settings import IMG_FOLDER
+
+IMAGE_EXTENSIONS = {".jpg", ".png", ".jpeg", ".gif", ".bmp"}
+CATALOG_NAME = "catalog.sqlite"
+
+
+def default_catalog_path(img_folder):
+    """
+    Get the default catalog path of an images folder (next to it, in the data folder).
+
+    Parameters:
+    - img_folder (str): Path to the folder containing images.
+
+    Returns:
+    - str: Path to the catalog.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(img_folder)), CATALOG_NAME)
+
+
+def open_catalog(db_path):
+    """
+    Open the dataset catalog, creating it if needed.
+
+    Parameters:
+    - db_path (str): Path to the SQLite catalog.
+
+    Returns:
+    - sqlite3.Connection: Connection to the catalog.
+    """
+    connection = sqlite3.connect(db_path)
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS images ('
+        'name TEXT PRIMARY KEY, class_name TEXT, size INTEGER, mtime_ns INTEGER, hash TEXT, '
+        'width INTEGER, height INTEGER, label_path TEXT, label_mtime_ns INTEGER, box_count INTEGER)'
+    )
+    connection.execute('CREATE INDEX IF NOT EXISTS images_class ON images (class_name)')
+    return connection
+
+
+def file_hash(path):
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def count_boxes(label_path):
+    with open(label_path, 'r') as file:
+        return sum(1 for line in file if line.strip())
+
+
+def update_catalog(img_folder, labels_folder=None, db_path=None, with_hash=True):
+    """
+    Update the catalog of an images folder. Only the images (and labels) whose
+    size or modification time changed since the last update are read again.
+
+    Parameters:
+    - img_folder (str): Path to the folder containing images.
+    - labels_folder (str): Path to the folder containing YOLO labels (default:
+      'labels' next to the images folder).
+    - db_path (str): Path to the SQLite catalog (default: next to the images folder).
+    - with_hash (bool): Whether to hash the content of new or modified images.
+
+    Returns:
+    - dict: Number of images added, updated, unchanged and removed.
+    """
+    if labels_folder is None:
+        labels_folder = os.path.join(os.path.dirname(os.path.abspath(img_folder)), 'labels')
+    db_path = db_path or default_catalog_path(img_folder)
+
+    # One scan of each folder, the stats come with the directory entries
+    labels = {}
+    if os.path.isdir(labels_folder):
+        for entry in os.scandir(labels_folder):
+            if entry.is_file() and entry.name.endswith('.txt'):
+                labels[entry.name[:-4]] = entry
+
+    counts = {'added': 0, 'updated': 0, 'unchanged': 0, 'removed': 0}
+    connection = open_catalog(db_path)
+    with connection:
+        known = {row[0]: row[1:] for row in connection.execute(
+            'SELECT name, size, mtime_ns, label_mtime_ns, hash FROM images')}
+        seen = set()
+        rows = []
+        for entry in os.scandir(img_folder):
+            stem, extension = os.path.splitext(entry.name)
+            if extension.lower() not in IMAGE_EXTENSIONS or not entry.is_file():
+                continue
+            seen.add(entry.name)
+            stat = entry.stat()
+            label = labels.get(stem)
+            label_mtime_ns = label.stat().st_mtime_ns if label is not None else None
+
+            record = known.get(entry.name)
+            # Images cataloged without hash are read again when a hash is needed
+            if (record is not None and record[:3] == (stat.st_size, stat.st_mtime_ns, label_mtime_ns)
+                    and (record[3] is not None or not with_hash)):
+                counts['unchanged'] += 1
+                continue
+            counts['updated' if entry.name in known else 'added'] += 1
+
+            try:
+                with Image.open(entry.path) as img:
+                    width, height = img.size
+            except OSError:
+                width, height = None, None
+            rows.append((
+                entry.name, entry.name.split('_')[0], stat.st_size, stat.st_mtime_ns,
+                file_hash(entry.path) if with_hash else None, width, height,
+                label.path if label is not None else None, label_mtime_ns,
+                count_boxes(label.path) if label is not None else None,
+            ))
+
+        connection.executemany('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        removed = [(name,) for name in known if name not in seen]
+        connection.executemany('DELETE FROM images WHERE name = ?', removed)
+        counts['removed'] = len(removed)
+    connection.close()
+    return counts
+
+
+def query_images(db_path, class_name=None, annotated=None, exclude=None):
+    """
+    List the images of the catalog.
+
+    Parameters:
+    - db_path (str): Path to the SQLite catalog.
+    - class_name (str): Only list the images of this class.
+    - annotated (bool): Only list the images with (True) or without (False) a label file.
+    - exclude (iterable): Image names not to list.
+
+    Returns:
+    - list: List of image names, sorted.
+    """
+    query = 'SELECT name FROM images WHERE 1 = 1'
+    params = []
+    if class_name is not None:
+        query += ' AND class_name = ?'
+        params.append(class_name)
+    if annotated is not None:
+        query += ' AND label_path IS NOT NULL' if annotated else ' AND label_path IS NULL'
+    query += ' ORDER BY name'
+
+    connection = open_catalog(db_path)
+    names = [row[0] for row in connection.execute(query, params)]
+    connection.close()
+
+    if exclude:
+        exclude = set(exclude)
+        names = [name for name in names if name not in exclude]
+    return names
+
+
+def get_records(db_path, names=None):
+    """
+    Get the catalog records of images.
+
+    Parameters:
+    - db_path (str): Path to the SQLite catalog.
+    - names (list): Image names (default: every image).
+
+    Returns:
+    - list: List of dictionaries, one per image.
+    """
+    connection = open_catalog(db_path)
+    connection.row_factory = sqlite3.Row
+    rows = connection.execute('SELECT * FROM images ORDER BY name').fetchall()
+    connection.close()
+    records = [dict(row) for row in rows]
+    if names is not None:
+        names = set(names)
+        records = [record for record in records if record['name'] in names]
+    return records
+
+
+def class_counts(db_path):
+    """
+    Count the images and boxes of each class.
+
+    Parameters:
+    - db_path (str): Path to the SQLite catalog.
+
+    Returns:
+    - dict: Dictionary mapping a class name to its number of images, annotated images and boxes.
+    """
+    connection = open_catalog(db_path)
+    rows = connection.execute(
+        'SELECT class_name, COUNT(*), COUNT(label_path), COALESCE(SUM(box_count), 0) '
+        'FROM images GROUP BY class_name'
+    ).fetchall()
+    connection.close()
+    return {class_name: {'images': nb_images, 'annotated': nb_annotated, 'boxes': nb_boxes}
+            for class_name, nb_images, nb_annotated, nb_boxes in rows}
+
+
+if __name__ == "__main__":
+    print(update_catalog(IMG_FOLDER))
+    print(class_counts(default_catalog_path(IMG_FOLDER)))
@@ -0,0 +1,350 @@
+import argparse
+import json
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from settings import DATA_FOLDER, PROJECT_ROOT
+
+SHARDS_FOLDER = os.path.join(DATA_FOLDER, "shards")
+CONFIG_PATH = os.path.join(PROJECT_ROOT, "config.yaml")
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+DEFAULT_IMGSZ = 640
+# Files of a shard
+IMAGES_FILE = "images.u8"
+INDEX_FILE = "index.npy"
+LABELS_FILE = "labels.npy"
+LABEL_OFFSETS_FILE = "label_offsets.npy"
+META_FILE = "meta.json"
+
+
+def read_config(config_path):
+    """
+    Read a training config.yaml (see `yolo_train.create_config_file`).
+
+    Parameters:
+    - config_path (str): Path to the config file.
+
+    Returns:
+    - dict: Content of the config, with the train and val paths made absolute.
+    """
+    import yaml
+
+    with open(config_path) as file:
+        config = yaml.safe_load(file)
+    root = config.get('path') or os.path.dirname(os.path.abspath(config_path))
+    for split in ('train', 'val'):
+        if config.get(split) and not os.path.isabs(config[split]):
+            config[split] = os.path.join(root, config[split])
+    return config
+
+
+def list_split_images(split_path):
+    """
+    List the images of a split, given as a folder or as a .txt image list.
+
+    Parameters:
+    - split_path (str): Path to the image folder or to the image list.
+
+    Returns:
+    - list: Sorted paths to the images.
+    """
+    if split_path.endswith('.txt'):
+        with open(split_path) as file:
+            base = os.path.dirname(split_path)
+            paths = [os.path.join(base, line.strip()) for line in file if line.strip()]
+    else:
+        paths = [os.path.join(split_path, f) for f in os.listdir(split_path)]
+    return sorted(p for p in paths if p.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def label_path(image_path):
+    """
+    Get the YOLO label file of an image, with the rule of ultralytics
+    ('data/images/x.jpg' -> 'data/labels/x.txt').
+
+    Parameters:
+    - image_path (str): Path to the image.
+
+    Returns:
+    - str: Path to the label file.
+    """
+    sa, sb = f'{os.sep}images{os.sep}', f'{os.sep}labels{os.sep}'
+    return sb.join(image_path.rsplit(sa, 1)).rsplit('.', 1)[0] + '.txt'
+
+
+def read_labels(image_path):
+    """
+    Read the YOLO labels of an image.
+
+    Parameters:
+    - image_path (str): Path to the image.
+
+    Returns:
+    - np.ndarray: Rows (class_id, x, y, w, h) of shape (n, 5), normalized coordinates.
+    """
+    path = label_path(image_path)
+    if not os.path.isfile(path):
+        return np.zeros((0, 5), dtype=np.float32)
+    labels = np.loadtxt(path, dtype=np.float32, ndmin=2)
+    return labels[:, :5].reshape(-1, 5)
+
+
+def load_resized(image_path, imgsz):
+    """
+    Decode an image and resize its long side to `imgsz`, like ultralytics does
+    for each image at each epoch (the aspect ratio is kept, the letterboxing
+    and the augmentations stay done by the training loop).
+
+    Parameters:
+    - image_path (str): Path to the image.
+    - imgsz (int): Training image size.
+
+    Returns:
+    - tuple: (BGR image, (original height, original width)).
+    """
+    import cv2
+
+    img = cv2.imread(image_path)
+    if img is None:
+        raise ValueError(f"Cannot decode {image_path}")
+    h0, w0 = img.shape[:2]
+    ratio = imgsz / max(h0, w0)
+    if ratio != 1:
+        w, h = min(math.ceil(w0 * ratio), imgsz), min(math.ceil(h0 * ratio), imgsz)
+        img = cv2.resize(img, (w, h), interpolation=cv2.INTER_LINEAR)
+    return img, (h0, w0)
+
+
+def pack_split(image_paths, shard_dir, imgsz=DEFAULT_IMGSZ, num_workers=8):
+    """
+    Pack the images of a split and their labels into a shard: the resized
+    pixels are appended to one flat uint8 file (memory-mapped when training),
+    indexed by their offset and shape, and the labels are packed in one array.
+
+    Parameters:
+    - image_paths (list): Paths to the images of the split.
+    - shard_dir (str): Folder of the shard (overwritten).
+    - imgsz (int): Training image size.
+    - num_workers (int): Number of threads decoding the images.
+
+    Returns:
+    - dict: Metadata of the shard.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    # Row of the index: (offset, height, width, original height, original width)
+    index = np.zeros((len(image_paths), 5), dtype=np.int64)
+    labels = []
+    files, skipped = [], []
+    offset = 0
+    images_path = os.path.join(shard_dir, IMAGES_FILE)
+    # Written next to its final path, so that an interrupted packing is not taken for a shard
+    with open(images_path + ".part", "wb") as images_file, ThreadPoolExecutor(max_workers=num_workers) as executor:
+
+        def load(image_path):
+            try:
+                return load_resized(image_path, imgsz)
+            except ValueError:
+                return None
+
+        # Decoded in parallel, written in order
+        for image_path, loaded in zip(image_paths, executor.map(load, image_paths)):
+            if loaded is None:
+                skipped.append(image_path)
+                continue
+            img, (h0, w0) = loaded
+            images_file.write(np.ascontiguousarray(img).tobytes())
+            index[len(files)] = (offset, img.shape[0], img.shape[1], h0, w0)
+            offset += img.nbytes
+            labels.append(read_labels(image_path))
+            files.append(image_path)
+    os.replace(images_path + ".part", images_path)
+
+    label_offsets = np.cumsum([0] + [len(label) for label in labels], dtype=np.int64)
+    np.save(os.path.join(shard_dir, INDEX_FILE), index[:len(files)])
+    np.save(os.path.join(shard_dir, LABELS_FILE),
+            np.concatenate(labels) if labels else np.zeros((0, 5), dtype=np.float32))
+    np.save(os.path.join(shard_dir, LABEL_OFFSETS_FILE), label_offsets)
+    meta = {"imgsz": imgsz, "files": files, "skipped": skipped, "nbytes": offset,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    with open(os.path.join(shard_dir, META_FILE), "w") as file:
+        json.dump(meta, file)
+    return meta
+
+
+def pack_shards(config_path=CONFIG_PATH, shards_folder=SHARDS_FOLDER, imgsz=DEFAULT_IMGSZ, num_workers=8):
+    """
+    Pack the train and val splits of a config.yaml into shards.
+
+    Parameters:
+    - config_path (str): Path to the training config file.
+    - shards_folder (str): Folder of the shards, one sub-folder per split.
+    - imgsz (int): Training image size.
+    - num_workers (int): Number of threads decoding the images.
+
+    Returns:
+    - dict: Metadata of each shard, by split.
+    """
+    config = read_config(config_path)
+    metas = {}
+    for split in ('train', 'val'):
+        image_paths = list_split_images(config[split])
+        metas[split] = pack_split(image_paths, os.path.join(shards_folder, split), imgsz, num_workers)
+        print(f"{split}: {len(metas[split]['files'])} images packed ({metas[split]['nbytes'] / 2 ** 20:.0f} MB), "
+              f"{len(metas[split]['skipped'])} skipped")
+    return metas
+
+
+def load_shard(shard_dir):
+    """
+    Open a shard, its pixels being memory-mapped (read from the page cache,
+    not loaded in memory).
+
+    Parameters:
+    - shard_dir (str): Folder of the shard.
+
+    Returns:
+    - dict: 'images' (flat uint8 memmap), 'index', 'labels', 'label_offsets' and 'meta'.
+    """
+    with open(os.path.join(shard_dir, META_FILE)) as file:
+        meta = json.load(file)
+    return {
+        "images": np.memmap(os.path.join(shard_dir, IMAGES_FILE), dtype=np.uint8, mode="r"),
+        "index": np.load(os.path.join(shard_dir, INDEX_FILE)),
+        "labels": np.load(os.path.join(shard_dir, LABELS_FILE)),
+        "label_offsets": np.load(os.path.join(shard_dir, LABEL_OFFSETS_FILE)),
+        "meta": meta,
+    }
+
+
+def shard_image(shard, i):
+    """
+    Get an image of a shard.
+
+    Parameters:
+    - shard (dict): Shard opened by `load_shard`.
+    - i (int): Index of the image.
+
+    Returns:
+    - tuple: (BGR image, (original height, original width)); the image is a
+      read-only view of the memmap.
+    """
+    offset, h, w, h0, w0 = shard["index"][i].tolist()
+    img = shard["images"][offset:offset + h * w * 3].reshape(h, w, 3)
+    return img, (h0, w0)
+
+
+def shard_labels(shard, i):
+    """
+    Get the labels of an image of a shard.
+
+    Parameters:
+    - shard (dict): Shard opened by `load_shard`.
+    - i (int): Index of the image.
+
+    Returns:
+    - np.ndarray: Rows (class_id, x, y, w, h) of shape (n, 5).
+    """
+    start, end = shard["label_offsets"][i:i + 2]
+    return shard["labels"][start:end]
+
+
+def train(config_path, shards_folder=SHARDS_FOLDER, weights="yolov8n.pt", **train_args):
+    """
+    Train a YOLO model on the shards of a config.
+
+    Parameters:
+    - config_path (str): Path to the training config file (for the class names).
+    - shards_folder (str): Folder of the shards packed by `pack_shards`.
+    - weights (str): Pretrained weights.
+    - **train_args: Other arguments of `YOLO.train` (epochs, batch, ...).
+
+    Returns:
+    - DetectionTrainer: The trainer, with its metrics and paths to the weights.
+    """
+    from functools import partial
+    from ultralytics import YOLO
+    from shard_trainer import ShardDetectionTrainer
+
+    model = YOLO(weights)
+    model.train(data=config_path, trainer=partial(ShardDetectionTrainer, shards_folder), **train_args)
+    return model.trainer
+
+
+def bench_epochs(config_path, shards_folder=SHARDS_FOLDER, epochs=2, batch=7, imgsz=DEFAULT_IMGSZ, workers=2,
+                 weights="yolov8n.pt", val=True):
+    """
+    Measure the epochs per hour of the training on the image folders and on
+    the shards.
+
+    Parameters:
+    - config_path (str): Path to the training config file.
+    - shards_folder (str): Folder of the shards packed by `pack_shards`.
+    - epochs (int): Number of epochs of each run (the first one is not timed, it warms the page cache up).
+    - batch (int): Batch size.
+    - imgsz (int): Training image size.
+    - workers (int): Number of data loader workers.
+    - weights (str): Pretrained weights.
+    - val (bool): Whether to validate at each epoch, as a real training does.
+
+    Returns:
+    - dict: Epochs per hour and epoch durations of each layout.
+    """
+    from functools import partial
+    from ultralytics import YOLO
+    from shard_trainer import ShardDetectionTrainer
+
+    results = {}
+    for layout in ('folders', 'shards'):
+        # Time at the start of the first epoch, then at the end of each epoch (validation included)
+        epoch_ends = []
+
+        def on_train_epoch_start(trainer):
+            if not epoch_ends:
+                epoch_ends.append(time.perf_counter())
+
+        model = YOLO(weights)
+        model.add_callback("on_train_epoch_start", on_train_epoch_start)
+        model.add_callback("on_fit_epoch_end", lambda trainer: epoch_ends.append(time.perf_counter()))
+        trainer = partial(ShardDetectionTrainer, shards_folder) if layout == 'shards' else None
+        model.train(data=config_path, trainer=trainer, epochs=epochs, batch=batch, imgsz=imgsz, workers=workers,
+                    device='cpu', val=val, plots=False, project=os.path.join(PROJECT_ROOT, "runs", "bench_shards"),
+                    name=layout, exist_ok=True)
+        # The first epoch is left out: it pays for the cold page cache (and the first label scan of the folders)
+        durations = np.diff(epoch_ends)[1:] if len(epoch_ends) > 2 else np.diff(epoch_ends)
+        results[layout] = {"epoch_s": durations.tolist(), "epochs_per_hour": 3600 / float(np.mean(durations))}
+        print(layout, results[layout])
+    results["speedup"] = results["shards"]["epochs_per_hour"] / results["folders"]["epochs_per_hour"]
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack the training splits into pre-decoded shards, train on them, "
+                                                 "or compare their training speed with the image folders.")
+    parser.add_argument("command", choices=["pack", "train", "bench"])
+    parser.add_argument("--config", default=CONFIG_PATH, help="training config (train and val splits)")
+    parser.add_argument("--shards", default=SHARDS_FOLDER, help="folder of the shards")
+    parser.add_argument("--imgsz", type=int, default=DEFAULT_IMGSZ)
+    parser.add_argument("--workers", type=int, default=8, help="decoding threads (pack) or data loader workers")
+    parser.add_argument("--weights", default="yolov8n.pt")
+    parser.add_argument("--epochs", type=int, help="epochs of the training (default 300) or of each bench run "
+                                                   "(default 3)")
+    parser.add_argument("--batch", type=int, default=7)
+    parser.add_argument("--no-val", action="store_true", help="bench: do not validate at each epoch")
+    parser.add_argument("--output", default="bench_shards.json", help="bench: where to write the JSON report")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        pack_shards(args.config, args.shards, args.imgsz, args.workers)
+    elif args.command == "train":
+        train(args.config, args.shards, args.weights, epochs=args.epochs or 300, batch=args.batch, imgsz=args.imgsz,
+              workers=args.workers)
+    else:
+        report = bench_epochs(args.config, args.shards, args.epochs or 3, args.batch, args.imgsz, args.workers,
+                              args.weights, not args.no_val)
+        report["meta"] = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "cpu_count": os.cpu_count(),
+                          "config": args.config}
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Speedup of the shards: x{report['speedup']:.2f}, report saved to {args.output}")
@@ -1,56 +1,241 @@
+import hashlib
+import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-HOME = os.getcwd()
-HOME = os.path.dirname(HOME)
+from settings import DATA_FOLDER, IMG_FOLDER, URL_FILES_PATH
 
-URL_FILES_PATH = os.path.join(HOME, "data", "urls")
-IMG_FOLDER = os.path.join(HOME, "data", "images")
+MANIFEST_PATH = os.path.join(DATA_FOLDER, "download_manifest.json")
 
-def download_images_from_file(file_path, output_folder):
+# (connect, read) timeouts in seconds
+TIMEOUT = (3.05, 30)
+CHUNK_SIZE = 64 * 1024
+
+
+def create_session(pool_size=8, retries=3, backoff_factor=0.5):
     """
-    Download images from URLs listed in a file.
+    Create an HTTP session reusing its connections and retrying with
+    exponential backoff on connection errors and 429/5xx responses.
 
     Parameters:
-    - file_path (str): Path to the file containing image URLs.
-    - output_folder (str): Path to the folder where downloaded images will be saved.
+    - pool_size (int): Maximum number of connections kept per host.
+    - retries (int): Number of retries.
+    - backoff_factor (float): Backoff factor between retries (in seconds).
+
+    Returns:
+    - requests.Session: HTTP session.
     """
-    # Create the output folder if it doesn't exist
-    os.makedirs(output_folder, exist_ok=True)
+    retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class DownloadManifest:
+    """
+    Record of every url downloaded (image name, content hash, size and status),
+    used to skip the urls already downloaded and to deduplicate images by
+    content across url files.
+    """
+
+    def __init__(self, manifest_path):
+        """
+        Parameters:
+        - manifest_path (str): Path to the manifest file (created if needed).
+        """
+        self.manifest_path = manifest_path
+        self.entries = {}
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, 'r') as file:
+                self.entries = json.load(file)
+        # Content hash -> name of the image holding this content
+        self.hashes = {entry['hash']: entry['image_name'] for entry in self.entries.values()
+                       if entry['status'] == 'ok'}
+        self.lock = threading.Lock()
+
+    def is_done(self, url, output_folder):
+        entry = self.entries.get(url)
+        if entry is None:
+            return False
+        # A duplicate is only done while the image holding its content is still there
+        image_name = entry['duplicate_of'] if entry['status'] == 'duplicate' else entry['image_name']
+        return entry['status'] in ('ok', 'duplicate') and os.path.isfile(os.path.join(output_folder, image_name))
+
+    def record(self, url, **entry):
+        with self.lock:
+            self.entries[url] = entry
+
+    def claim_hash(self, content_hash, image_name):
+        """
+        Register the content of an image.
+
+        Returns:
+        - str or None: Name of the image already holding this content, None if it is new.
+        """
+        with self.lock:
+            if content_hash in self.hashes and self.hashes[content_hash] != image_name:
+                return self.hashes[content_hash]
+            self.hashes[content_hash] = image_name
+            return None
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.manifest_path) or '.', exist_ok=True)
+        with self.lock:
+            content = json.dumps(self.entries, indent=2)
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            file.write(content)
+        os.replace(tmp_path, self.manifest_path)
+
+
+def download_image(session, url, image_path, manifest, timeout=TIMEOUT):
+    """
+    Download one image, streaming it to disk. An image whose content was
+    already downloaded from another url is not kept.
+
+    Parameters:
+    - session (requests.Session): HTTP session.
+    - url (str): Url of the image.
+    - image_path (str): Where to save the image.
+    - manifest (DownloadManifest): Manifest of the downloads.
+    - timeout (tuple): (connect, read) timeouts in seconds.
+
+    Returns:
+    - dict: Manifest entry of the url.
+    """
+    image_name = os.path.basename(image_path)
+    tmp_path = image_path + '.part'
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        with session.get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            with open(tmp_path, 'wb') as image_file:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    hasher.update(chunk)
+                    size += len(chunk)
+                    image_file.write(chunk)
+    except (requests.exceptions.RequestException, OSError) as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return {'image_name': image_name, 'hash': None, 'size': size, 'status': 'error', 'error': str(e)}
+
+    content_hash = hasher.hexdigest()
+    duplicate_of = manifest.claim_hash(content_hash, image_name)
+    if duplicate_of is not None:
+        os.remove(tmp_path)
+        return {'image_name': image_name, 'hash': content_hash, 'size': size, 'status': 'duplicate',
+                'duplicate_of': duplicate_of}
+
+    os.replace(tmp_path, image_path)
+    return {'image_name': image_name, 'hash': content_hash, 'size': size, 'status': 'ok'}
+
 
+def list_urls(file_path):
+    """
+    List the urls of a file with the names of their images.
+
+    Parameters:
+    - file_path (str): Path to the file containing image URLs.
+
+    Returns:
+    - list: List of (url, image_name) tuples.
+    """
     # Extract class name from the file path
     class_name = os.path.splitext(os.path.basename(file_path))[0].split("_")[0]
 
     # Read URLs from the file
     with open(file_path, 'r') as file:
-        urls = file.readlines()
+        urls = [url.strip() for url in file.readlines()]  # Remove leading/trailing whitespaces
+
+    return [(url, f"{class_name}_{i + 1}.jpg") for i, url in enumerate(urls) if url]
+
+
+def download_images(url_files, output_folder, manifest_path=MANIFEST_PATH, max_workers=8, session=None,
+                    timeout=TIMEOUT):
+    """
+    Download the images of several url files concurrently, skipping the urls
+    already downloaded by a previous run and the images whose content was
+    already downloaded.
+
+    Parameters:
+    - url_files (list): Paths to the files containing image URLs.
+    - output_folder (str): Path to the folder where downloaded images will be saved.
+    - manifest_path (str): Path to the download manifest.
+    - max_workers (int): Number of images downloaded at the same time.
+    - session (requests.Session): HTTP session (one is created by default).
+    - timeout (tuple): (connect, read) timeouts in seconds.
+
+    Returns:
+    - dict: Number of urls by status ('ok', 'duplicate', 'error', 'skipped').
+    """
+    # Create the output folder if it doesn't exist
+    os.makedirs(output_folder, exist_ok=True)
+    manifest = DownloadManifest(manifest_path)
+    session = session or create_session(pool_size=max_workers)
+
+    todo = []
+    counts = {'ok': 0, 'duplicate': 0, 'error': 0, 'skipped': 0}
+    seen_urls = set()
+    for file_path in url_files:
+        for url, image_name in list_urls(file_path):
+            if manifest.is_done(url, output_folder):
+                counts['skipped'] += 1
+            elif url in seen_urls:
+                # The manifest has one entry per url: a url of several files is downloaded once
+                counts['duplicate'] += 1
+            else:
+                seen_urls.add(url)
+                todo.append((url, image_name))
 
-    # Download images
-    for i, url in enumerate(urls):
-        url = url.strip()  # Remove leading/trailing whitespaces
-        try:
-            response = requests.get(url)
-            response.raise_for_status()  # Check for errors
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(download_image, session, url, os.path.join(output_folder, image_name),
+                                   manifest, timeout): url
+                   for url, image_name in todo}
+        for i, future in enumerate(as_completed(futures)):
+            url = futures[future]
+            entry = dict(future.result(), url=url)
+            manifest.record(url, **entry)
+            counts[entry['status']] += 1
+            if entry['status'] == 'error':
+                print(f"Error downloading {entry['image_name']}: {entry['error']}")
+            # Save the progress once in a while, so that an interrupted run can resume
+            if i % 50 == 49:
+                manifest.save()
 
-            # Save the image to the output folder
-            image_name = f"{class_name}_{i + 1}.jpg"
-            image_path = os.path.join(output_folder, image_name)
-            with open(image_path, 'wb') as image_file:
-                image_file.write(response.content)
+    manifest.save()
+    print(f"Downloads: {counts}")
+    return counts
+
+
+def download_images_from_file(file_path, output_folder, manifest_path=MANIFEST_PATH, max_workers=8):
+    """
+    Download images from URLs listed in a file.
 
-            print(f"{class_name} {i + 1} downloaded successfully: {image_path}")
+    Parameters:
+    - file_path (str): Path to the file containing image URLs.
+    - output_folder (str): Path to the folder where downloaded images will be saved.
+    - manifest_path (str): Path to the download manifest.
+    - max_workers (int): Number of images downloaded at the same time.
 
-        except requests.exceptions.RequestException as e:
-            print(f"Error downloading {class_name} {i + 1}: {e}")
+    Returns:
+    - dict: Number of urls by status ('ok', 'duplicate', 'error', 'skipped').
+    """
+    return download_images([file_path], output_folder, manifest_path, max_workers)
 
 # Example usage:
 # download_images_from_file("path/to/your/urls.txt", "path/to/your/output_folder")
-            
+
 if __name__ == "__main__":
-    
+
     urls_files = os.listdir(URL_FILES_PATH)
     urls_files = [os.path.join(URL_FILES_PATH, urls_file) for urls_file in urls_files]
 
-    # Download Images
-    for urls_file in urls_files:
-        download_images_from_file(urls_file, IMG_FOLDER)
\ No newline at end of file
+    # Download Images (shared connection pool and deduplication across the url files)
+    download_images(urls_files, IMG_FOLDER)
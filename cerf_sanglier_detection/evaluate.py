@@ -0,0 +1,431 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from settings import DATA_FOLDER, DEVICE, PROJECT_ROOT, YOLO_WEIGHTS_PATH
+from dataset_shards import read_config, list_split_images, read_labels
+from result_cache import weights_hash
+
+CONFIG_TEST_PATH = os.path.join(PROJECT_ROOT, "config_test.yaml")
+EVAL_CACHE_FOLDER = os.path.join(DATA_FOLDER, "eval_cache")
+# Predictions are cached down to this confidence, the sweeps can only use higher thresholds
+CONF_FLOOR = 0.001
+NMS_IOU = 0.7
+MAX_DET = 300
+# IoU thresholds of mAP50-95
+MAP_IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+# Batches of images decoded ahead of the model
+PREFETCH_BATCHES = 2
+
+
+def cache_path(weights_path, image_paths, imgsz, conf_floor=CONF_FLOOR, nms_iou=NMS_IOU,
+               cache_folder=EVAL_CACHE_FOLDER):
+    """
+    Get the cache file of the predictions of some weights on some images.
+
+    Parameters:
+    - weights_path (str): Path to the yolo(.pt) weight file.
+    - image_paths (list): Paths to the images.
+    - imgsz (int): Inference image size.
+    - conf_floor (float): Confidence threshold of the cached predictions.
+    - nms_iou (float): IoU threshold of the NMS.
+    - cache_folder (str): Folder of the cache.
+
+    Returns:
+    - str: Path to the .npz cache file.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(json.dumps([weights_hash(weights_path), imgsz, conf_floor, nms_iou]).encode())
+    for image_path in image_paths:
+        hasher.update(f"{image_path}:{os.stat(image_path).st_mtime_ns}\n".encode())
+    return os.path.join(cache_folder, f"{hasher.hexdigest()}.npz")
+
+
+def predict_images(weights_path, image_paths, imgsz=640, batch=16, num_workers=8, conf_floor=CONF_FLOOR,
+                   nms_iou=NMS_IOU, device=DEVICE):
+    """
+    Run the model on images, in batches, the next batches being decoded by a
+    thread pool while the model runs.
+
+    Parameters:
+    - weights_path (str): Path to the yolo(.pt) weight file.
+    - image_paths (list): Paths to the images.
+    - imgsz (int): Inference image size.
+    - batch (int): Number of images per forward pass.
+    - num_workers (int): Number of decoding threads.
+    - conf_floor (float): Confidence threshold of the predictions.
+    - nms_iou (float): IoU threshold of the NMS.
+    - device (str): Device used for inference.
+
+    Returns:
+    - dict: 'files' (decoded images), 'shapes' (height, width) of shape (n, 2), 'preds' (x1, y1, x2, y2,
+      score, class_id) in pixels of shape (m, 6) and 'pred_offsets' (predictions of image i are
+      preds[pred_offsets[i]:pred_offsets[i + 1]]).
+    """
+    import cv2
+    from ultralytics import YOLO
+
+    model = YOLO(weights_path)
+    batches = [image_paths[i:i + batch] for i in range(0, len(image_paths), batch)]
+    files, shapes, preds = [], [], []
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        queued = deque([executor.submit(cv2.imread, path) for path in paths] for paths in batches[:PREFETCH_BATCHES])
+        for i, paths in enumerate(batches):
+            futures = queued.popleft()
+            if i + PREFETCH_BATCHES < len(batches):
+                queued.append([executor.submit(cv2.imread, path) for path in batches[i + PREFETCH_BATCHES]])
+            decoded = [(path, future.result()) for path, future in zip(paths, futures)]
+            decoded = [(path, img) for path, img in decoded if img is not None]
+            if not decoded:
+                continue
+            results = model.predict([img for _, img in decoded], imgsz=imgsz, conf=conf_floor, iou=nms_iou,
+                                     max_det=MAX_DET, device=device, verbose=False)
+            for (path, img), result in zip(decoded, results):
+                files.append(path)
+                shapes.append(img.shape[:2])
+                preds.append(result.boxes.data.cpu().numpy().astype(np.float32))
+            print(f"{len(files)}/{len(image_paths)} images", end="\r")
+    print()
+    return {
+        "files": files,
+        "shapes": np.array(shapes, dtype=np.int64).reshape(-1, 2),
+        "preds": np.concatenate(preds) if preds else np.zeros((0, 6), dtype=np.float32),
+        "pred_offsets": np.cumsum([0] + [len(pred) for pred in preds], dtype=np.int64),
+    }
+
+
+def load_predictions(weights_path, image_paths, imgsz=640, batch=16, num_workers=8, device=DEVICE,
+                     cache_folder=EVAL_CACHE_FOLDER, refresh=False):
+    """
+    Get the low-threshold predictions of some weights on some images, from the
+    cache or by running the model once (and caching them).
+
+    Parameters:
+    - weights_path (str): Path to the yolo(.pt) weight file.
+    - image_paths (list): Paths to the images.
+    - imgsz (int): Inference image size.
+    - batch (int): Number of images per forward pass.
+    - num_workers (int): Number of decoding threads.
+    - device (str): Device used for inference.
+    - cache_folder (str): Folder of the cache (None to disable it).
+    - refresh (bool): Whether to run the model even if the predictions are cached.
+
+    Returns:
+    - dict: Predictions, see `predict_images`.
+    """
+    path = cache_path(weights_path, image_paths, imgsz, cache_folder=cache_folder) if cache_folder else None
+    if path and not refresh and os.path.isfile(path):
+        with np.load(path) as cached:
+            predictions = {key: cached[key] for key in ("shapes", "preds", "pred_offsets")}
+            predictions["files"] = cached["files"].tolist()
+        print(f"Predictions loaded from {path}")
+        return predictions
+
+    predictions = predict_images(weights_path, image_paths, imgsz, batch, num_workers, device=device)
+    if path:
+        os.makedirs(cache_folder, exist_ok=True)
+        # Written next to its final path, so that an interrupted run is not taken for a cache
+        with open(path + ".part", "wb") as file:
+            np.savez(file, files=np.array(predictions["files"]), shapes=predictions["shapes"],
+                     preds=predictions["preds"], pred_offsets=predictions["pred_offsets"])
+        os.replace(path + ".part", path)
+        print(f"Predictions cached in {path}")
+    return predictions
+
+
+def load_ground_truth(files, shapes):
+    """
+    Read the YOLO labels of images, in pixels.
+
+    Parameters:
+    - files (list): Paths to the images.
+    - shapes (np.ndarray): (height, width) of the images, of shape (n, 2).
+
+    Returns:
+    - tuple: (boxes (class_id, x1, y1, x2, y2) of shape (m, 5), offsets of the boxes of each image).
+    """
+    labels = [read_labels(path) for path in files]
+    offsets = np.cumsum([0] + [len(label) for label in labels], dtype=np.int64)
+    labels = np.concatenate(labels) if labels else np.zeros((0, 5), dtype=np.float32)
+    # Size of the image of each box
+    sizes = np.repeat(shapes[:, ::-1], np.diff(offsets), axis=0).astype(np.float32)
+    centers, half_sizes = labels[:, 1:3] * sizes, labels[:, 3:5] * sizes / 2
+    return np.hstack([labels[:, :1], centers - half_sizes, centers + half_sizes]), offsets
+
+
+def image_pairs(pred_offsets, gt_offsets):
+    """
+    List every (prediction, ground truth box) pair of the same image, without
+    a loop over the images.
+
+    Parameters:
+    - pred_offsets (np.ndarray): Offsets of the predictions of each image.
+    - gt_offsets (np.ndarray): Offsets of the ground truth boxes of each image.
+
+    Returns:
+    - tuple: (prediction indices, ground truth indices) of the pairs.
+    """
+    pred_image = np.repeat(np.arange(len(pred_offsets) - 1), np.diff(pred_offsets))
+    counts = np.diff(gt_offsets)[pred_image]
+    pair_pred = np.repeat(np.arange(len(pred_image)), counts)
+    # Rank of each pair among the pairs of its prediction
+    rank = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    pair_gt = np.repeat(gt_offsets[:-1][pred_image], counts) + rank
+    return pair_pred, pair_gt
+
+
+def pair_iou(boxes1, boxes2):
+    """
+    Compute the IoU of pairs of boxes.
+
+    Parameters:
+    - boxes1 (np.ndarray): Boxes (x1, y1, x2, y2) of shape (n, 4).
+    - boxes2 (np.ndarray): Boxes (x1, y1, x2, y2) of shape (n, 4).
+
+    Returns:
+    - np.ndarray: IoU of each pair, of shape (n,).
+    """
+    top_left = np.maximum(boxes1[:, :2], boxes2[:, :2])
+    bottom_right = np.minimum(boxes1[:, 2:], boxes2[:, 2:])
+    inter = np.prod(np.clip(bottom_right - top_left, 0, None), axis=1)
+    area1 = np.prod(boxes1[:, 2:] - boxes1[:, :2], axis=1)
+    area2 = np.prod(boxes2[:, 2:] - boxes2[:, :2], axis=1)
+    return inter / np.maximum(area1 + area2 - inter, 1e-9)
+
+
+def match_pairs(pair_pred, pair_gt, ious, mask):
+    """
+    Match predictions and ground truth boxes one to one, the pairs of highest
+    IoU first (as ultralytics does).
+
+    Parameters:
+    - pair_pred (np.ndarray): Prediction index of each pair.
+    - pair_gt (np.ndarray): Ground truth index of each pair.
+    - ious (np.ndarray): IoU of each pair.
+    - mask (np.ndarray): Pairs which may be matched.
+
+    Returns:
+    - tuple: (prediction indices, ground truth indices) of the matches.
+    """
+    candidates = np.flatnonzero(mask)
+    candidates = candidates[np.argsort(-ious[candidates], kind="stable")]
+    candidates = candidates[np.unique(pair_pred[candidates], return_index=True)[1]]
+    candidates = candidates[np.argsort(-ious[candidates], kind="stable")]
+    candidates = candidates[np.unique(pair_gt[candidates], return_index=True)[1]]
+    return pair_pred[candidates], pair_gt[candidates]
+
+
+class Evaluation:
+    """
+    Predictions and ground truth of a split, with the IoU of every pair of the
+    same image computed once, so that each threshold of a sweep only costs a
+    few vectorized operations.
+    """
+
+    def __init__(self, predictions, nb_classes):
+        self.nb_classes = nb_classes
+        self.files = predictions["files"]
+        self.preds = predictions["preds"]
+        self.pred_offsets = predictions["pred_offsets"]
+        self.gts, self.gt_offsets = load_ground_truth(self.files, predictions["shapes"])
+        self.scores = self.preds[:, 4]
+        self.pred_classes = self.preds[:, 5].astype(int)
+        self.gt_classes = self.gts[:, 0].astype(int)
+        self.pred_images = np.repeat(np.arange(len(self.files)), np.diff(self.pred_offsets))
+        self.gt_images = np.repeat(np.arange(len(self.files)), np.diff(self.gt_offsets))
+        self.pair_pred, self.pair_gt = image_pairs(self.pred_offsets, self.gt_offsets)
+        self.pair_iou = pair_iou(self.preds[self.pair_pred, :4], self.gts[self.pair_gt, 1:])
+        self.same_class = self.pred_classes[self.pair_pred] == self.gt_classes[self.pair_gt]
+
+    def average_precision(self, iou_thresholds=MAP_IOU_THRESHOLDS):
+        """
+        Compute the average precision of each class at each IoU threshold
+        (101-point interpolation of COCO, with every prediction above the
+        cached confidence floor).
+
+        Parameters:
+        - iou_thresholds (np.ndarray): IoU thresholds.
+
+        Returns:
+        - np.ndarray: AP of shape (number of classes, number of thresholds).
+        """
+        true_positives = np.zeros((len(self.preds), len(iou_thresholds)), dtype=bool)
+        for j, threshold in enumerate(iou_thresholds):
+            matched, _ = match_pairs(self.pair_pred, self.pair_gt, self.pair_iou,
+                                     self.same_class & (self.pair_iou >= threshold))
+            true_positives[matched, j] = True
+
+        order = np.argsort(-self.scores, kind="stable")
+        true_positives, classes = true_positives[order], self.pred_classes[order]
+        recall_points = np.linspace(0, 1, 101)
+        ap = np.zeros((self.nb_classes, len(iou_thresholds)))
+        for class_id in range(self.nb_classes):
+            nb_gts = np.count_nonzero(self.gt_classes == class_id)
+            tp = true_positives[classes == class_id]
+            if not nb_gts or not len(tp):
+                continue
+            tp_cumsum = np.cumsum(tp, axis=0)
+            recall = tp_cumsum / nb_gts
+            precision = tp_cumsum / np.arange(1, len(tp) + 1)[:, None]
+            # Best precision at this recall or a higher one
+            precision = np.maximum.accumulate(precision[::-1], axis=0)[::-1]
+            for j in range(len(iou_thresholds)):
+                indices = np.searchsorted(recall[:, j], recall_points, side="left")
+                found = indices < len(recall)
+                ap[class_id, j] = np.where(found, precision[np.minimum(indices, len(recall) - 1), j], 0).mean()
+        return ap
+
+    def at_threshold(self, conf, iou):
+        """
+        Score the predictions above a confidence threshold, a prediction being
+        right when it overlaps a box of its class by at least `iou`.
+
+        Parameters:
+        - conf (float): Confidence threshold.
+        - iou (float): IoU threshold of the matches.
+
+        Returns:
+        - dict: Precision, recall, F1 and counts of each class, mean absolute
+          error of the per image counts, and confusion matrix (rows: predicted
+          class then background, columns: true class then background).
+        """
+        nb_classes = self.nb_classes
+        kept = self.scores >= conf
+        overlap = kept[self.pair_pred] & (self.pair_iou >= iou)
+
+        matched_preds, _ = match_pairs(self.pair_pred, self.pair_gt, self.pair_iou, overlap & self.same_class)
+        tp = np.bincount(self.pred_classes[matched_preds], minlength=nb_classes)
+        nb_preds = np.bincount(self.pred_classes[kept], minlength=nb_classes)
+        nb_gts = np.bincount(self.gt_classes, minlength=nb_classes)
+        precision = tp / np.maximum(nb_preds, 1)
+        recall = tp / np.maximum(nb_gts, 1)
+        f1 = 2 * precision * recall / np.maximum(precision + recall, 1e-9)
+
+        # Number of animals of each class in each image, predicted and true
+        nb_images = len(self.files)
+        pred_counts = np.bincount(self.pred_images[kept] * nb_classes + self.pred_classes[kept],
+                                  minlength=nb_images * nb_classes).reshape(nb_images, nb_classes)
+        gt_counts = np.bincount(self.gt_images * nb_classes + self.gt_classes,
+                                minlength=nb_images * nb_classes).reshape(nb_images, nb_classes)
+
+        # Confusion matrix, with the matches of any class
+        matched_preds, matched_gts = match_pairs(self.pair_pred, self.pair_gt, self.pair_iou, overlap)
+        confusion = np.zeros((nb_classes + 1, nb_classes + 1), dtype=np.int64)
+        np.add.at(confusion, (self.pred_classes[matched_preds], self.gt_classes[matched_gts]), 1)
+        unmatched_preds = kept.copy()
+        unmatched_preds[matched_preds] = False
+        confusion[:nb_classes, nb_classes] = np.bincount(self.pred_classes[unmatched_preds], minlength=nb_classes)
+        unmatched_gts = np.ones(len(self.gts), dtype=bool)
+        unmatched_gts[matched_gts] = False
+        confusion[nb_classes, :nb_classes] = np.bincount(self.gt_classes[unmatched_gts], minlength=nb_classes)
+
+        return {
+            "conf": float(conf),
+            "iou": float(iou),
+            "precision": precision.tolist(),
+            "recall": recall.tolist(),
+            "f1": f1.tolist(),
+            "predicted": nb_preds.tolist(),
+            "true": nb_gts.tolist(),
+            "count_mae": np.abs(pred_counts - gt_counts).mean(axis=0).tolist() if nb_images else [0.] * nb_classes,
+            "confusion": confusion.tolist(),
+        }
+
+    def sweep(self, confs, ious):
+        """
+        Score the predictions at every pair of thresholds.
+
+        Parameters:
+        - confs (list): Confidence thresholds.
+        - ious (list): IoU thresholds of the matches.
+
+        Returns:
+        - list: Results of `at_threshold`.
+        """
+        return [self.at_threshold(conf, iou) for iou in ious for conf in confs]
+
+
+def evaluate(config_path=CONFIG_TEST_PATH, split="val", weights_path=YOLO_WEIGHTS_PATH, confs=None, ious=(0.5,),
+             imgsz=640, batch=16, num_workers=8, device=DEVICE, cache_folder=EVAL_CACHE_FOLDER, refresh=False):
+    """
+    Evaluate weights on a split of a config: mAP, then a sweep of the
+    confidence and IoU thresholds.
+
+    Parameters:
+    - config_path (str): Path to the config file.
+    - split (str): Split of the config ('val' is the test set in config_test.yaml).
+    - weights_path (str): Path to the yolo(.pt) weight file.
+    - confs (list): Confidence thresholds of the sweep (default: 0.05 to 0.95).
+    - ious (list): IoU thresholds of the sweep.
+    - imgsz (int): Inference image size.
+    - batch (int): Number of images per forward pass.
+    - num_workers (int): Number of decoding threads.
+    - device (str): Device used for inference.
+    - cache_folder (str): Folder of the prediction cache (None to disable it).
+    - refresh (bool): Whether to run the model even if the predictions are cached.
+
+    Returns:
+    - dict: Report of the evaluation.
+    """
+    config = read_config(config_path)
+    names = config["names"]
+    names = [names[i] for i in sorted(names)] if isinstance(names, dict) else list(names)
+    confs = np.round(np.arange(0.05, 0.96, 0.05), 2) if confs is None else confs
+
+    image_paths = list_split_images(config[split])
+    predictions = load_predictions(weights_path, image_paths, imgsz, batch, num_workers, device, cache_folder,
+                                   refresh)
+    start = time.perf_counter()
+    evaluation = Evaluation(predictions, len(names))
+    ap = evaluation.average_precision()
+    sweep = evaluation.sweep(confs, ious)
+    elapsed = time.perf_counter() - start
+    return {
+        "meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "config": config_path, "split": split,
+                 "weights": weights_path, "images": len(evaluation.files), "boxes": len(evaluation.gts),
+                 "conf_floor": CONF_FLOOR, "nms_iou": NMS_IOU, "scoring_s": elapsed},
+        "names": names,
+        "mAP50": ap[:, 0].tolist(),
+        "mAP50-95": ap.mean(axis=1).tolist(),
+        "sweep": sweep,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate weights on a split: the predictions are computed once "
+                                                 "and cached, then scored at any confidence/IoU thresholds.")
+    parser.add_argument("--config", default=CONFIG_TEST_PATH)
+    parser.add_argument("--split", default="val", help="split of the config ('val' is test_data in config_test.yaml)")
+    parser.add_argument("--weights", default=YOLO_WEIGHTS_PATH)
+    parser.add_argument("--conf", nargs="+", type=float, help="confidence thresholds (default: 0.05 to 0.95)")
+    parser.add_argument("--iou", nargs="+", type=float, default=[0.5], help="IoU thresholds of the matches")
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--batch", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=8, help="decoding threads")
+    parser.add_argument("--device", default=DEVICE)
+    parser.add_argument("--no-cache", action="store_true", help="do not read nor write the prediction cache")
+    parser.add_argument("--refresh", action="store_true", help="run the model even if the predictions are cached")
+    parser.add_argument("--output", default="eval_report.json", help="where to write the JSON report")
+    args = parser.parse_args()
+
+    report = evaluate(args.config, args.split, args.weights, args.conf, args.iou, args.imgsz, args.batch,
+                      args.workers, args.device, None if args.no_cache else EVAL_CACHE_FOLDER, args.refresh)
+    names = report["names"]
+    print(f"{report['meta']['images']} images, {report['meta']['boxes']} boxes, "
+          f"scored in {report['meta']['scoring_s']:.2f} s")
+    for i, name in enumerate(names):
+        print(f"{name}: mAP50 {report['mAP50'][i]:.3f}, mAP50-95 {report['mAP50-95'][i]:.3f}")
+    print(f"{'conf':>5} {'iou':>5} " + " ".join(f"{name + ' P/R/F1/count MAE':>30}" for name in names))
+    for result in report["sweep"]:
+        print(f"{result['conf']:>5.2f} {result['iou']:>5.2f} " + " ".join(
+            f"{result['precision'][i]:>9.3f}{result['recall'][i]:>7.3f}{result['f1'][i]:>7.3f}"
+            f"{result['count_mae'][i]:>7.3f}" for i in range(len(names))))
+    best = max(report["sweep"], key=lambda result: np.mean(result["f1"]))
+    print(f"Best mean F1 {np.mean(best['f1']):.3f} at conf {best['conf']:.2f}, iou {best['iou']:.2f}")
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Report saved to {args.output}")
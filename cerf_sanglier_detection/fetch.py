@@ -0,0 +1,272 @@
+import contextvars
+import hashlib
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PIL import Image, ImageOps
+from cerf_sanglier_detection.metrics import record_stage
+
+# (connect, read) timeouts in seconds
+FETCH_TIMEOUT = (3.05, 10)
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+MAX_CONNECTIONS_PER_HOST = 4
+MAX_FETCH_WORKERS = 16
+CHUNK_SIZE = 64 * 1024
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+class FetchError(Exception):
+    """
+    Raised when an input image cannot be downloaded, read or decoded.
+    """
+
+    def __init__(self, source, reason):
+        self.source = source
+        self.reason = reason
+        super().__init__(f"Could not fetch image '{source}': {reason}")
+
+
+class PixelBudgetError(FetchError):
+    """
+    Raised when the images of a request decode to more pixels than its budget.
+    """
+
+
+class PixelBudget:
+    """
+    Number of pixels the images of a request may decode to, shared by the
+    threads fetching them. Each image takes its share before being decoded,
+    so an oversized image fails without allocating its pixels.
+    """
+
+    def __init__(self, max_pixels):
+        self.max_pixels = max_pixels
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def take(self, nb_pixels, source):
+        with self._lock:
+            if self.used + nb_pixels > self.max_pixels:
+                raise PixelBudgetError(source, f"the images of the request decode to more than {self.max_pixels} "
+                                               f"pixels")
+            self.used += nb_pixels
+
+
+def create_session(max_connections_per_host=MAX_CONNECTIONS_PER_HOST, max_hosts=MAX_FETCH_WORKERS, retries=0,
+                   backoff_factor=0.):
+    """
+    Create an HTTP session reusing its connections. Once a host has
+    `max_connections_per_host` connections in use, other requests to this host
+    wait for one to be released.
+
+    Parameters:
+    - max_connections_per_host (int): Size of the connection pool of each host.
+    - max_hosts (int): Number of hosts whose pool is kept (the least recently
+      used one is closed past this number).
+    - retries (int): Number of retries on connection errors and 429/5xx responses.
+    - backoff_factor (float): Backoff factor between retries (in seconds).
+
+    Returns:
+    - requests.Session: HTTP session.
+    """
+    retry = Retry(total=retries, backoff_factor=backoff_factor,
+                  status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=max_hosts, pool_maxsize=max_connections_per_host,
+                          max_retries=retry, pool_block=True)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """
+    Get the HTTP session shared by the process.
+
+    Returns:
+    - requests.Session: HTTP session.
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = create_session()
+    return _SESSION
+
+
+def is_url(source):
+    return isinstance(source, str) and source.lower().startswith(('http://', 'https://'))
+
+
+def content_hash(data):
+    """
+    Hash image content (encoded bytes or a decoded array).
+
+    Parameters:
+    - data (bytes or np.ndarray): Image content.
+
+    Returns:
+    - str: Hexadecimal digest.
+    """
+    if isinstance(data, np.ndarray):
+        data = np.ascontiguousarray(data).data
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def decode_chunks(chunks, source, max_bytes=MAX_IMAGE_BYTES, max_side=None, budget=None):
+    """
+    Read the bytes of an image (at most `max_bytes`), hashing them on the way,
+    then decode it. With `max_side`, JPEG images are decoded at a reduced
+    scale (1/2, 1/4 or 1/8, in the DCT domain) and the other images are
+    reduced once decoded, their long side staying at least `max_side`.
+
+    Parameters:
+    - chunks (iterable): Iterable of bytes.
+    - source (str): Url or path of the image (for error messages).
+    - max_bytes (int): Maximum size of the encoded image.
+    - max_side (int): Long side down to which the image may be reduced (None to keep its full resolution).
+    - budget (PixelBudget): Decoded pixels left to the request (None for no limit).
+
+    Returns:
+    - tuple: Tuple containing the BGR image (the channel order expected by the
+      YOLO model), the hash of the encoded bytes, the time spent decoding and
+      the (x, y) factors from the decoded image to the original one.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    parts = []
+    nb_bytes = 0
+    for chunk in chunks:
+        nb_bytes += len(chunk)
+        if nb_bytes > max_bytes:
+            raise FetchError(source, f"image is larger than {max_bytes} bytes")
+        hasher.update(chunk)
+        parts.append(chunk)
+
+    start = time.perf_counter()
+    try:
+        img = Image.open(BytesIO(b''.join(parts)))
+        width, height = img.size
+        if max_side and max(width, height) > max_side:
+            ratio = max_side / max(width, height)
+            # Only JPEG images have a draft mode, it picks the smallest scale keeping this size
+            img.draft('RGB', (math.ceil(width * ratio), math.ceil(height * ratio)))
+        if budget is not None:
+            budget.take(img.width * img.height, source)
+        # Size of the original image, once rotated by its EXIF orientation
+        if img.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+            width, height = height, width
+        img = ImageOps.exif_transpose(img)
+        factor = max(img.size) // max_side if max_side else 1
+        if factor >= 2:
+            img = img.reduce(factor)
+        img = img.convert('RGB')
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise FetchError(source, f"cannot decode image ({e})")
+
+    scale = (width / img.width, height / img.height)
+    img = np.ascontiguousarray(np.asarray(img)[..., ::-1])
+    return img, hasher.hexdigest(), time.perf_counter() - start, scale
+
+
+def fetch_image(source, session=None, timeout=FETCH_TIMEOUT, max_bytes=MAX_IMAGE_BYTES, max_side=None, budget=None):
+    """
+    Download (or read from disk) and decode one image.
+
+    Parameters:
+    - source (str or bytes): Url or local path of the image, or its encoded bytes (e.g. an upload).
+    - session (requests.Session): HTTP session, the shared one by default.
+    - timeout (tuple): (connect, read) timeouts in seconds.
+    - max_bytes (int): Maximum size of the encoded image.
+    - max_side (int): Long side down to which the image may be reduced (see `decode_chunks`).
+    - budget (PixelBudget): Decoded pixels left to the request (None for no limit).
+
+    Returns:
+    - tuple: Tuple containing the BGR image, the hash of its encoded bytes and
+      the (x, y) factors from the decoded image to the original one.
+    """
+    start = time.perf_counter()
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        # Already in memory, decoded without any copy to disk
+        if len(source) > max_bytes:
+            raise FetchError('uploaded image', f"image is larger than {max_bytes} bytes")
+        img, img_hash, decode_time, scale = decode_chunks([source], 'uploaded image', max_bytes, max_side,
+                                                          budget)
+    elif not is_url(source):
+        if not os.path.isfile(source):
+            raise FetchError(source, "no such file")
+        if os.path.getsize(source) > max_bytes:
+            raise FetchError(source, f"image is larger than {max_bytes} bytes")
+        with open(source, 'rb') as file:
+            img, img_hash, decode_time, scale = decode_chunks(iter(lambda: file.read(CHUNK_SIZE), b''), source,
+                                                              max_bytes, max_side, budget)
+    else:
+        session = session or get_session()
+        try:
+            with session.get(source, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+                content_length = response.headers.get('Content-Length')
+                if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+                    raise FetchError(source, f"image is larger than {max_bytes} bytes")
+                img, img_hash, decode_time, scale = decode_chunks(response.iter_content(CHUNK_SIZE), source,
+                                                                  max_bytes, max_side, budget)
+        except requests.exceptions.RequestException as e:
+            raise FetchError(source, e)
+
+    record_stage('decode', decode_time)
+    record_stage('download', time.perf_counter() - start - decode_time)
+    return img, img_hash, scale
+
+
+def fetch_images(sources, session=None, timeout=FETCH_TIMEOUT, max_bytes=MAX_IMAGE_BYTES,
+                 max_workers=MAX_FETCH_WORKERS, max_side=None, max_pixels=None):
+    """
+    Fetch images concurrently, yielding each one as soon as it is decoded (so
+    not in the order of `sources`). Sources which already are arrays are
+    yielded right away.
+
+    Parameters:
+    - sources (list): Urls, local paths, encoded bytes or BGR arrays.
+    - session (requests.Session): HTTP session, the shared one by default.
+    - timeout (tuple): (connect, read) timeouts in seconds.
+    - max_bytes (int): Maximum size of each encoded image.
+    - max_workers (int): Maximum number of images fetched at the same time.
+    - max_side (int): Long side down to which the images may be reduced (see `decode_chunks`).
+    - max_pixels (int): Maximum number of decoded pixels of all the images (None for no limit).
+
+    Yields:
+    - tuple: Tuple containing the index of the source, its BGR image, its
+      content hash and the (x, y) factors from the decoded image to the
+      original one.
+    """
+    to_fetch = []
+    for index, source in enumerate(sources):
+        if isinstance(source, np.ndarray):
+            yield index, source, content_hash(source), (1., 1.)
+        else:
+            to_fetch.append((index, source))
+    if not to_fetch:
+        return
+
+    session = session or get_session()
+    budget = PixelBudget(max_pixels) if max_pixels else None
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(to_fetch)))
+    try:
+        # Run in the caller's context so that the stage timings go to its request
+        futures = {
+            executor.submit(contextvars.copy_context().run, fetch_image, source, session, timeout, max_bytes,
+                            max_side, budget): index
+            for index, source in to_fetch
+        }
+        for future in as_completed(futures):
+            yield (futures[future], *future.result())
+    finally:
+        # Do not keep downloading if the caller stopped (e.g. on an error)
+        executor.shutdown(wait=False, cancel_futures=True)
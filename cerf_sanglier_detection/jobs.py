@@ -0,0 +1,202 @@
+import json
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_CHUNK_SIZE = 8
+
+
+class JobStore:
+    """
+    SQLite store of the batch jobs and of their results, one row per image so
+    that results can be read page by page while the job is still running.
+    """
+
+    def __init__(self, db_path):
+        """
+        Parameters:
+        - db_path (str): Path to the SQLite database (created if needed).
+        """
+        self.db_path = db_path
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id TEXT PRIMARY KEY, status TEXT, total INTEGER, done INTEGER, failed INTEGER, '
+                'params TEXT, error TEXT, created_at REAL, updated_at REAL)'
+            )
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'job_id TEXT, idx INTEGER, result TEXT, PRIMARY KEY (job_id, idx))'
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def create_job(self, total, params):
+        """
+        Create a queued job.
+
+        Parameters:
+        - total (int): Number of images of the job.
+        - params (dict): Parameters of the job (JSON serializable).
+
+        Returns:
+        - str: Id of the job.
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT INTO jobs VALUES (?, ?, ?, 0, 0, ?, NULL, ?, ?)',
+                (job_id, 'queued', total, json.dumps(params), now, now)
+            )
+        return job_id
+
+    def set_status(self, job_id, status, error=None):
+        with self._connect() as connection:
+            connection.execute('UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?',
+                               (status, error, time.time(), job_id))
+
+    def add_results(self, job_id, first_index, results):
+        """
+        Store the results of consecutive images of a job and update its progress.
+
+        Parameters:
+        - job_id (str): Id of the job.
+        - first_index (int): Index of the first image of `results` in the job.
+        - results (list): Detection results, or {'error': ...} for failed images.
+        """
+        nb_failed = sum('error' in result for result in results)
+        with self._connect() as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                [(job_id, first_index + i, json.dumps(result)) for i, result in enumerate(results)]
+            )
+            connection.execute(
+                'UPDATE jobs SET done = done + ?, failed = failed + ?, updated_at = ? WHERE id = ?',
+                (len(results), nb_failed, time.time(), job_id)
+            )
+
+    def get_job(self, job_id, offset=0, limit=50):
+        """
+        Get the progress of a job and a page of its results.
+
+        Parameters:
+        - job_id (str): Id of the job.
+        - offset (int): Index of the first result returned.
+        - limit (int): Maximum number of results returned.
+
+        Returns:
+        - dict or None: Job progress and results, None if the job does not exist.
+        """
+        with self._connect() as connection:
+            job = connection.execute(
+                'SELECT status, total, done, failed, error, created_at, updated_at FROM jobs WHERE id = ?',
+                (job_id,)
+            ).fetchone()
+            if job is None:
+                return None
+            rows = connection.execute(
+                'SELECT idx, result FROM results WHERE job_id = ? AND idx >= ? ORDER BY idx LIMIT ?',
+                (job_id, offset, limit)
+            ).fetchall()
+
+        status, total, done, failed, error, created_at, updated_at = job
+        results = [dict(json.loads(result), index=idx) for idx, result in rows]
+        next_offset = rows[-1][0] + 1 if rows and len(rows) == limit and rows[-1][0] + 1 < total else None
+        return {
+            'job_id': job_id,
+            'status': status,
+            'total': total,
+            'done': done,
+            'failed': failed,
+            'error': error,
+            'created_at': created_at,
+            'updated_at': updated_at,
+            'offset': offset,
+            'next_offset': next_offset,
+            'results': results,
+        }
+
+    def interrupt_unfinished(self):
+        """
+        Mark jobs left queued or running by a previous process as interrupted.
+        """
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = 'interrupted', updated_at = ? WHERE status IN ('queued', 'running')",
+                (time.time(),)
+            )
+
+
+class JobManager:
+    """
+    Run batch jobs in a background worker pool, storing their results in a
+    JobStore chunk by chunk.
+    """
+
+    def __init__(self, store, process_fn, max_workers=2, chunk_size=JOB_CHUNK_SIZE, interrupt_unfinished=True):
+        """
+        Parameters:
+        - store (JobStore): Store of the jobs and results.
+        - process_fn (callable): Called as `process_fn(inputs, **params)`, it must
+          return one detection result per input (e.g. `detect_animal`).
+        - max_workers (int): Number of jobs processed at the same time.
+        - chunk_size (int): Number of images processed (and stored) at once.
+        - interrupt_unfinished (bool): Whether to mark the unfinished jobs of a
+          previous process as interrupted. Workers of a multi-process server
+          share the store and must not (the server does it once at startup).
+        """
+        self.store = store
+        self.process_fn = process_fn
+        self.chunk_size = chunk_size
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job-worker')
+        if interrupt_unfinished:
+            self.store.interrupt_unfinished()
+
+    def submit(self, inputs, **params):
+        """
+        Queue a job.
+
+        Parameters:
+        - inputs (list): Inputs of the job (image urls).
+        - **params: Other arguments of `process_fn` (JSON serializable).
+
+        Returns:
+        - str: Id of the job.
+        """
+        job_id = self.store.create_job(len(inputs), params)
+        self._executor.submit(self._run, job_id, inputs, params)
+        return job_id
+
+    def _process_chunk(self, chunk, params):
+        try:
+            return self.process_fn(chunk, **params)
+        except Exception:
+            if len(chunk) == 1:
+                raise
+        # Retry image by image so that one bad input only fails itself
+        results = []
+        for source in chunk:
+            try:
+                results.extend(self.process_fn([source], **params))
+            except Exception as e:
+                results.append({'error': str(e)})
+        return results
+
+    def _run(self, job_id, inputs, params):
+        self.store.set_status(job_id, 'running')
+        try:
+            for start in range(0, len(inputs), self.chunk_size):
+                chunk = inputs[start:start + self.chunk_size]
+                try:
+                    results = self._process_chunk(chunk, params)
+                except Exception as e:
+                    results = [{'error': str(e)}]
+                self.store.add_results(job_id, start, results)
+        except Exception as e:
+            self.store.set_status(job_id, 'failed', error=str(e))
+            return
+        self.store.set_status(job_id, 'done')
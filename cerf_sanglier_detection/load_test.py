@@ -0,0 +1,155 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+from cerf_sanglier_detection.settings import PROJECT_ROOT
+
+DEFAULT_IMAGE = os.path.join(PROJECT_ROOT, "wild-boar.jpg")
+
+
+def wait_until_ready(url, timeout=300):
+    """
+    Wait for a server to answer on /healthz.
+
+    Parameters:
+    - url (str): Base url of the server.
+    - timeout (float): Maximum time to wait, in seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"{url}/healthz", timeout=2).ok:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(1)
+    raise TimeoutError(f"{url} is not ready after {timeout} s")
+
+
+def run_load(url, image_bytes, concurrency, duration, response_format="boxes"):
+    """
+    Send images to /predict from `concurrency` clients for `duration` seconds,
+    each client sending its next request as soon as it gets a response.
+
+    Parameters:
+    - url (str): Base url of the server.
+    - image_bytes (bytes): JPEG image sent as the raw body of the requests.
+    - concurrency (int): Number of concurrent clients.
+    - duration (float): Duration of the load, in seconds.
+    - response_format (str): Format asked to the server.
+
+    Returns:
+    - dict: Throughput, latency percentiles (ms) of the successful requests and count of each status code.
+    """
+    deadline = time.monotonic() + duration
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def client():
+        session = requests.Session()
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                status = session.post(f"{url}/predict?format={response_format}", data=image_bytes,
+                                      headers={"Content-Type": "image/jpeg"}, timeout=60).status_code
+            except requests.exceptions.RequestException:
+                status = "connection_error"
+            latency = time.perf_counter() - start
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == 200:
+                    latencies.append(latency)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(client)
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies or [np.nan]) * 1000
+    return {
+        "concurrency": concurrency,
+        "requests_per_s": statuses.get(200, 0) / elapsed,
+        "rejected_share": statuses.get(503, 0) / max(sum(statuses.values()), 1),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "statuses": {str(status): count for status, count in statuses.items()},
+    }
+
+
+def start_server(nb_workers, port, extra_env=None):
+    """
+    Start gunicorn with the serving configuration of gunicorn.conf.py.
+
+    Parameters:
+    - nb_workers (int): Number of worker processes.
+    - port (int): Port of the server.
+    - extra_env (dict): Other environment variables of the server.
+
+    Returns:
+    - subprocess.Popen: Server process.
+    """
+    env = dict(os.environ, WEB_CONCURRENCY=str(nb_workers), BIND=f"127.0.0.1:{port}", **(extra_env or {}))
+    return subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"], env=env,
+                            cwd=PROJECT_ROOT)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test POST /predict, optionally for several numbers of workers.")
+    parser.add_argument("--url", default="http://127.0.0.1:5000", help="server to test (ignored with --workers)")
+    parser.add_argument("--workers", nargs="+", type=int,
+                        help="start gunicorn with each number of workers in turn and test it")
+    parser.add_argument("--port", type=int, default=5055, help="port of the servers started with --workers")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16])
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load per concurrency level")
+    parser.add_argument("--overload", action="store_true",
+                        help="with --workers, also test twice as many clients as the servers have threads, which "
+                             "must get 503 errors instead of waiting")
+    parser.add_argument("--threads", type=int, default=8, help="WORKER_THREADS of the servers started with --workers")
+    parser.add_argument("--image", default=DEFAULT_IMAGE)
+    parser.add_argument("--format", default="boxes")
+    parser.add_argument("--output", default="load_test.json", help="where to write the JSON report")
+    args = parser.parse_args()
+
+    with open(args.image, "rb") as file:
+        image_bytes = file.read()
+
+    results = []
+    for nb_workers in args.workers or [None]:
+        server = None
+        url = args.url
+        if nb_workers is not None:
+            # The same image is sent again and again, the result cache would answer it
+            server = start_server(nb_workers, args.port, {"RESULT_CACHE_SIZE": "0",
+                                                          "WORKER_THREADS": str(args.threads)})
+            url = f"http://127.0.0.1:{args.port}"
+        concurrencies = list(args.concurrency)
+        if args.overload and nb_workers is not None:
+            concurrencies.append(2 * nb_workers * args.threads)
+        try:
+            wait_until_ready(url)
+            for concurrency in concurrencies:
+                result = dict(run_load(url, image_bytes, concurrency, args.duration, args.format), workers=nb_workers)
+                print(result)
+                results.append(result)
+            if args.overload and nb_workers is not None and not results[-1]["statuses"].get("503"):
+                print(f"WARNING: no request was rejected with {concurrencies[-1]} clients, admission control is "
+                      f"not working")
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    report = {"meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "cpu_count": os.cpu_count(),
+                       "image": args.image, "duration_s": args.duration}, "results": results}
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Report saved to {args.output}")
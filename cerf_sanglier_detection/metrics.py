@@ -0,0 +1,197 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.)
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+# Metrics rendered by /metrics, in creation order
+_METRICS = []
+# Time spent in each stage by the current request (None outside of a request)
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+_timings_lock = threading.Lock()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+class Counter:
+    """
+    Prometheus counter, with optional labels.
+    """
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._lock = threading.Lock()
+        _METRICS.append(self)
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in self._values.items():
+                lines.append(f'{self.name}{_format_labels(labels)} {value}')
+        return lines
+
+
+class Histogram:
+    """
+    Prometheus histogram, with optional labels.
+    """
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        # labels -> [count of each bucket, sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+        _METRICS.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self.buckets), 0., 0]
+            bucket_counts, _, _ = values = self._values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    bucket_counts[i] += 1
+            values[1] += value
+            values[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, (bucket_counts, total, count) in self._values.items():
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    bucket_labels = _format_labels(labels + (('le', bound),))
+                    lines.append(f'{self.name}_bucket{bucket_labels} {bucket_count}')
+                lines.append(f'{self.name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {count}')
+                lines.append(f'{self.name}_sum{_format_labels(labels)} {total}')
+                lines.append(f'{self.name}_count{_format_labels(labels)} {count}')
+        return lines
+
+
+REQUESTS = Counter('animal_detection_requests_total', 'HTTP requests by endpoint, method and status code.')
+REQUEST_SECONDS = Histogram('animal_detection_request_seconds', 'HTTP request duration by endpoint.')
+ERRORS = Counter('animal_detection_errors_total', 'HTTP errors by status code and error name.')
+IMAGES_PER_REQUEST = Histogram('animal_detection_images_per_request', 'Number of images per request.',
+                               buckets=COUNT_BUCKETS)
+STAGE_SECONDS = Histogram('animal_detection_stage_seconds',
+                          'Time spent in each stage of the detection (download, decode, preprocess, '
+                          'inference, postprocess, annotate, encode, serialize).')
+
+
+def start_request_timings():
+    """
+    Start recording the stage timings of the current request.
+
+    Returns:
+    - contextvars.Token: Token to give to `stop_request_timings`.
+    """
+    return _request_timings.set({})
+
+
+def stop_request_timings(token):
+    """
+    Stop recording the stage timings of the current request.
+
+    Parameters:
+    - token (contextvars.Token): Token returned by `start_request_timings`.
+
+    Returns:
+    - dict: Total time (in seconds) spent in each stage by the request.
+    """
+    timings = _request_timings.get()
+    _request_timings.reset(token)
+    return timings or {}
+
+
+def record_stage(stage, seconds):
+    """
+    Record the time spent in a stage, in the stage histogram and in the timings
+    of the current request if any.
+
+    Parameters:
+    - stage (str): Name of the stage.
+    - seconds (float): Time spent in the stage.
+    """
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        with _timings_lock:
+            timings[stage] = timings.get(stage, 0.) + seconds
+
+
+@contextmanager
+def timed(stage):
+    """
+    Time the block of a stage (see `record_stage`).
+
+    Parameters:
+    - stage (str): Name of the stage.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def server_timing_header(timings):
+    """
+    Build a Server-Timing header value from stage timings.
+
+    Parameters:
+    - timings (dict): Time (in seconds) spent in each stage.
+
+    Returns:
+    - str: Header value, durations being in ms.
+    """
+    return ', '.join(f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in timings.items())
+
+
+def render_gauges(prefix, values):
+    """
+    Render a dictionary of numbers as Prometheus gauges.
+
+    Parameters:
+    - prefix (str): Prefix of the gauge names.
+    - values (dict): Dictionary mapping a name to its value.
+
+    Returns:
+    - list: Lines of the Prometheus text format.
+    """
+    lines = []
+    for name, value in values.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.extend([f'# TYPE {prefix}_{name} gauge', f'{prefix}_{name} {value}'])
+    return lines
+
+
+def render_metrics(extra_lines=()):
+    """
+    Render every metric in the Prometheus text format.
+
+    Parameters:
+    - extra_lines (iterable): Other lines to append (e.g. from `render_gauges`).
+
+    Returns:
+    - str: Body of the /metrics endpoint.
+    """
+    lines = []
+    for metric in _METRICS:
+        lines.extend(metric.render())
+    lines.extend(extra_lines)
+    return '\n'.join(lines) + '\n'
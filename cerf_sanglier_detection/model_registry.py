@@ -0,0 +1,89 @@
+import os
+import threading
+import numpy as np
+
+# Models already loaded by this process, keyed by (weights path, device)
+_MODELS = {}
+# One lock per model: an ultralytics predictor keeps per-call state, so a
+# model can be shared across threads but must not run two predictions at once
+_MODEL_LOCKS = {}
+_REGISTRY_LOCK = threading.Lock()
+
+WARMUP_IMG_SIZE = 640
+
+
+def _model_key(weights_path, device):
+    return os.path.abspath(weights_path), str(device)
+
+
+def warmup_model(model, device='cpu', img_size=WARMUP_IMG_SIZE):
+    """
+    Run a dummy forward pass so that the first real request does not pay for
+    the predictor setup.
+
+    Parameters:
+    - model (YOLO): Loaded YOLO model.
+    - device (str): Device used for inference.
+    - img_size (int): Side of the dummy square image.
+    """
+    dummy_img = np.zeros((img_size, img_size, 3), dtype=np.uint8)
+    model.predict(source=dummy_img, save=False, device=device, verbose=False)
+
+
+def get_model(weights_path, device='cpu', warmup=True):
+    """
+    Get the YOLO model for the given weights and device, loading it only the
+    first time it is requested by the process.
+
+    Parameters:
+    - weights_path (str): Path to the yolo(.pt) weight file, or to weights
+      exported for another backend (see `backends`).
+    - device (str): Device used for inference.
+    - warmup (bool): Whether to run a dummy forward pass after loading.
+
+    Returns:
+    - YOLO: Loaded YOLO model.
+    """
+    key = _model_key(weights_path, device)
+    model = _MODELS.get(key)
+    if model is not None:
+        return model
+
+    with _REGISTRY_LOCK:
+        # Another thread may have loaded it while we were waiting
+        if key not in _MODELS:
+            # Imported on first use: ultralytics (and torch) take seconds to import
+            from ultralytics import YOLO
+            model = YOLO(weights_path, task='detect')
+            if warmup:
+                warmup_model(model, device)
+            _MODEL_LOCKS[key] = threading.Lock()
+            _MODELS[key] = model
+    return _MODELS[key]
+
+
+def predict(weights_path, source, device='cpu', **kwargs):
+    """
+    Run inference with the shared model of the given weights and device.
+
+    Parameters:
+    - weights_path (str): Path to the yolo(.pt) weight file.
+    - source: Anything accepted by `YOLO.predict` (url, path, array or list).
+    - device (str): Device used for inference.
+    - **kwargs: Other arguments passed to `YOLO.predict`.
+
+    Returns:
+    - list: List of ultralytics Results.
+    """
+    model = get_model(weights_path, device)
+    with _MODEL_LOCKS[_model_key(weights_path, device)]:
+        return model.predict(source=source, save=False, device=device, **kwargs)
+
+
+def clear_models():
+    """
+    Drop every loaded model (mostly useful to release memory in scripts).
+    """
+    with _REGISTRY_LOCK:
+        _MODELS.clear()
+        _MODEL_LOCKS.clear()
@@ -1,51 +1,233 @@
-from PIL import Image
-import numpy as np
+from PIL import Image, ImageDraw, ImageOps
+import argparse
+import hashlib
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataset_catalog import update_catalog, query_images, default_catalog_path
+from settings import DATA_FOLDER, IMG_FOLDER
 
-def create_image_mosaic(input_folder, output_path, label, mosaic_size=(800, 800), max_img = 10, rows=2, columns=5):
-    # Get a list of image files in the input folder
-    image_files = [f for f in os.listdir(input_folder) if (f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif'))) and (f.split('_')[0]==label)]
-    image_files = image_files[:max_img]
+# Colors of the label boxes, by class id
+BOX_COLORS = [(255, 64, 64), (64, 160, 255), (64, 255, 64), (255, 200, 0)]
+BACKGROUND = (32, 32, 32)
+
+
+def default_thumbnail_folder(input_folder):
+    """
+    Get the default thumbnail cache folder of an images folder (next to it, in the data folder).
+
+    Parameters:
+    - input_folder (str): Path to the folder containing images.
+
+    Returns:
+    - str: Path to the thumbnail cache folder.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(input_folder)), 'thumbnails')
+
+
+def thumbnail_path(image_path, tile_size, cache_dir):
+    # An edited image gets a new thumbnail, its size and modification time being in the key
+    stat = os.stat(image_path)
+    key = f'{os.path.abspath(image_path)}|{stat.st_size}|{stat.st_mtime_ns}|{tile_size[0]}x{tile_size[1]}'
+    return os.path.join(cache_dir, hashlib.blake2b(key.encode(), digest_size=16).hexdigest() + '.jpg')
+
+
+def load_thumbnail(image_path, tile_size, cache_dir=None):
+    """
+    Load an image reduced to fit in a tile, keeping its aspect ratio. JPEG images
+    are decoded at a reduced scale (draft mode), and the thumbnails are cached
+    on disk when a cache folder is given.
+
+    Parameters:
+    - image_path (str): Path to the image.
+    - tile_size (tuple): (width, height) of the tile.
+    - cache_dir (str): Path to the thumbnail cache folder.
+
+    Returns:
+    - PIL.Image.Image: RGB thumbnail.
+    """
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = thumbnail_path(image_path, tile_size, cache_dir)
+        if os.path.isfile(cache_path):
+            with Image.open(cache_path) as thumbnail:
+                return thumbnail.convert('RGB')
+
+    with Image.open(image_path) as img:
+        # Let the JPEG decoder scale down by 1/2, 1/4 or 1/8 while decoding
+        img.draft('RGB', tile_size)
+        img = ImageOps.exif_transpose(img).convert('RGB')
+    img.thumbnail(tile_size, Image.BILINEAR)
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        img.save(tmp_path, 'JPEG', quality=85)
+        os.replace(tmp_path, cache_path)
+    return img
+
+
+def read_label_boxes(label_path):
+    """
+    Read the boxes of a YOLO label file.
+
+    Parameters:
+    - label_path (str): Path to the label file.
+
+    Returns:
+    - list: List of (class_id, x_center, y_center, width, height) tuples, coordinates being normalized.
+    """
+    boxes = []
+    if label_path is None or not os.path.isfile(label_path):
+        return boxes
+    with open(label_path, 'r') as file:
+        for line in file:
+            values = line.split()
+            if len(values) >= 5:
+                boxes.append((int(values[0]), *map(float, values[1:5])))
+    return boxes
+
+
+def draw_boxes(img, boxes):
+    """
+    Draw YOLO label boxes on an image, in place.
+
+    Parameters:
+    - img (PIL.Image.Image): Image.
+    - boxes (list): Boxes returned by `read_label_boxes`.
+    """
+    draw = ImageDraw.Draw(img)
+    width, height = img.size
+    for class_id, x, y, w, h in boxes:
+        color = BOX_COLORS[class_id % len(BOX_COLORS)]
+        draw.rectangle([(x - w / 2) * width, (y - h / 2) * height, (x + w / 2) * width, (y + h / 2) * height],
+                       outline=color, width=2)
+
+
+def make_tile(image_path, tile_size, cache_dir=None, label_path=None):
+    """
+    Make the tile of an image: its thumbnail, with its label boxes if a label file is given.
+
+    Returns:
+    - tuple: (thumbnail, error message), one of them being None.
+    """
+    try:
+        img = load_thumbnail(image_path, tile_size, cache_dir)
+        if label_path is not None:
+            draw_boxes(img, read_label_boxes(label_path))
+        return img, None
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+
+
+def render_sheets(image_paths, output_pattern, columns=10, rows=10, tile_size=(160, 160), labels_folder=None,
+                  cache_dir=None, num_workers=8, captions=True):
+    """
+    Render contact sheets of images, as many pages as needed. The tiles are
+    decoded by a pool of workers; the images that cannot be read are reported
+    instead of being dropped silently.
+
+    Parameters:
+    - image_paths (list): Paths to the images.
+    - output_pattern (str): Path of the sheets, formatted with the page number (e.g. 'sheet_{page:03d}.jpg').
+    - columns (int): Number of tiles per row.
+    - rows (int): Number of rows per sheet.
+    - tile_size (tuple): (width, height) of a tile.
+    - labels_folder (str): Path to the YOLO labels, to draw their boxes (None to draw none).
+    - cache_dir (str): Path to the thumbnail cache folder (None to disable the cache).
+    - num_workers (int): Number of images decoded at the same time.
+    - captions (bool): Whether to write the image names under the tiles.
+
+    Returns:
+    - tuple: (paths of the sheets, list of (image path, error message) for the images that failed).
+    """
+    per_page = columns * rows
+    caption_height = 12 if captions else 0
+    cell_width, cell_height = tile_size[0], tile_size[1] + caption_height
+
+    def label_of(image_path):
+        if labels_folder is None:
+            return None
+        return os.path.join(labels_folder, os.path.splitext(os.path.basename(image_path))[0] + '.txt')
+
+    sheet_paths = []
+    failures = []
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for page, start in enumerate(range(0, len(image_paths), per_page)):
+            page_paths = image_paths[start:start + per_page]
+            nb_rows = (len(page_paths) + columns - 1) // columns
+            sheet = Image.new('RGB', (columns * cell_width, nb_rows * cell_height), BACKGROUND)
+            draw = ImageDraw.Draw(sheet)
+
+            tiles = executor.map(lambda path: make_tile(path, tile_size, cache_dir, label_of(path)), page_paths)
+            for i, (image_path, (tile, error)) in enumerate(zip(page_paths, tiles)):
+                left, top = (i % columns) * cell_width, (i // columns) * cell_height
+                if tile is None:
+                    failures.append((image_path, error))
+                    print(f"Error reading {image_path}: {error}")
+                    draw.line([left, top, left + tile_size[0], top + tile_size[1]], fill=(255, 0, 0), width=2)
+                else:
+                    # Center the thumbnail in its tile
+                    sheet.paste(tile, (left + (tile_size[0] - tile.width) // 2, top + (tile_size[1] - tile.height) // 2))
+                if captions:
+                    draw.text((left + 2, top + tile_size[1]), os.path.basename(image_path)[:cell_width // 6],
+                              fill=(220, 220, 220))
+
+            sheet_path = output_pattern.format(page=page)
+            os.makedirs(os.path.dirname(os.path.abspath(sheet_path)), exist_ok=True)
+            sheet.save(sheet_path, quality=90)
+            sheet_paths.append(sheet_path)
+
+    print(f"{len(sheet_paths)} sheets of {len(image_paths)} images saved ({len(failures)} failed)")
+    return sheet_paths, failures
+
+
+def create_image_mosaic(input_folder, output_path, label, mosaic_size=(800, 800), max_img = 10, rows=2, columns=5,
+                        draw_labels=False, num_workers=8):
+    # Get a list of image files of this label from the dataset catalog
+    catalog_path = default_catalog_path(input_folder)
+    update_catalog(input_folder, db_path=catalog_path, with_hash=False)
+    image_files = query_images(catalog_path, class_name=label)[:max_img]
 
     if not image_files:
         print("No image files found in the input folder.")
         return
 
     # Calculate the size of each tile in the mosaic
-    tile_width = mosaic_size[0] // columns
-    tile_height = mosaic_size[1] // rows
-
-    # Create an empty mosaic image
-    mosaic = Image.new('RGB', mosaic_size)  
-
-    # Iterate through the images and paste them onto the mosaic
-    for i, image_file in enumerate(image_files):
-        row = i // columns
-        col = i % columns
-        image_path = os.path.join(input_folder, image_file)
-        try :
-            img = Image.open(image_path)
-            img = img.resize((tile_width, tile_height), Image.LANCZOS)
-            mosaic.paste(img, (col * tile_width, row * tile_height))
-        except :
-            pass
-
-    # Save the resulting mosaic image
-    mosaic.save(output_path)
+    tile_size = (mosaic_size[0] // columns, mosaic_size[1] // rows)
+    labels_folder = os.path.join(os.path.dirname(os.path.abspath(input_folder)), 'labels') if draw_labels else None
+
+    # A single page of the contact sheet, its output path having no page placeholder
+    image_paths = [os.path.join(input_folder, image_file) for image_file in image_files[:rows * columns]]
+    render_sheets(image_paths, output_path.replace('{', '{{').replace('}', '}}'), columns, rows, tile_size,
+                  labels_folder, default_thumbnail_folder(input_folder), num_workers, captions=False)
     print(f"Mosaic created and saved to {output_path}")
 
 if __name__ == "__main__":
-    
-    HOME = os.getcwd()
-    IMG_FOLDER = os.path.join(HOME, "data", "images")
-    
-
-    # Specify the output path for the mosaic image
-    output_path = "deer_mosaic.jpg"
-    create_image_mosaic(IMG_FOLDER, output_path, label = 'deer')
-    
-    output_path = "boar_mosaic.jpg"
-    create_image_mosaic(IMG_FOLDER, output_path, label = 'boar')
-
+    parser = argparse.ArgumentParser(description="Render mosaics or paginated contact sheets of the dataset.")
+    parser.add_argument("--label", nargs="+", default=["deer", "boar"], help="classes to render")
+    parser.add_argument("--sheets", action="store_true",
+                        help="render every image of the classes as paginated contact sheets")
+    parser.add_argument("--columns", type=int, default=10)
+    parser.add_argument("--rows", type=int, default=10)
+    parser.add_argument("--tile-size", type=int, default=160)
+    parser.add_argument("--boxes", action="store_true", help="draw the YOLO label boxes")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--output", default="sheets", help="folder of the contact sheets")
+    args = parser.parse_args()
 
+    for label in args.label:
+        if not args.sheets:
+            # Specify the output path for the mosaic image
+            output_path = f"{label}_mosaic.jpg"
+            create_image_mosaic(IMG_FOLDER, output_path, label=label, draw_labels=args.boxes,
+                                num_workers=args.workers)
+            continue
 
+        catalog_path = default_catalog_path(IMG_FOLDER)
+        update_catalog(IMG_FOLDER, db_path=catalog_path, with_hash=False)
+        image_paths = [os.path.join(IMG_FOLDER, name) for name in query_images(catalog_path, class_name=label)]
+        labels_folder = os.path.join(DATA_FOLDER, "labels") if args.boxes else None
+        render_sheets(image_paths, os.path.join(args.output, label + "_{page:03d}.jpg"), args.columns, args.rows,
+                      (args.tile_size, args.tile_size), labels_folder, default_thumbnail_folder(IMG_FOLDER),
+                      args.workers)
@@ -0,0 +1,46 @@
+import numpy as np
+
+# BGR colors of the boxes, by class id
+BOX_COLORS = [(56, 56, 255), (255, 157, 151), (31, 112, 255), (29, 178, 255), (49, 210, 207), (10, 249, 72)]
+TEXT_COLOR = (255, 255, 255)
+
+
+def draw_detections(img, boxes, names=None):
+    """
+    Draw detection boxes and their labels on an image, in place (a lighter
+    replacement of ultralytics' `Results.plot`, which copies the image and
+    goes through PIL for the labels).
+
+    Parameters:
+    - img (np.ndarray): BGR image, modified in place (pass a copy to keep the original).
+    - boxes (np.ndarray): Boxes (x1, y1, x2, y2, score, class_id) of shape (n, 6).
+    - names (dict): Dictionary mapping a class id to its name.
+
+    Returns:
+    - np.ndarray: The image, with the boxes drawn.
+    """
+    import cv2
+
+    if not len(boxes):
+        return img
+    names = names or {}
+    line_width = max(round(sum(img.shape[:2]) / 2 * 0.003), 2)
+    font_scale = line_width / 3
+    font_thickness = max(line_width - 1, 1)
+
+    corners = np.rint(boxes[:, :4]).astype(int)
+    class_ids = boxes[:, 5].astype(int)
+    for (x1, y1, x2, y2), score, class_id in zip(corners.tolist(), boxes[:, 4].tolist(), class_ids.tolist()):
+        color = BOX_COLORS[class_id % len(BOX_COLORS)]
+        cv2.rectangle(img, (x1, y1), (x2, y2), color, line_width, cv2.LINE_AA)
+
+        label = f'{names.get(class_id, class_id)} {score:.2f}'
+        (text_width, text_height), _ = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, font_scale, font_thickness)
+        # Label above the box, or inside it when the box touches the top of the image
+        outside = y1 - text_height - 3 >= 0
+        y_text = y1 - 2 if outside else y1 + text_height + 2
+        cv2.rectangle(img, (x1, y1), (x1 + text_width, y1 - text_height - 3 if outside else y1 + text_height + 3),
+                      color, -1, cv2.LINE_AA)
+        cv2.putText(img, label, (x1, y_text), cv2.FONT_HERSHEY_SIMPLEX, font_scale, TEXT_COLOR, font_thickness,
+                    cv2.LINE_AA)
+    return img
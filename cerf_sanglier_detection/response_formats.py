@@ -0,0 +1,148 @@
+import base64
+import json
+import uuid
+import numpy as np
+
+# Formats a client can ask for on /predict
+# - boxes: detections only, no image at all (default)
+# - jpeg / png: images encoded and sent as base64 strings
+# - msgpack / multipart: images sent as raw uint8 buffers with shape and dtype
+# - list: images as nested lists of ints (legacy output, very slow)
+RESPONSE_FORMATS = ('boxes', 'jpeg', 'png', 'msgpack', 'multipart', 'list')
+DEFAULT_RESPONSE_FORMAT = 'boxes'
+
+# How images are stored inside each detection result for a response format
+IMAGE_FORMATS = {
+    'boxes': None,
+    'jpeg': 'jpeg',
+    'png': 'png',
+    'msgpack': 'raw',
+    'multipart': 'raw',
+    'list': 'list',
+}
+
+JPEG_QUALITY = 90
+
+
+def image_format_of(response_format):
+    """
+    Get the image encoding used by a response format.
+
+    Parameters:
+    - response_format (str): One of RESPONSE_FORMATS.
+
+    Returns:
+    - str or None: 'jpeg', 'png', 'raw', 'list' or None when no image is sent.
+    """
+    return IMAGE_FORMATS[response_format]
+
+
+def encode_image(img, image_format):
+    """
+    Encode a BGR uint8 image for a detection result.
+
+    Parameters:
+    - img (np.ndarray): BGR image of shape (height, width, 3).
+    - image_format (str): 'jpeg', 'png', 'raw' or 'list'.
+
+    Returns:
+    - str, dict or list: base64 string for jpeg/png, dict with the raw buffer,
+      its shape and dtype for raw, nested lists for list.
+    """
+    if image_format == 'list':
+        return img.tolist()
+
+    if image_format == 'raw':
+        img = np.ascontiguousarray(img)
+        return {'data': img.tobytes(), 'shape': list(img.shape), 'dtype': str(img.dtype)}
+
+    # OpenCV is only imported by the formats using it
+    import cv2
+    if image_format == 'jpeg':
+        ok, buffer = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    elif image_format == 'png':
+        ok, buffer = cv2.imencode('.png', img)
+    else:
+        raise ValueError(f"Unknown image format '{image_format}'")
+
+    if not ok:
+        raise ValueError(f"Could not encode image as {image_format}")
+    return base64.b64encode(buffer).decode('ascii')
+
+
+def decode_image(value):
+    """
+    Decode an image of a detection result back to a BGR numpy array, whatever
+    format it was sent with.
+
+    Parameters:
+    - value (str, dict or list): Encoded image.
+
+    Returns:
+    - np.ndarray: BGR image.
+    """
+    if isinstance(value, str):
+        import cv2
+        buffer = np.frombuffer(base64.b64decode(value), dtype=np.uint8)
+        return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    if isinstance(value, dict):
+        return np.frombuffer(value['data'], dtype=value['dtype']).reshape(value['shape'])
+    return np.array(value).astype(np.uint8)
+
+
+def to_msgpack(detection_results):
+    """
+    Serialize detection results (with raw images) to a msgpack body.
+
+    Parameters:
+    - detection_results (list): List of dictionaries containing detection results.
+
+    Returns:
+    - bytes: msgpack body.
+    """
+    # msgpack is only needed by clients asking for this format
+    import msgpack
+
+    return msgpack.packb(detection_results, use_bin_type=True)
+
+
+def to_multipart(detection_results):
+    """
+    Serialize detection results (with raw images) to a multipart/mixed body.
+    The first part is the JSON results where each raw image is replaced by
+    {'part': index, 'shape': ..., 'dtype': ...}, and the following parts are
+    the raw image buffers, in the order given by 'part'.
+
+    Parameters:
+    - detection_results (list): List of dictionaries containing detection results.
+
+    Returns:
+    - tuple: Tuple containing the body (bytes) and its content type (str).
+    """
+    boundary = uuid.uuid4().hex
+    buffers = []
+    results = []
+    for detection_result in detection_results:
+        result = {}
+        for key, value in detection_result.items():
+            if isinstance(value, dict) and 'data' in value:
+                result[key] = {'part': len(buffers) + 1, 'shape': value['shape'], 'dtype': value['dtype']}
+                buffers.append(value)
+            else:
+                result[key] = value
+        results.append(result)
+
+    chunks = [
+        f'--{boundary}\r\nContent-Type: application/json\r\n\r\n'.encode(),
+        json.dumps(results).encode(),
+        b'\r\n',
+    ]
+    for i, buffer in enumerate(buffers, start=1):
+        headers = (f'--{boundary}\r\nContent-Type: application/octet-stream\r\n'
+                   f'Content-ID: {i}\r\n'
+                   f'X-Shape: {",".join(map(str, buffer["shape"]))}\r\n'
+                   f'X-Dtype: {buffer["dtype"]}\r\n\r\n')
+        chunks.extend([headers.encode(), buffer['data'], b'\r\n'])
+    chunks.append(f'--{boundary}--\r\n'.encode())
+
+    return b''.join(chunks), f'multipart/mixed; boundary={boundary}'
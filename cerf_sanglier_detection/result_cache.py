@@ -0,0 +1,220 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+
+@lru_cache(maxsize=16)
+def _file_hash(paths, mtimes):
+    hasher = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def weights_hash(weights_path):
+    """
+    Hash a weights file (or every file of an exported weights folder), the hash
+    is only computed again when a file changes.
+
+    Parameters:
+    - weights_path (str): Path to the yolo(.pt) weight file or folder.
+
+    Returns:
+    - str: Hexadecimal digest.
+    """
+    if os.path.isdir(weights_path):
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(weights_path) for name in names)
+    else:
+        paths = [os.path.abspath(weights_path)]
+    return _file_hash(tuple(paths), tuple(os.stat(path).st_mtime_ns for path in paths))
+
+
+class ResultCache:
+    """
+    LRU cache of detection results (boxes and counts by class), keyed by image
+    content, weights and confidence threshold, with an optional on-disk layer
+    shared by every process using the same `cache_dir`.
+    """
+
+    def __init__(self, max_entries=1024, ttl=None, cache_dir=None, max_disk_entries=100000):
+        """
+        Parameters:
+        - max_entries (int): Maximum number of results kept in memory.
+        - ttl (float): Time to live of a result in seconds (None: never expires).
+        - cache_dir (str): Folder of the on-disk cache (None: memory only).
+        - max_disk_entries (int): Maximum number of results kept on disk.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self.max_disk_entries = max_disk_entries
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._nb_disk_entries = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._nb_disk_entries = sum(name.endswith('.json') for name in os.listdir(cache_dir))
+
+    @staticmethod
+    def make_key(image_hash, weights_hash, confidence, variant=None):
+        """
+        Build the key of a result.
+
+        Parameters:
+        - image_hash (str): Hash of the image content.
+        - weights_hash (str): Hash of the weights file.
+        - confidence (float): Confidence threshold for detections.
+        - variant (str): Other settings changing the result (e.g. tiling), if any.
+
+        Returns:
+        - str: Cache key.
+        """
+        key = f'{weights_hash}-{image_hash}-{float(confidence)}'
+        return key if variant is None else f'{key}-{variant}'
+
+    def _expired(self, stored_at):
+        return self.ttl is not None and time.time() - stored_at > self.ttl
+
+    def get(self, key):
+        """
+        Get a result from the cache.
+
+        Parameters:
+        - key (str): Cache key.
+
+        Returns:
+        - dict or None: Cached result, None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, value = entry
+                if not self._expired(stored_at):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+                self.evictions += 1
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._store(key, entry)
+            return entry[1]
+
+    def set(self, key, value):
+        """
+        Store a result in the cache.
+
+        Parameters:
+        - key (str): Cache key.
+        - value (dict): JSON serializable result.
+        """
+        entry = (time.time(), value)
+        with self._lock:
+            self._store(key, entry)
+        self._write_disk(key, entry)
+
+    def stats(self):
+        """
+        Get the cache counters.
+
+        Returns:
+        - dict: Hits, misses, hit rate, evictions and number of entries.
+        """
+        with self._lock:
+            nb_lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / nb_lookups if nb_lookups else 0.,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'disk_entries': self._nb_disk_entries,
+            }
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.json')
+
+    def _read_disk(self, key):
+        if self.cache_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r') as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if self._expired(entry['stored_at']):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return entry['stored_at'], entry['value']
+
+    def _write_disk(self, key, entry):
+        if self.cache_dir is None:
+            return
+        path = self._disk_path(key)
+        # Write then rename so that readers never see a partial file (the
+        # temporary name is unique to this thread of this process)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            existed = os.path.exists(path)
+            with open(tmp_path, 'w') as file:
+                json.dump({'stored_at': entry[0], 'value': entry[1]}, file)
+            os.replace(tmp_path, path)
+        except OSError:
+            # The disk layer is a cache: a failed write must not fail the request
+            return
+
+        with self._lock:
+            if not existed:
+                self._nb_disk_entries += 1
+            prune = self._nb_disk_entries > self.max_disk_entries
+        if prune:
+            self._prune_disk()
+
+    def _prune_disk(self):
+        # Drop the oldest files, down to 90% of the limit to prune only once in a while.
+        # Other threads or processes may remove files meanwhile, and write temporary files
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                files.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                pass
+        files.sort()
+        nb_to_remove = max(len(files) - int(self.max_disk_entries * 0.9), 0)
+        for _, path in files[:nb_to_remove]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._nb_disk_entries = len(files) - nb_to_remove
+            self.evictions += nb_to_remove
@@ -0,0 +1,102 @@
+import argparse
+import json
+import os
+from settings import PROJECT_ROOT, RUN_REGISTRY_PATH, SERVED_RUN, select_run
+
+
+def load_registry(registry_path=RUN_REGISTRY_PATH):
+    """
+    Load the registry of the training runs.
+
+    Parameters:
+    - registry_path (str): Path to the registry.
+
+    Returns:
+    - dict: Registry, whose 'runs' are sorted from the oldest to the newest.
+    """
+    if not os.path.isfile(registry_path):
+        return {"runs": []}
+    with open(registry_path) as file:
+        return json.load(file)
+
+
+def save_registry(registry, registry_path=RUN_REGISTRY_PATH):
+    """
+    Save the registry of the training runs (atomically, the API may be reading it).
+
+    Parameters:
+    - registry (dict): Registry to save.
+    - registry_path (str): Path to the registry.
+    """
+    os.makedirs(os.path.dirname(registry_path), exist_ok=True)
+    with open(registry_path + ".tmp", "w") as file:
+        json.dump(registry, file, indent=2)
+    os.replace(registry_path + ".tmp", registry_path)
+
+
+def update_run(run_id, registry_path=RUN_REGISTRY_PATH, **fields):
+    """
+    Add a run to the registry, or update its fields if it is already there.
+
+    Parameters:
+    - run_id (str): Id of the run (name of its folder in runs/detect).
+    - registry_path (str): Path to the registry.
+    - **fields: Fields of the run to set.
+
+    Returns:
+    - dict: The run.
+    """
+    registry = load_registry(registry_path)
+    run = find_run(registry, run_id)
+    if run is None:
+        run = {"id": run_id}
+        registry["runs"].append(run)
+    run.update(fields)
+    save_registry(registry, registry_path)
+    return run
+
+
+def find_run(registry, run_id):
+    """
+    Find a run of the registry.
+
+    Parameters:
+    - registry (dict): Registry.
+    - run_id (str): Id of the run.
+
+    Returns:
+    - dict: The run, or None if it is not in the registry.
+    """
+    return next((run for run in registry["runs"] if run["id"] == run_id), None)
+
+
+def project_path(path):
+    """
+    Make a path relative to the project, so that the registry stays valid when
+    the project is moved to another machine.
+
+    Parameters:
+    - path (str): Path to a file of the project.
+
+    Returns:
+    - str: Path relative to the project root.
+    """
+    return os.path.relpath(os.path.abspath(path), PROJECT_ROOT)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List the training runs and the one served by the API.")
+    parser.add_argument("--registry", default=RUN_REGISTRY_PATH)
+    parser.add_argument("--served-run", default=SERVED_RUN, help="'best', 'latest' or a run id")
+    args = parser.parse_args()
+
+    registry = load_registry(args.registry)
+    served = select_run(registry["runs"], args.served_run)
+    for run in registry["runs"]:
+        metrics = run.get("metrics", {})
+        print(f"{'*' if run is served else ' '} {run['id']:<10} {run.get('status', ''):<12} "
+              f"epochs {run.get('epochs_done', 0)}/{run.get('epochs', '?'):<4} "
+              f"stop {run.get('stop_reason', '-'):<9} fitness {run.get('fitness') or 0.:.4f} "
+              f"mAP50 {metrics.get('mAP50', 0.):.3f} mAP50-95 {metrics.get('mAP50-95', 0.):.3f} "
+              f"{run.get('epochs_per_hour', 0.):.1f} epochs/h")
+    print(f"Served ({args.served_run}): {served['best_weights'] if served else 'none, LAST_TRAIN_ID is used'}")
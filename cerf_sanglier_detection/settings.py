@@ -0,0 +1,81 @@
+import json
+import os
+
+# Paths of the project, overridable by environment variables. They do not
+# depend on the working directory, so the API and the scripts can be started
+# from anywhere. This module must stay cheap to import (no heavy dependency).
+
+PROJECT_ROOT = os.environ.get("PROJECT_ROOT", os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DATA_FOLDER = os.environ.get("DATA_FOLDER", os.path.join(PROJECT_ROOT, "data"))
+IMG_FOLDER = os.path.join(DATA_FOLDER, "images")
+URL_FILES_PATH = os.path.join(DATA_FOLDER, "urls")
+
+# Training runs, recorded by yolo_train.py (see run_registry.py)
+RUNS_FOLDER = os.path.join(PROJECT_ROOT, "runs", "detect")
+RUN_REGISTRY_PATH = os.environ.get("RUN_REGISTRY_PATH", os.path.join(PROJECT_ROOT, "runs", "registry.json"))
+
+
+def select_run(runs, served_run="best"):
+    """
+    Pick a run of the registry whose best weights exist.
+
+    Parameters:
+    - runs (list): Runs of the registry, oldest first.
+    - served_run (str): 'best' (highest fitness), 'latest' (last finished), or the id of a run.
+
+    Returns:
+    - dict: The run, or None if no run matches.
+    """
+    runs = [run for run in runs if run.get("best_weights")
+            and os.path.isfile(os.path.join(PROJECT_ROOT, run["best_weights"]))]
+    if served_run not in ("best", "latest"):
+        return next((run for run in runs if run["id"] == served_run), None)
+    runs = [run for run in runs if run.get("status") == "finished"]
+    if not runs:
+        return None
+    if served_run == "latest":
+        return runs[-1]
+    return max(runs, key=lambda run: run.get("fitness") or 0.)
+
+
+def served_weights_path(registry_path=RUN_REGISTRY_PATH, served_run="best", default=None):
+    """
+    Get the best weights of the run served by the API.
+
+    Parameters:
+    - registry_path (str): Path to the run registry.
+    - served_run (str): Which run to serve (see `select_run`).
+    - default (str): Weights used when the registry has no such run.
+
+    Returns:
+    - str: Path to the weights.
+    """
+    try:
+        with open(registry_path) as file:
+            runs = json.load(file)["runs"]
+    except (OSError, ValueError, KeyError):
+        runs = []
+    run = select_run(runs, served_run)
+    return os.path.join(PROJECT_ROOT, run["best_weights"]) if run else default
+
+
+# Weights served by the API: YOLO_WEIGHTS_PATH, or the run LAST_TRAIN_ID if set,
+# else the SERVED_RUN run of the registry, else train13 (trained before the registry)
+LAST_TRAIN_ID = int(os.environ.get("LAST_TRAIN_ID", 13))
+LAST_TRAIN_WEIGHTS_PATH = os.path.join(RUNS_FOLDER, f"train{LAST_TRAIN_ID}", "weights", "best.pt")
+SERVED_RUN = os.environ.get("SERVED_RUN", "best")
+if "YOLO_WEIGHTS_PATH" in os.environ:
+    YOLO_WEIGHTS_PATH = os.environ["YOLO_WEIGHTS_PATH"]
+elif "LAST_TRAIN_ID" in os.environ:
+    YOLO_WEIGHTS_PATH = LAST_TRAIN_WEIGHTS_PATH
+else:
+    YOLO_WEIGHTS_PATH = served_weights_path(RUN_REGISTRY_PATH, SERVED_RUN, LAST_TRAIN_WEIGHTS_PATH)
+DEVICE = os.environ.get("DEVICE", "cpu")
+
+# GroundingDino, used to annotate the dataset (see setup_grounding_dino.py)
+GROUNDING_DINO_PATH = os.environ.get("GROUNDING_DINO_PATH", os.path.join(PROJECT_ROOT, "GroundingDINO"))
+GROUNDING_DINO_CONFIG_PATH = os.environ.get(
+    "GROUNDING_DINO_CONFIG_PATH",
+    os.path.join(GROUNDING_DINO_PATH, "groundingdino", "config", "GroundingDINO_SwinT_OGC.py"))
+GROUNDING_DINO_WEIGHTS_PATH = os.environ.get(
+    "GROUNDING_DINO_WEIGHTS_PATH", os.path.join(PROJECT_ROOT, "weights", "groundingdino_swint_ogc.pth"))
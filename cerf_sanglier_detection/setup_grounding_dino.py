@@ -1,27 +1,53 @@
 import os
 import subprocess
+import sys
+from settings import GROUNDING_DINO_PATH, GROUNDING_DINO_CONFIG_PATH, GROUNDING_DINO_WEIGHTS_PATH
 
-HOME = os.getcwd()
-HOME = os.path.dirname(HOME)
-os.chdir(HOME)
+GROUNDING_DINO_REPO = "https://github.com/IDEA-Research/GroundingDINO.git"
+WEIGHTS_URL = "https://github.com/IDEA-Research/GroundingDINO/releases/download/v0.1.0-alpha/groundingdino_swint_ogc.pth"
 
-# Cloning Groundin Dino directory and installing requirements
-subprocess.run(["git", "clone", "https://github.com/IDEA-Research/GroundingDINO.git"])
-os.chdir(os.path.join(HOME, "GroundingDINO"))
-subprocess.run(["pip", "install", "-q", "-e", "."])
+# Define the config and weight files (importing this module installs nothing,
+# run it as a script to set GroundingDino up)
+CONFIG_PATH = GROUNDING_DINO_CONFIG_PATH
+WEIGHTS_PATH = GROUNDING_DINO_WEIGHTS_PATH
 
-# Define the config file
-CONFIG_PATH = os.path.join(HOME, "GroundingDINO/groundingdino/config/GroundingDINO_SwinT_OGC.py")
-print(CONFIG_PATH, "; exist:", os.path.isfile(CONFIG_PATH))
 
-# Downloading Grounding Dino Weights
-os.chdir(HOME)
-os.makedirs(os.path.join(HOME, "weights"), exist_ok=True)
-os.chdir(os.path.join(HOME, "weights"))
-subprocess.run(["wget", "-q", "https://github.com/IDEA-Research/GroundingDINO/releases/download/v0.1.0-alpha/groundingdino_swint_ogc.pth"])
+def install_grounding_dino(repo_path=GROUNDING_DINO_PATH):
+    """
+    Clone the GroundingDino repository and install it (skipped if already cloned).
 
-# Define the weight file
-WEIGHTS_NAME = "groundingdino_swint_ogc.pth"
-WEIGHTS_PATH = os.path.join(HOME, "weights", WEIGHTS_NAME)
-print(WEIGHTS_PATH, "; exist:", os.path.isfile(WEIGHTS_PATH))
+    Parameters:
+    - repo_path (str): Where to clone the repository.
+    """
+    if not os.path.isdir(repo_path):
+        subprocess.run(["git", "clone", GROUNDING_DINO_REPO, repo_path], check=True)
+    subprocess.run([sys.executable, "-m", "pip", "install", "-q", "-e", repo_path], check=True)
 
+
+def download_weights(weights_path=WEIGHTS_PATH):
+    """
+    Download the GroundingDino weights (skipped if already downloaded).
+
+    Parameters:
+    - weights_path (str): Where to save the weights.
+    """
+    if os.path.isfile(weights_path):
+        return
+    os.makedirs(os.path.dirname(weights_path), exist_ok=True)
+    # Downloaded next to its final path, so that an interrupted download is not taken for the weights
+    subprocess.run(["wget", "-q", "-O", weights_path + ".part", WEIGHTS_URL], check=True)
+    os.replace(weights_path + ".part", weights_path)
+
+
+def setup_grounding_dino():
+    """
+    Install GroundingDino and download its weights.
+    """
+    install_grounding_dino()
+    download_weights()
+    print(CONFIG_PATH, "; exist:", os.path.isfile(CONFIG_PATH))
+    print(WEIGHTS_PATH, "; exist:", os.path.isfile(WEIGHTS_PATH))
+
+
+if __name__ == "__main__":
+    setup_grounding_dino()
@@ -0,0 +1,99 @@
+import os
+from ultralytics.data import YOLODataset
+from ultralytics.models.yolo.detect import DetectionTrainer
+from ultralytics.utils import DEFAULT_CFG, colorstr
+from ultralytics.utils.torch_utils import de_parallel
+from dataset_shards import load_shard, shard_image, shard_labels
+
+
+class ShardDataset(YOLODataset):
+    """
+    YOLO dataset reading its images and labels from a shard (see
+    `dataset_shards.pack_split`) instead of decoding and resizing the JPEG
+    files at each epoch. The augmentations are the ones of `YOLODataset`.
+    """
+
+    def __init__(self, shard_dir, *args, **kwargs):
+        self.shard_dir = shard_dir
+        self.shard = load_shard(shard_dir)
+        super().__init__(*args, **kwargs)
+        if self.shard["meta"]["imgsz"] != self.imgsz:
+            raise ValueError(f"{shard_dir} is packed for imgsz={self.shard['meta']['imgsz']}, not {self.imgsz}")
+        # Shard row of each sample: `set_rectangle` sorts the samples by aspect ratio
+        rows = {im_file: row for row, im_file in enumerate(self.shard["meta"]["files"])}
+        self.shard_rows = [rows[im_file] for im_file in self.im_files]
+
+    def __getstate__(self):
+        # Pickling a memmap copies its whole content: the data loader workers open it again
+        state = self.__dict__.copy()
+        state["shard"] = dict(self.shard, images=None)
+        return state
+
+    def get_img_files(self, img_path):
+        files = self.shard["meta"]["files"]
+        return files[:round(len(files) * self.fraction)] if self.fraction < 1 else files
+
+    def get_labels(self):
+        labels = []
+        for i, im_file in enumerate(self.im_files):
+            label = shard_labels(self.shard, i)
+            # Original (height, width) of the image
+            shape = tuple(self.shard["index"][i, 3:5].tolist())
+            labels.append(dict(im_file=im_file, shape=shape, cls=label[:, 0:1].copy(), bboxes=label[:, 1:].copy(),
+                               segments=[], keypoints=None, normalized=True, bbox_format="xywh"))
+        return labels
+
+    def load_image(self, i, rect_mode=True):
+        if self.ims[i] is not None:
+            return self.ims[i], self.im_hw0[i], self.im_hw[i]
+        if self.shard["images"] is None:
+            self.shard["images"] = load_shard(self.shard_dir)["images"]
+        img, (h0, w0) = shard_image(self.shard, self.shard_rows[i])
+        # The augmentations may write in the image, and the memmap is read-only
+        img = img.copy()
+        if not rect_mode and img.shape[:2] != (self.imgsz, self.imgsz):
+            import cv2
+
+            img = cv2.resize(img, (self.imgsz, self.imgsz), interpolation=cv2.INTER_LINEAR)
+        if self.augment:
+            # Same buffer as `BaseDataset.load_image`, the mosaic picks its other images in it
+            self.ims[i], self.im_hw0[i], self.im_hw[i] = img, (h0, w0), img.shape[:2]
+            self.buffer.append(i)
+            if len(self.buffer) >= self.max_buffer_length:
+                j = self.buffer.pop(0)
+                self.ims[j], self.im_hw0[j], self.im_hw[j] = None, None, None
+        return img, (h0, w0), img.shape[:2]
+
+
+class ShardDetectionTrainer(DetectionTrainer):
+    """
+    Detection trainer whose train and val data loaders read the shards of
+    `shards_folder` ('train' and 'val' sub-folders).
+    """
+
+    def __init__(self, shards_folder, cfg=DEFAULT_CFG, overrides=None, _callbacks=None):
+        self.shards_folder = shards_folder
+        super().__init__(cfg, overrides, _callbacks)
+
+    def build_dataset(self, img_path, mode="train", batch=None):
+        stride = max(int(de_parallel(self.model).stride.max() if self.model else 0), 32)
+        split = "train" if mode == "train" else "val"
+        # Same arguments as `build_yolo_dataset`, but no image cache: the shard is the cache
+        return ShardDataset(
+            os.path.join(self.shards_folder, split),
+            img_path=img_path,
+            imgsz=self.args.imgsz,
+            batch_size=batch,
+            augment=mode == "train",
+            hyp=self.args,
+            rect=self.args.rect or mode == "val",
+            cache=None,
+            single_cls=self.args.single_cls or False,
+            stride=stride,
+            pad=0.0 if mode == "train" else 0.5,
+            prefix=colorstr(f"{mode}: "),
+            task=self.args.task,
+            classes=self.args.classes,
+            data=self.data,
+            fraction=self.args.fraction if mode == "train" else 1.0,
+        )
@@ -1,13 +1,31 @@
+import argparse
 import os
 import shutil
 from tqdm import tqdm
-from sklearn.model_selection import train_test_split, StratifiedShuffleSplit
-from utils import get_image_names
+from dataset_catalog import update_catalog, query_images, default_catalog_path
+from settings import DATA_FOLDER
 
-# Set the path to your data folder
-HOME = os.getcwd()
-HOME = os.path.dirname(HOME)
-DATA_FOLDER = os.path.join(HOME,'data')
+# How the images of a split are materialized: copies, hard links, symbolic
+# links (the last two use no extra disk space), or only image list files
+SPLIT_MODES = ('copy', 'hardlink', 'symlink', 'list')
+
+def list_annotated_images(image_folder, non_annotated_imgs=None, class_name=None):
+    """
+    List the annotated image files of a folder, from its dataset catalog
+    (updated first, only the new or modified files are read).
+
+    Parameters:
+    - image_folder (str): Path to the folder containing images.
+    - non_annotated_imgs (list): List of non-annotated image names, excluded
+      (the images without a label file are excluded anyway).
+    - class_name (str): Only list the images of this class.
+
+    Returns:
+    - list: List of image files.
+    """
+    catalog_path = default_catalog_path(image_folder)
+    update_catalog(image_folder, db_path=catalog_path)
+    return query_images(catalog_path, class_name=class_name, annotated=True, exclude=non_annotated_imgs)
 
 def list_file_byclass(image_folder, dict_labels, non_annotated_imgs):
     """
@@ -21,37 +39,64 @@ def list_file_byclass(image_folder, dict_labels, non_annotated_imgs):
     Returns:
     - dict: Dictionary mapping class names to lists of image files.
     """
-    final_dict = {}
+    catalog_path = default_catalog_path(image_folder)
+    update_catalog(image_folder, db_path=catalog_path)
 
+    final_dict = {}
     for key in dict_labels.keys():
-        final_dict[key] = [image_file for image_file in get_image_names(image_folder)
-                       if (image_file not in non_annotated_imgs) and (image_file.split('_')[0] == key)]
-        
+        final_dict[key] = query_images(catalog_path, class_name=key, annotated=True, exclude=non_annotated_imgs)
+
     return final_dict
 
-def create_train_valid_test(DATA_FOLDER, non_annotated_imgs):
+def create_train_valid_test(DATA_FOLDER, non_annotated_imgs=None, seed=None):
     """
     Create training, validation, and testing sets.
 
     Parameters:
     - DATA_FOLDER (str): Path to the data folder.
-    - non_annotated_imgs (list): List of non-annotated image names.
+    - non_annotated_imgs (list): List of non-annotated image names (images without label are excluded anyway).
+    - seed (int): Random seed, to reproduce a split.
 
     Returns:
     - tuple: Tuple containing lists of training, validation, and testing image files.
     """
-    # List all image files in the 'images' folder 
+    from sklearn.model_selection import train_test_split
+
+    # List all annotated image files in the 'images' folder
     image_folder = os.path.join(DATA_FOLDER, 'images')
-    image_files = [image_file for image_file in get_image_names(image_folder)
-                       if (image_file not in non_annotated_imgs)]
+    image_files = list_annotated_images(image_folder, non_annotated_imgs)
     
     # Split the data into training, validation, and testing sets
-    train_images, test_images = train_test_split(image_files, test_size=0.2)
-    train_images, valid_images = train_test_split(train_images, test_size=0.2)
+    train_images, test_images = train_test_split(image_files, test_size=0.2, random_state=seed)
+    train_images, valid_images = train_test_split(train_images, test_size=0.2, random_state=seed)
 
     return train_images, valid_images, test_images
 
-def move_images(source_folder, destination_folder, image_list):
+def place_file(source_path, destination_path, mode='copy'):
+    """
+    Copy or link a file.
+
+    Parameters:
+    - source_path (str): Path to the source file.
+    - destination_path (str): Path to the destination file (replaced if it exists).
+    - mode (str): 'copy', 'hardlink' or 'symlink'.
+    """
+    # A link left by a previous split is the source itself: it is removed, not written through
+    if os.path.lexists(destination_path):
+        os.remove(destination_path)
+    if mode == 'copy':
+        shutil.copy(source_path, destination_path)
+        return
+    if mode == 'symlink':
+        os.symlink(os.path.abspath(source_path), destination_path)
+        return
+    try:
+        os.link(source_path, destination_path)
+    except OSError:
+        # Hard links cannot cross file systems
+        shutil.copy(source_path, destination_path)
+
+def move_images(source_folder, destination_folder, image_list, mode='copy'):
     """
     Move images from source folder to destination folder 
     and move labels of those image wtih the same mouvement as images
@@ -60,6 +105,7 @@ def move_images(source_folder, destination_folder, image_list):
     - source_folder (str): Path to the source image folder.
     - destination_folder (str): Path to the destination image folder.
     - image_list (list): List of image files to be moved.
+    - mode (str): 'copy', 'hardlink' or 'symlink'.
     """
     for image in tqdm(image_list):
         img_source_path = os.path.join(source_folder, image)
@@ -72,49 +118,135 @@ def move_images(source_folder, destination_folder, image_list):
         label_source_path = os.path.join(label_source_folder, label)
         label_destination_path = os.path.join(label_destination_folder, label)
 
-        shutil.copy(img_source_path , img_destination_path)
-        shutil.copy(label_source_path , label_destination_path)
+        place_file(img_source_path, img_destination_path, mode)
+        place_file(label_source_path, label_destination_path, mode)
+
+def write_image_list(image_folder, image_list, list_path):
+    """
+    Write a YOLO image list file: one absolute image path per line. YOLO finds
+    the label of 'data/images/x.jpg' in 'data/labels/x.txt', so the images and
+    labels stay where they are.
+
+    Parameters:
+    - image_folder (str): Path to the folder containing images.
+    - image_list (list): List of image files.
+    - list_path (str): Path to the list file.
+    """
+    os.makedirs(os.path.dirname(list_path), exist_ok=True)
+    with open(list_path, 'w') as file:
+        for image in image_list:
+            file.write(os.path.abspath(os.path.join(image_folder, image)) + '\n')
 
-def create_train_valid_test_stratified(DATA_FOLDER, non_annotated_imgs):
+def create_train_valid_test_stratified(DATA_FOLDER, non_annotated_imgs=None, seed=None):
     """
     Create stratified training, validation, and testing sets.
 
     Parameters:
     - DATA_FOLDER (str): Path to the data folder.
-    - non_annotated_imgs (list): List of non-annotated image names.
+    - non_annotated_imgs (list): List of non-annotated image names (images without label are excluded anyway).
+    - seed (int): Random seed, to reproduce a split.
 
     Returns:
     - tuple: Tuple containing lists of training, validation, and testing image files.
     """
-    # List all image files in the 'images' folder 
+    from sklearn.model_selection import StratifiedShuffleSplit
+
+    # List all annotated image files in the 'images' folder
     image_folder = os.path.join(DATA_FOLDER, 'images')
-    image_files = [image_file for image_file in get_image_names(image_folder)
-                       if (image_file not in non_annotated_imgs)]
+    image_files = list_annotated_images(image_folder, non_annotated_imgs)
 
     # Extract labels from file names
     labels = [f.split('_')[0] for f in image_files]
 
     # Split the data into training, validation, and testing sets with stratification
-    stratified_splitter = StratifiedShuffleSplit(n_splits=1, test_size=0.2)
+    stratified_splitter = StratifiedShuffleSplit(n_splits=1, test_size=0.2, random_state=seed)
     train_index, test_index = next(stratified_splitter.split(image_files, labels))
 
     train_images, test_images = [image_files[i] for i in train_index], [image_files[i] for i in test_index]
     train_labels, test_labels = [labels[i] for i in train_index], [labels[i] for i in test_index]
 
-    stratified_splitter = StratifiedShuffleSplit(n_splits=1, test_size=0.2)
+    stratified_splitter = StratifiedShuffleSplit(n_splits=1, test_size=0.2, random_state=seed)
     train_index, valid_index = next(stratified_splitter.split(train_images, train_labels))
 
     train_images, valid_images = [train_images[i] for i in train_index], [train_images[i] for i in valid_index]
 
     return train_images, valid_images, test_images
 
-def create_train_valid_test_folders(DATA_FOLDER, stratified=True):
+def create_train_valid_test_lists(DATA_FOLDER, stratified=True, non_annotated_imgs=None, seed=None):
+    """
+    Create training, validation, and testing sets as YOLO image list files
+    (no image is copied).
+
+    Parameters:
+    - DATA_FOLDER (str): Path to the data folder.
+    - stratified (bool): Whether to use stratified sampling.
+    - non_annotated_imgs (list): List of non-annotated image names.
+    - seed (int): Random seed, to reproduce a split.
+
+    Returns:
+    - tuple: Tuple containing the paths to the training, validation, and testing list files.
+    """
+    if stratified:
+        splits = create_train_valid_test_stratified(DATA_FOLDER, non_annotated_imgs, seed)
+    else:
+        splits = create_train_valid_test(DATA_FOLDER, non_annotated_imgs, seed)
+
+    image_folder = os.path.join(DATA_FOLDER, 'images')
+    list_paths = []
+    for name, image_list in zip(['train', 'valid', 'test'], splits):
+        list_path = os.path.join(DATA_FOLDER, 'splits', f'{name}.txt')
+        write_image_list(image_folder, sorted(image_list), list_path)
+        list_paths.append(list_path)
+    return tuple(list_paths)
+
+def create_kfold_lists(DATA_FOLDER, k=5, non_annotated_imgs=None, seed=0, test_size=0.2):
+    """
+    Create k stratified folds as YOLO image list files. A test set is held out
+    first, then each fold uses one part of the other images for validation and
+    the rest for training.
+
+    Parameters:
+    - DATA_FOLDER (str): Path to the data folder.
+    - k (int): Number of folds.
+    - non_annotated_imgs (list): List of non-annotated image names.
+    - seed (int): Random seed, to reproduce the folds.
+    - test_size (float): Share of the images held out for testing.
+
+    Returns:
+    - tuple: Tuple containing the list of (train, valid) list file paths of each fold and the test list file path.
+    """
+    from sklearn.model_selection import train_test_split, StratifiedKFold
+
+    image_folder = os.path.join(DATA_FOLDER, 'images')
+    image_files = list_annotated_images(image_folder, non_annotated_imgs)
+    labels = [f.split('_')[0] for f in image_files]
+
+    pool_images, test_images, pool_labels, _ = train_test_split(image_files, labels, test_size=test_size,
+                                                                stratify=labels, random_state=seed)
+    test_path = os.path.join(DATA_FOLDER, 'splits', 'test.txt')
+    write_image_list(image_folder, sorted(test_images), test_path)
+
+    folds = []
+    splitter = StratifiedKFold(n_splits=k, shuffle=True, random_state=seed)
+    for i, (train_index, valid_index) in enumerate(splitter.split(pool_images, pool_labels)):
+        fold_folder = os.path.join(DATA_FOLDER, 'splits', f'fold_{i}')
+        train_path = os.path.join(fold_folder, 'train.txt')
+        valid_path = os.path.join(fold_folder, 'valid.txt')
+        write_image_list(image_folder, sorted(pool_images[j] for j in train_index), train_path)
+        write_image_list(image_folder, sorted(pool_images[j] for j in valid_index), valid_path)
+        folds.append((train_path, valid_path))
+    return folds, test_path
+
+def create_train_valid_test_folders(DATA_FOLDER, stratified=True, non_annotated_imgs=None, mode='copy', seed=None):
     """
     Create folders for training, validation, and testing sets. and copiying the data there
 
     Parameters:
     - DATA_FOLDER (str): Path to the data folder.
     - stratified (bool): Whether to use stratified sampling.
+    - non_annotated_imgs (list): List of non-annotated image names.
+    - mode (str): 'copy', 'hardlink' or 'symlink', how images and labels are placed in the folders.
+    - seed (int): Random seed, to reproduce a split.
 
     Returns:
     - tuple: Tuple containing lists of training, validation, and testing image files.
@@ -135,17 +267,32 @@ def create_train_valid_test_folders(DATA_FOLDER, stratified=True):
             os.makedirs(labels_folder)
 
     if stratified:
-        train_images, valid_images, test_images = create_train_valid_test_stratified(DATA_FOLDER, non_annotated_imgs)
+        train_images, valid_images, test_images = create_train_valid_test_stratified(DATA_FOLDER, non_annotated_imgs, seed)
     else:
-        train_images, valid_images, test_images = create_train_valid_test(DATA_FOLDER, non_annotated_imgs)
+        train_images, valid_images, test_images = create_train_valid_test(DATA_FOLDER, non_annotated_imgs, seed)
 
     image_folder = os.path.join(DATA_FOLDER, 'images')
-    move_images(image_folder, train_folder, train_images)
-    move_images(image_folder, valid_folder, valid_images)
-    move_images(image_folder, test_folder, test_images)
+    move_images(image_folder, train_folder, train_images, mode)
+    move_images(image_folder, valid_folder, valid_images, mode)
+    move_images(image_folder, test_folder, test_images, mode)
+
+    return train_images, valid_images, test_images
 
 
 if __name__ == "__main__":
-    # Set the path to your data folder
-    DATA_FOLDER = os.path.join(HOME,'data')
-    create_train_valid_test_folders(DATA_FOLDER, stratified = True)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Split the annotated images into training, validation and testing sets.")
+    parser.add_argument("--mode", default="copy", choices=SPLIT_MODES,
+                        help="copy, hard link or symlink the files into split folders, or only write image lists")
+    parser.add_argument("--seed", type=int, default=None, help="random seed, to reproduce a split")
+    parser.add_argument("--kfold", type=int, default=0, help="write k folds of image lists instead")
+    parser.add_argument("--not-stratified", action="store_true")
+    args = parser.parse_args()
+
+    if args.kfold:
+        folds, test_path = create_kfold_lists(DATA_FOLDER, k=args.kfold, seed=args.seed or 0)
+        print(f"Folds: {folds}, test: {test_path}")
+    elif args.mode == 'list':
+        print(create_train_valid_test_lists(DATA_FOLDER, stratified=not args.not_stratified, seed=args.seed))
+    else:
+        create_train_valid_test_folders(DATA_FOLDER, stratified=not args.not_stratified, mode=args.mode,
+                                        seed=args.seed)
\ No newline at end of file
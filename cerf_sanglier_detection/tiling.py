@@ -0,0 +1,163 @@
+import numpy as np
+from cerf_sanglier_detection import model_registry
+from cerf_sanglier_detection.metrics import timed
+
+DEFAULT_TILE_SIZE = 640
+DEFAULT_TILE_OVERLAP = 0.2
+# Smallest tile accepted in a request (smaller tiles make huge batches)
+MIN_TILE_SIZE = 160
+# Largest overlap accepted in a request: the step between two tiles stays at least half a tile
+MAX_TILE_OVERLAP = 0.5
+# Largest number of tiles of an image, and number of tiles given to the model at once
+MAX_TILES = 256
+TILE_BATCH_SIZE = 16
+NMS_IOU = 0.5
+
+
+class TilingError(ValueError):
+    """
+    Raised when an image would be cut into more than `MAX_TILES` tiles.
+    """
+
+
+def tile_origins(length, tile_size, overlap):
+    """
+    Get the start positions of the tiles along one axis, the last tile ending
+    on the border of the image.
+
+    Parameters:
+    - length (int): Length of the image along the axis.
+    - tile_size (int): Length of a tile.
+    - overlap (float): Fraction of a tile shared with the next one.
+
+    Returns:
+    - np.ndarray: Start positions.
+    """
+    if length <= tile_size:
+        return np.zeros(1, dtype=int)
+    step = max(int(tile_size * (1 - overlap)), 1)
+    origins = np.arange(0, length - tile_size, step)
+    return np.append(origins, length - tile_size)
+
+
+def tile_grid(height, width, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_TILE_OVERLAP, max_tiles=MAX_TILES):
+    """
+    Get the tiles of an image, without touching its pixels.
+
+    Parameters:
+    - height (int): Height of the image.
+    - width (int): Width of the image.
+    - tile_size (int): Size of the (square) tiles; images smaller than a tile give smaller tiles.
+    - overlap (float): Fraction of a tile shared with its neighbours.
+    - max_tiles (int): Largest number of tiles allowed, None for no limit.
+
+    Returns:
+    - tuple: (tile height, tile width, y origins, x origins).
+    """
+    tile_height, tile_width = min(tile_size, height), min(tile_size, width)
+    ys = tile_origins(height, tile_height, overlap)
+    xs = tile_origins(width, tile_width, overlap)
+    if max_tiles is not None and len(ys) * len(xs) > max_tiles:
+        raise TilingError(f"a {width}x{height} image gives {len(ys) * len(xs)} tiles of {tile_size} pixels "
+                          f"with an overlap of {overlap}, more than {max_tiles}: use larger tiles or less overlap")
+    return tile_height, tile_width, ys, xs
+
+
+def extract_tiles(img, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_TILE_OVERLAP, max_tiles=MAX_TILES):
+    """
+    Cut an image into overlapping tiles, with a single copy of the pixels (the
+    tiles are picked from a strided view of the image).
+
+    Parameters:
+    - img (np.ndarray): BGR image of shape (height, width, 3).
+    - tile_size (int): Size of the (square) tiles; images smaller than a tile give smaller tiles.
+    - overlap (float): Fraction of a tile shared with its neighbours.
+    - max_tiles (int): Largest number of tiles allowed, None for no limit.
+
+    Returns:
+    - tuple: (tiles of shape (n, tile height, tile width, 3), (x, y) origins of the tiles of shape (n, 2)).
+    """
+    tile_height, tile_width, ys, xs = tile_grid(*img.shape[:2], tile_size, overlap, max_tiles)
+
+    # View of every possible tile, of shape (rows, columns, 1, tile height, tile width, 3)
+    windows = np.lib.stride_tricks.sliding_window_view(img, (tile_height, tile_width, 3))
+    tiles = windows[ys[:, None], xs[None, :], 0].reshape(-1, tile_height, tile_width, 3)
+    origins = np.stack(np.meshgrid(xs, ys), axis=-1).reshape(-1, 2)
+    return tiles, origins
+
+
+def merge_tile_boxes(results, origins, iou_threshold=NMS_IOU):
+    """
+    Bring the boxes of the tiles back to the coordinates of the image and
+    remove the duplicates found by overlapping tiles (NMS by class).
+
+    Parameters:
+    - results (list): Ultralytics results, one per tile.
+    - origins (np.ndarray): (x, y) origins of the tiles, (0, 0) for a result on the full image.
+    - iou_threshold (float): IoU above which two boxes of the same class are the same animal.
+
+    Returns:
+    - torch.Tensor: Boxes (x1, y1, x2, y2, score, class_id) of shape (n, 6).
+    """
+    import torch
+    from torchvision.ops import batched_nms
+
+    all_boxes = []
+    for result, (x, y) in zip(results, origins):
+        boxes = result.boxes.data.cpu().clone()
+        boxes[:, [0, 2]] += float(x)
+        boxes[:, [1, 3]] += float(y)
+        all_boxes.append(boxes)
+    boxes = torch.cat(all_boxes) if all_boxes else torch.zeros((0, 6))
+    keep = batched_nms(boxes[:, :4], boxes[:, 4], boxes[:, 5].long(), iou_threshold)
+    return boxes[keep]
+
+
+def predict_tiled(weights_path, img, device='cpu', conf=0.25, tile_size=DEFAULT_TILE_SIZE,
+                  overlap=DEFAULT_TILE_OVERLAP, include_full_image=True, batch_size=TILE_BATCH_SIZE):
+    """
+    Run sliced inference on a large image: its tiles go through the model at
+    their own size, by batches of `batch_size`, and the whole image (for the
+    animals larger than a tile) at the usual model size.
+
+    Parameters:
+    - weights_path (str): Path to the YOLO weights.
+    - img (np.ndarray): BGR image.
+    - device (str): Device used for inference.
+    - conf (float): Confidence threshold for detections.
+    - tile_size (int): Size of the (square) tiles.
+    - overlap (float): Fraction of a tile shared with its neighbours.
+    - include_full_image (bool): Whether to also run the downscaled whole image.
+    - batch_size (int): Number of tiles given to the model at once.
+
+    Returns:
+    - Results: Ultralytics result of the whole image, like one of `model_registry.predict`.
+
+    Raises:
+    - TilingError: If the image gives more than `MAX_TILES` tiles.
+    """
+    from ultralytics.engine.results import Results
+
+    with timed('tile'):
+        tile_height, tile_width, ys, xs = tile_grid(*img.shape[:2], tile_size, overlap)
+        origins = np.stack(np.meshgrid(xs, ys), axis=-1).reshape(-1, 2)
+
+    # Model input size of the tiles, a multiple of the model stride
+    tile_imgsz = -(-tile_size // 32) * 32
+    results = []
+    for start in range(0, len(origins), batch_size):
+        # Views of the image: only the tiles of the current batch are letterboxed
+        tiles = [img[y:y + tile_height, x:x + tile_width] for x, y in origins[start:start + batch_size]]
+        results += model_registry.predict(weights_path, tiles, device=device, conf=conf, imgsz=tile_imgsz,
+                                          verbose=False)
+    if include_full_image and len(origins) > 1:
+        results += model_registry.predict(weights_path, img, device=device, conf=conf, verbose=False)
+        origins = np.vstack([origins, [[0, 0]]])
+
+    with timed('merge'):
+        boxes = merge_tile_boxes(results, origins)
+
+    result = Results(img, path='', names=results[0].names, boxes=boxes)
+    # Time spent by the model on every batch, so that it is recorded once per image
+    result.speed = {stage: sum(r.speed[stage] or 0. for r in results) for stage in results[0].speed}
+    return result
@@ -13,8 +13,9 @@ def get_image_names(img_folder, extensions=None):
     """
     if extensions is None:
         extensions = [".jpg", ".png", ".jpeg", ".gif", ".bmp"]  # Add more extensions if needed
+    extensions = {ext.lower() for ext in extensions}
 
-    image_names = [file for file in os.listdir(img_folder) if any(file.lower().endswith(ext) for ext in extensions)]
+    image_names = [file for file in os.listdir(img_folder) if os.path.splitext(file)[1].lower() in extensions]
     return image_names
 
 
@@ -0,0 +1,292 @@
+import argparse
+import json
+import numpy as np
+from cerf_sanglier_detection import model_registry
+from cerf_sanglier_detection.backends import box_iou
+from cerf_sanglier_detection.metrics import record_stage, timed
+from cerf_sanglier_detection.settings import YOLO_WEIGHTS_PATH, DEVICE
+
+DICT_LABELS = {'boar': 0, 'deer': 1}
+# Frames run through the model together
+VIDEO_BATCH_SIZE = 8
+# Fraction of the pixels that must change for a frame to be analyzed
+MOTION_THRESHOLD = 0.01
+# A frame is analyzed at least every MAX_SKIPPED_FRAMES frames, even without motion
+MAX_SKIPPED_FRAMES = 50
+SEGMENT_SECONDS = 10.
+
+
+class VideoError(Exception):
+    """
+    A video that cannot be opened or read.
+    """
+
+
+def iter_frames(source, stride=1):
+    """
+    Read the frames of a video one at a time, keeping only one frame in memory.
+
+    Parameters:
+    - source (str): Path to a video file, or url of a stream (e.g. rtsp://...).
+    - stride (int): Only one frame out of `stride` is decoded.
+
+    Yields:
+    - tuple: Tuple containing the frame index, its timestamp (in seconds) and the BGR frame.
+    """
+    import cv2
+
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise VideoError(f"{source}: cannot open the video")
+    # Streams may not report their frame rate
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.
+    try:
+        frame_index = 0
+        while True:
+            # Skipped frames are only grabbed, not decoded
+            if frame_index % stride:
+                if not capture.grab():
+                    break
+                frame_index += 1
+                continue
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield frame_index, frame_index / fps, frame
+            frame_index += 1
+    finally:
+        capture.release()
+
+
+class MotionGate:
+    """
+    Skip the frames that barely changed since the last analyzed frame, by
+    comparing small grayscale versions of the frames.
+    """
+
+    def __init__(self, threshold=MOTION_THRESHOLD, max_skipped=MAX_SKIPPED_FRAMES, size=(64, 64), pixel_delta=25):
+        """
+        Parameters:
+        - threshold (float): Fraction of changed pixels above which a frame is analyzed (0 to analyze every frame).
+        - max_skipped (int): Number of frames after which a frame is analyzed even without motion.
+        - size (tuple): Size of the compared grayscale frames.
+        - pixel_delta (int): Gray level difference above which a pixel has changed.
+        """
+        self.threshold = threshold
+        self.max_skipped = max_skipped
+        self.size = size
+        self.pixel_delta = pixel_delta
+        self._reference = None
+        self._skipped = 0
+
+    def should_analyze(self, frame):
+        if self.threshold <= 0:
+            return True
+        import cv2
+        small = cv2.cvtColor(cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        if self._reference is not None and self._skipped < self.max_skipped:
+            changed = np.count_nonzero(cv2.absdiff(small, self._reference) > self.pixel_delta) / small.size
+            if changed < self.threshold:
+                self._skipped += 1
+                return False
+        self._reference = small
+        self._skipped = 0
+        return True
+
+
+class IoUTracker:
+    """
+    Link the boxes of successive analyzed frames into tracks, greedily matching
+    the boxes of the same class by IoU. Only the summary of each track is kept
+    and the tracks are handed back as soon as they end, so memory does not grow
+    with the length of the video.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_missed_frames=MAX_SKIPPED_FRAMES * 2):
+        """
+        Parameters:
+        - iou_threshold (float): Minimum IoU between a box and the last box of a track to extend it.
+        - max_missed_frames (int): Number of frames without a match after which a track ends.
+        """
+        self.iou_threshold = iou_threshold
+        self.max_missed_frames = max_missed_frames
+        self._tracks = []
+        self._next_id = 0
+
+    def update(self, frame_index, timestamp, boxes):
+        """
+        Add the boxes of an analyzed frame.
+
+        Parameters:
+        - frame_index (int): Index of the frame.
+        - timestamp (float): Timestamp of the frame (in seconds).
+        - boxes (np.ndarray): Boxes (x1, y1, x2, y2, score, class_id) of shape (n, 6).
+
+        Returns:
+        - tuple: (ids of the tracks of the boxes, list of the tracks that ended).
+        """
+        box_track_ids = [None] * len(boxes)
+        if len(boxes) and self._tracks:
+            last_boxes = np.array([track['last_box'] for track in self._tracks])
+            ious = box_iou(boxes[:, :4], last_boxes)
+            # Boxes of different classes never match
+            ious[boxes[:, 5][:, None] != np.array([track['class_id'] for track in self._tracks])[None, :]] = 0
+            for box_index, track_index in zip(*np.unravel_index(np.argsort(-ious, axis=None), ious.shape)):
+                if ious[box_index, track_index] < self.iou_threshold:
+                    break
+                track = self._tracks[track_index]
+                if box_track_ids[box_index] is not None or track['last_frame'] == frame_index:
+                    continue
+                self._extend(track, frame_index, timestamp, boxes[box_index])
+                box_track_ids[box_index] = track['track_id']
+
+        for box_index, box in enumerate(boxes):
+            if box_track_ids[box_index] is None:
+                track = {'track_id': self._next_id, 'class_id': int(box[5]), 'first_frame': frame_index,
+                         'start_s': timestamp, 'nb_detections': 0, 'max_score': 0.}
+                self._next_id += 1
+                self._extend(track, frame_index, timestamp, box)
+                self._tracks.append(track)
+                box_track_ids[box_index] = track['track_id']
+
+        ended = [track for track in self._tracks if frame_index - track['last_frame'] > self.max_missed_frames]
+        self._tracks = [track for track in self._tracks if frame_index - track['last_frame'] <= self.max_missed_frames]
+        return box_track_ids, ended
+
+    def flush(self):
+        """
+        End every track (at the end of the video).
+
+        Returns:
+        - list: Tracks that were still running.
+        """
+        ended, self._tracks = self._tracks, []
+        return ended
+
+    @staticmethod
+    def _extend(track, frame_index, timestamp, box):
+        track['last_frame'] = frame_index
+        track['end_s'] = timestamp
+        track['last_box'] = [float(v) for v in box[:4]]
+        track['nb_detections'] += 1
+        track['max_score'] = max(track['max_score'], float(box[4]))
+
+
+def new_segment(index, segment_seconds):
+    return {'segment': index, 'start_s': index * segment_seconds, 'end_s': (index + 1) * segment_seconds,
+            'frames_read': 0, 'frames_analyzed': 0,
+            'max_count_by_class': {label: 0 for label in DICT_LABELS}, 'track_ids': set()}
+
+
+def format_segment(segment):
+    return dict(segment, type='segment', track_ids=sorted(segment['track_ids']))
+
+
+def format_track(track):
+    id_labels = {value: key for key, value in DICT_LABELS.items()}
+    return dict(track, type='track', label=id_labels.get(track['class_id'], str(track['class_id'])))
+
+
+def analyze_video(source, weights_path=YOLO_WEIGHTS_PATH, confidence=0.25, device=DEVICE, stride=1,
+                  motion_threshold=MOTION_THRESHOLD, batch_size=VIDEO_BATCH_SIZE, segment_seconds=SEGMENT_SECONDS):
+    """
+    Detect animals in a video, reading it as a stream: frames are decoded one
+    by one, strided and gated by motion, and the analyzed ones go through the
+    model in batches. Memory is bounded by the batch size whatever the length
+    of the video.
+
+    Parameters:
+    - source (str): Path to a video file, or url of a stream.
+    - weights_path (str): Path to the YOLO weights.
+    - confidence (float): Confidence threshold for detections.
+    - device (str): Device used for inference.
+    - stride (int): Only one frame out of `stride` is read.
+    - motion_threshold (float): See `MotionGate` (0 to analyze every read frame).
+    - batch_size (int): Number of frames in a forward pass.
+    - segment_seconds (float): Duration of the segments over which counts are reported.
+
+    Yields:
+    - dict: Events in time order: a 'segment' event (number of frames read and
+      analyzed, maximum number of animals of each class seen in one frame, ids
+      of the tracks seen) at the end of each segment, a 'track' event when a
+      track ends, and a final 'summary' event.
+    """
+    gate = MotionGate(motion_threshold)
+    tracker = IoUTracker()
+    id_labels = {value: key for key, value in DICT_LABELS.items()}
+    segment = new_segment(0, segment_seconds)
+    totals = {'frames_read': 0, 'frames_analyzed': 0, 'nb_tracks_by_class': {label: 0 for label in DICT_LABELS}}
+
+    def count_track(track):
+        label = id_labels.get(track['class_id'])
+        if label is not None:
+            totals['nb_tracks_by_class'][label] += 1
+        return format_track(track)
+
+    def run_batch(batch):
+        # Events of the analyzed frames of the batch
+        with timed('inference'):
+            results = model_registry.predict(weights_path, [frame for _, _, frame in batch], device=device,
+                                             conf=confidence, verbose=False)
+        for (frame_index, timestamp, _), result in zip(batch, results):
+            for stage, milliseconds in result.speed.items():
+                record_stage(stage, milliseconds / 1000)
+            boxes = result.boxes.data.cpu().numpy()
+            track_ids, ended = tracker.update(frame_index, timestamp, boxes)
+            yield frame_index, timestamp, boxes, track_ids, ended
+
+    def add_frames(events):
+        for frame_index, timestamp, boxes, track_ids, ended in events:
+            segment['frames_analyzed'] += 1
+            segment['track_ids'].update(track_ids)
+            class_ids = boxes[:, 5].astype(int) if len(boxes) else np.zeros(0, dtype=int)
+            for label, class_id in DICT_LABELS.items():
+                count = int(np.count_nonzero(class_ids == class_id))
+                segment['max_count_by_class'][label] = max(segment['max_count_by_class'][label], count)
+            yield from (count_track(track) for track in ended)
+
+    batch = []
+    for frame_index, timestamp, frame in iter_frames(source, stride):
+        # Segments are closed once their frames are all analyzed
+        if timestamp >= segment['end_s']:
+            if batch:
+                yield from add_frames(run_batch(batch))
+                batch = []
+            yield format_segment(segment)
+            totals['frames_read'] += segment['frames_read']
+            totals['frames_analyzed'] += segment['frames_analyzed']
+            segment = new_segment(int(timestamp // segment_seconds), segment_seconds)
+
+        segment['frames_read'] += 1
+        if gate.should_analyze(frame):
+            batch.append((frame_index, timestamp, frame))
+            if len(batch) >= batch_size:
+                yield from add_frames(run_batch(batch))
+                batch = []
+
+    if batch:
+        yield from add_frames(run_batch(batch))
+    yield format_segment(segment)
+    totals['frames_read'] += segment['frames_read']
+    totals['frames_analyzed'] += segment['frames_analyzed']
+    for track in tracker.flush():
+        yield count_track(track)
+    yield dict(totals, type='summary')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detect animals in a video file or stream, one JSON event per line.")
+    parser.add_argument("source", help="path to a video file, or url of a stream")
+    parser.add_argument("--weights", default=YOLO_WEIGHTS_PATH)
+    parser.add_argument("--confidence", type=float, default=0.25)
+    parser.add_argument("--stride", type=int, default=1, help="only read one frame out of STRIDE")
+    parser.add_argument("--motion-threshold", type=float, default=MOTION_THRESHOLD,
+                        help="fraction of changed pixels needed to analyze a frame (0 to analyze them all)")
+    parser.add_argument("--batch-size", type=int, default=VIDEO_BATCH_SIZE)
+    parser.add_argument("--segment-seconds", type=float, default=SEGMENT_SECONDS)
+    args = parser.parse_args()
+
+    for event in analyze_video(args.source, args.weights, args.confidence, stride=args.stride,
+                               motion_threshold=args.motion_threshold, batch_size=args.batch_size,
+                               segment_seconds=args.segment_seconds):
+        print(json.dumps(event), flush=True)
@@ -1,15 +1,18 @@
-import json
-import os
-from collections import defaultdict
-from ultralytics import YOLO
+from concurrent.futures import as_completed
 import numpy as np
-from PIL import Image
-
-HOME = os.getcwd()
-# HOME = os.path.dirname(HOME)
-
-last_train_id=13
-YOLO_WEIGHTS_PATH = f"{HOME}/runs/detect/train{last_train_id}/weights/best.pt"
+from cerf_sanglier_detection import model_registry
+from cerf_sanglier_detection.fetch import fetch_images
+from cerf_sanglier_detection.result_cache import weights_hash
+from cerf_sanglier_detection.tiling import predict_tiled
+from cerf_sanglier_detection.rendering import draw_detections
+from cerf_sanglier_detection.metrics import record_stage, timed
+from cerf_sanglier_detection.response_formats import DEFAULT_RESPONSE_FORMAT, image_format_of, encode_image, decode_image
+# Served weights and device, from the environment (see settings.py)
+from cerf_sanglier_detection.settings import YOLO_WEIGHTS_PATH, DEVICE
+
+BOX_FIELDS = ['x1', 'y1', 'x2', 'y2', 'score', 'class_id']
+# How the boxes of a result are sent: a list of dicts (one per box), or a dict of lists (one per field)
+BOXES_LAYOUTS = ('records', 'columns')
 
 def count_occurrences(dict_labels, labels):
     """
@@ -17,55 +20,197 @@ def count_occurrences(dict_labels, labels):
 
     Parameters:
     - dict_labels (list): dictionary {"label" : label_index(int)}
-    - labels (list): List of detected class labels.
+    - labels (np.ndarray, torch.Tensor or list): Detected class labels.
 
     Returns:
     - dict: Dictionary mapping class labels to the number of occurrences.
     """
-    occurrences = defaultdict(int)
-    for label in labels:
-        occurrences[int(label.item())] += 1
-    
-    dict_result={}
-    for key, value in dict_labels.items():
-        dict_result[key] = occurrences[value]
-    
-    return dict_result
-
-def detect_animal(url, YOLO_WEIGHTS_PATH, confidence=0.6):
+    if hasattr(labels, 'cpu'):
+        labels = labels.cpu().numpy()
+    labels = np.asarray(labels).astype(np.int64).ravel()
+    occurrences = np.bincount(labels, minlength=max(dict_labels.values(), default=-1) + 1)
+    return {key: int(occurrences[value]) for key, value in dict_labels.items()}
+
+def format_boxes(boxes, boxes_layout='records'):
     """
-    Detect animals in an image from a given URL using a pre-trained YOLO model.
+    Convert an array of boxes to JSON serializable values, in one conversion.
 
     Parameters:
-    - url (str): URL of the image to be analyzed.
-    - YOLO_WEIGHTS_PATH (str): Path to the yolo(.bt) weight file.
-    - confidence (float): Confidence threshold for detections.
+    - boxes (np.ndarray): Boxes (x1, y1, x2, y2, score, class_id) of shape (n, 6).
+    - boxes_layout (str): 'records' (a list of dicts, one per box) or 'columns'
+      (a dict of lists, one per field of `BOX_FIELDS`).
 
     Returns:
-    - list: List of dictionaries containing detection results.
+    - list or dict: Boxes.
     """
-    # Define labels
-    dict_labels = {'boar': 0, 'deer': 1}
+    if boxes_layout == 'columns':
+        return dict(zip(BOX_FIELDS, boxes.reshape(-1, len(BOX_FIELDS)).T.tolist()))
+    return [dict(zip(BOX_FIELDS, box)) for box in boxes.tolist()]
 
-    # Load a YOLO model
-    model = YOLO(YOLO_WEIGHTS_PATH)
+def format_result(result, dict_labels, image_format=None, boxes_layout='records', draw_in_place=False,
+                  scale=(1., 1.)):
+    """
+    Build the detection result of one image from an ultralytics result.
 
-    # Run inference
-    results = model.predict(source=url, conf=confidence, save=False, device = 'cpu')
+    Parameters:
+    - result (Results): Ultralytics result of one image.
+    - dict_labels (dict): dictionary {"label" : label_index(int)}
+    - image_format (str): How images are encoded (see `response_formats.encode_image`),
+      None to send no image.
+    - boxes_layout (str): See `format_boxes`.
+    - draw_in_place (bool): Whether the annotations can be drawn on the
+      original image once it is encoded (it must not be used elsewhere),
+      instead of on a copy.
+    - scale (tuple): (x, y) factors from the image given to the model to the
+      original one, when it was decoded at a reduced size.
 
-    # Extract results
-    vars_names = ['x1', 'y1', 'x2', 'y2', 'score', 'class_id']
-    detection_results = []
+    Returns:
+    - dict: Detection result.
+    """
+    # Time spent by the model on this image (in ms)
+    for stage, milliseconds in result.speed.items():
+        record_stage(stage, milliseconds / 1000)
+
+    boxes = result.boxes.data.cpu().numpy()
+    detection_result = {}
+    # Images are only encoded (and annotated) when the client asks for them
+    if image_format is not None:
+        with timed('encode'):
+            detection_result['img_source'] = encode_image(result.orig_img, image_format)
+        with timed('annotate'):
+            img = result.orig_img if draw_in_place else result.orig_img.copy()
+            img_annotated = draw_detections(img, boxes, result.names)
+        with timed('encode'):
+            detection_result['img_annotated'] = encode_image(img_annotated, image_format)
+    if scale != (1., 1.):
+        # Boxes in the pixels of the original image
+        boxes = boxes * np.array([*scale, *scale, 1., 1.], dtype=boxes.dtype)
+    detection_result['number_of_detections_by_class'] = count_occurrences(dict_labels, boxes[:, 5])
+    detection_result['boxes'] = format_boxes(boxes, boxes_layout)
+    return detection_result
+
+
+def iter_detections(url, YOLO_WEIGHTS_PATH, confidence=0.6, device=DEVICE, response_format=DEFAULT_RESPONSE_FORMAT,
+                    batcher=None, cache=None, tiling=None, boxes_layout='records',
+                    decode_side=None, max_pixels=None):
+    """
+    Detect animals in images, yielding the result of each image as soon as it
+    is ready (so not in the order of the inputs). See `detect_animal` for the
+    parameters.
 
-    for result in results:
-        detection_result = {
-            'img_source': result.orig_img.tolist(),
-            'img_annotated': result.plot().tolist(),
-            'number_of_detections_by_class': count_occurrences(dict_labels, result.boxes.cls),
-            'boxes': [{var: value for var, value in zip(vars_names, detection)} for detection in result.boxes.data.tolist()]
-        }
-        detection_results.append(detection_result)
+    Yields:
+    - tuple: Tuple containing the index of the input and its detection result.
+    """
+    # Define labels
+    dict_labels = {'boar': 0, 'deer': 1}
+
+    sources = url if isinstance(url, list) else [url]
+    image_format = image_format_of(response_format)
+
+    # Cached results only hold the detections
+    use_cache = cache is not None and image_format is None
+    if use_cache:
+        model_hash = weights_hash(YOLO_WEIGHTS_PATH)
+    # Images are decoded at a reduced size only when the boxes are the whole
+    # answer: tiles need the full resolution, and returned images match the boxes
+    if tiling is not None or image_format is not None:
+        decode_side = None
+
+    # Settings changing the cached result, besides the weights and the confidence
+    variant = [] if boxes_layout == 'records' else [boxes_layout]
+    if decode_side:
+        variant.append(f"side{decode_side}")
+    if tiling is not None:
+        variant.append(f"tiles{tiling.get('tile_size')}-{tiling.get('overlap')}")
+    variant = '-'.join(variant) or None
+
+    # (x, y) factors to the original size of each image decoded at a reduced size
+    scales = {}
+
+    def finish(result, key, index):
+        # Arrays given by the caller are not drawn on, the images we decoded are
+        detection_result = format_result(result, dict_labels, image_format, boxes_layout,
+                                         draw_in_place=not isinstance(sources[index], np.ndarray),
+                                         scale=scales.pop(index, (1., 1.)))
+        if key is not None:
+            cache.set(key, detection_result)
+        return detection_result
+
+    # Future of each image sent to the batcher -> (index, cache key)
+    pending = {}
+
+    # Run inference with the shared model, on each image as soon as it is fetched
+    for index, img, img_hash, scale in fetch_images(sources, max_side=decode_side, max_pixels=max_pixels):
+        if scale != (1., 1.):
+            scales[index] = scale
+        key = None
+        if use_cache:
+            key = cache.make_key(img_hash, model_hash, confidence, variant)
+            cached_result = cache.get(key)
+            if cached_result is not None:
+                yield index, cached_result
+                continue
+
+        if tiling is not None:
+            # The tiles of an image already make batches of their own
+            result = predict_tiled(YOLO_WEIGHTS_PATH, img, device=device, conf=confidence, **tiling)
+            yield index, finish(result, key, index)
+        elif batcher is not None:
+            pending[batcher.submit(img, conf=confidence)] = (index, key)
+        else:
+            result = model_registry.predict(YOLO_WEIGHTS_PATH, img, device=device, conf=confidence)[0]
+            yield index, finish(result, key, index)
+
+        # Send the results already available without waiting for the other downloads
+        for future in [future for future in pending if future.done()]:
+            index, key = pending.pop(future)
+            yield index, finish(future.result(), key, index)
+
+    for future in as_completed(pending):
+        index, key = pending[future]
+        yield index, finish(future.result(), key, index)
+
+
+def detect_animal(url, YOLO_WEIGHTS_PATH, confidence=0.6, device=DEVICE, response_format=DEFAULT_RESPONSE_FORMAT,
+                  batcher=None, cache=None, tiling=None, boxes_layout='records',
+                  decode_side=None, max_pixels=None):
+    """
+    Detect animals in an image from a given URL using a pre-trained YOLO model.
+    The model is loaded once per process (see `model_registry`) and reused by
+    the following calls. Images are downloaded concurrently and each one goes
+    to the model as soon as it is decoded.
+
+    Parameters:
+    - url (str or list): URL (or local path) of the image to be analyzed, or a list of them.
+    - YOLO_WEIGHTS_PATH (str): Path to the yolo(.bt) weight file.
+    - confidence (float): Confidence threshold for detections.
+    - device (str): Device used for inference.
+    - response_format (str): One of `response_formats.RESPONSE_FORMATS`, it
+      decides whether and how 'img_source' and 'img_annotated' are sent.
+    - batcher (MicroBatcher): If given, images are batched with the ones of
+      concurrent calls by this batcher (which then decides the weights and
+      device used) instead of running their own forward pass.
+    - cache (ResultCache): If given, images already seen with the same weights
+      and confidence skip the model. It is only used when no image is sent back.
+    - tiling (dict): If given, large images are cut into overlapping tiles run
+      by small batches (see `tiling.predict_tiled`), e.g. {'tile_size': 640, 'overlap': 0.2}.
+    - boxes_layout (str): 'records' (a list of box dicts) or 'columns' (a dict
+      of lists, one per field), see `format_boxes`.
+    - decode_side (int): If given, images are decoded at a reduced size whose
+      long side stays at least `decode_side` (the model input size is enough),
+      the boxes being brought back to the pixels of the original images. It is
+      not used with tiling nor when images are sent back.
+    - max_pixels (int): If given, maximum number of decoded pixels of all the
+      images, a `fetch.PixelBudgetError` being raised over it.
 
+    Returns:
+    - list: List of dictionaries containing detection results.
+    """
+    nb_inputs = len(url) if isinstance(url, list) else 1
+    detection_results = [None] * nb_inputs
+    for index, detection_result in iter_detections(url, YOLO_WEIGHTS_PATH, confidence, device, response_format,
+                                                   batcher, cache, tiling, boxes_layout, decode_side, max_pixels):
+        detection_results[index] = detection_result
     return detection_results
 
 
@@ -74,12 +219,15 @@ def plot_annotated_from_result(results):
     Plot annotated images from the inference results.
 
     Parameters:
-    - results (list): List of dictionaries containing detection results.
+    - results (list): List of dictionaries containing detection results
+      (requested with any format sending images).
     """
+    from PIL import Image
+
     for result in results:
         annotated_img = result['img_annotated']
 
-        im_array = np.array(annotated_img).astype(np.uint8)  # Convert to a BGR numpy array
+        im_array = decode_image(annotated_img)  # Convert to a BGR numpy array
         rgb_image = Image.fromarray(im_array[..., ::-1])  # Convert to an RGB PIL image
         rgb_image.show()  # Show the image
 
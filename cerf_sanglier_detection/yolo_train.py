@@ -1,5 +1,14 @@
+import argparse
 import os
-from ultralytics import YOLO
+import time
+from functools import partial
+from settings import DATA_FOLDER, PROJECT_ROOT, RUNS_FOLDER, RUN_REGISTRY_PATH
+from run_registry import load_registry, find_run, update_run, project_path
+
+NB_EPOCHS = 300
+NB_BATCHES = 7
+# Epochs without improvement of the validation fitness before stopping
+PATIENCE = 50
 
 def create_config_str(DATA_FOLDER, train_folder, valid_folder, dict_labels):
     """
@@ -7,8 +16,8 @@ def create_config_str(DATA_FOLDER, train_folder, valid_folder, dict_labels):
 
     Parameters:
     - DATA_FOLDER (str): Path to the data folder.
-    - train_folder (str): Path to the training data folder.
-    - valid_folder (str): Path to the validation data folder.
+    - train_folder (str): Path to the training data folder, or to a .txt image list.
+    - valid_folder (str): Path to the validation data folder, or to a .txt image list.
     - dict_labels (dict): Dictionary mapping class names to labels.
 
     Returns:
@@ -37,14 +46,34 @@ def save_config_file(config_content, file_path):
         # Write the content to the file
         file.write(config_content)
 
+def create_kfold_config_files(DATA_FOLDER, folds, dict_labels, config_folder):
+    """
+    Create one config.yaml file per fold, pointing at its image lists.
+
+    Parameters:
+    - DATA_FOLDER (str): Path to the data folder.
+    - folds (list): List of (train, valid) image list paths (see `create_kfold_lists`).
+    - dict_labels (dict): Dictionary mapping class names to labels.
+    - config_folder (str): Folder of the config files.
+
+    Returns:
+    - list: Paths to the config files.
+    """
+    file_paths = []
+    for i, (train_list, valid_list) in enumerate(folds):
+        file_path = os.path.join(config_folder, f'config_fold_{i}.yaml')
+        create_config_file(DATA_FOLDER, train_list, valid_list, dict_labels, file_path)
+        file_paths.append(file_path)
+    return file_paths
+
 def create_config_file(DATA_FOLDER, train_folder, valid_folder, dict_labels, file_path):
     """
     Create a config.yaml file for training.
 
     Parameters:
     - DATA_FOLDER (str): Path to the data folder.
-    - train_folder (str): Path to the training data folder.
-    - valid_folder (str): Path to the validation data folder.
+    - train_folder (str): Path to the training data folder, or to a .txt image list.
+    - valid_folder (str): Path to the validation data folder, or to a .txt image list.
     - dict_labels (dict): Dictionary mapping class names to labels.
     - file_path (str): Path to the config.yaml file.
     """
@@ -52,21 +81,158 @@ def create_config_file(DATA_FOLDER, train_folder, valid_folder, dict_labels, fil
     save_config_file(config_content, file_path)
 
 
+def run_fields(trainer):
+    """
+    Get the fields of a run recorded in the registry from its trainer.
+
+    Parameters:
+    - trainer (DetectionTrainer): Ultralytics trainer of the run.
+
+    Returns:
+    - dict: Status, epochs, metrics and weights of the run.
+    """
+    metrics = trainer.metrics or {}
+    return {
+        "save_dir": project_path(trainer.save_dir),
+        "best_weights": project_path(trainer.best) if os.path.isfile(trainer.best) else None,
+        "last_weights": project_path(trainer.last) if os.path.isfile(trainer.last) else None,
+        "epochs": trainer.epochs,
+        # No epoch is done yet at the start of a training
+        "epochs_done": getattr(trainer, "epoch", trainer.start_epoch - 1) + 1,
+        "fitness": float(trainer.best_fitness) if trainer.best_fitness is not None else None,
+        "metrics": {name: float(metrics[f"metrics/{name}(B)"]) for name in ("precision", "recall", "mAP50", "mAP50-95")
+                    if f"metrics/{name}(B)" in metrics},
+    }
+
+
+def stop_reason(trainer):
+    """
+    Tell why a training ended.
+
+    Parameters:
+    - trainer (DetectionTrainer): Ultralytics trainer of the run.
+
+    Returns:
+    - str: 'patience' (early stopping), 'time' (time budget) or 'epochs'.
+    """
+    if trainer.epoch - trainer.stopper.best_epoch >= trainer.stopper.patience:
+        return "patience"
+    # With a time budget, ultralytics sets the number of epochs from the time of the first ones
+    if trainer.args.time:
+        return "time"
+    return "epochs"
+
+
+def train_model(config_file_path, weights="yolov8n.pt", epochs=NB_EPOCHS, batch=NB_BATCHES, patience=PATIENCE,
+                time_budget=None, resume=None, shards_folder=None, name=None, registry_path=RUN_REGISTRY_PATH,
+                **train_args):
+    """
+    Train a YOLO model and record the run in the registry: its status and
+    metrics at each epoch, then why it stopped and its throughput.
+
+    Parameters:
+    - config_file_path (str): Path to the config.yaml file.
+    - weights (str): Pretrained weights.
+    - epochs (int): Maximum number of epochs.
+    - batch (int): Batch size.
+    - patience (int): Epochs without improvement before stopping early.
+    - time_budget (float): Maximum training time in hours (None for no limit), it overrides `epochs`.
+    - resume (str): Id of a run of the registry, or path to its last.pt, to resume it (None to start a new run).
+    - shards_folder (str): Train on the shards of this folder (see dataset_shards.py) instead of the images.
+    - name (str): Name of the run folder (default: train, train2, ...).
+    - registry_path (str): Path to the run registry.
+    - **train_args: Other arguments of `YOLO.train`.
+
+    Returns:
+    - dict: The run, as recorded in the registry.
+    """
+    from ultralytics import YOLO
+
+    trainer_class = None
+    if shards_folder is not None:
+        from shard_trainer import ShardDetectionTrainer
+        trainer_class = partial(ShardDetectionTrainer, shards_folder)
+
+    if resume is not None:
+        run = find_run(load_registry(registry_path), resume)
+        last_weights = os.path.join(PROJECT_ROOT, run["last_weights"]) if run else resume
+        model = YOLO(last_weights)
+        # The other arguments are restored from the checkpoint
+        train_args = dict(resume=True)
+    else:
+        model = YOLO(weights)
+        train_args = dict(train_args, data=config_file_path, epochs=epochs, batch=batch, patience=patience,
+                          project=RUNS_FOLDER, name=name)
+        if time_budget:
+            train_args["time"] = time_budget
+
+    # Training time and epochs of this session, for the throughput
+    session = {}
+
+    def on_train_start(trainer):
+        session.update(start=time.perf_counter(), start_epoch=trainer.start_epoch)
+        update_run(trainer.save_dir.name, registry_path, status="running", config=project_path(trainer.args.data),
+                   started=time.strftime("%Y-%m-%dT%H:%M:%S"), shards=shards_folder is not None,
+                   args={key: getattr(trainer.args, key) for key in ("epochs", "batch", "imgsz", "patience", "time")},
+                   **run_fields(trainer))
+
+    def on_fit_epoch_end(trainer):
+        update_run(trainer.save_dir.name, registry_path, **run_fields(trainer))
+
+    def on_train_end(trainer):
+        elapsed = time.perf_counter() - session["start"]
+        session_epochs = trainer.epoch + 1 - session["start_epoch"]
+        update_run(trainer.save_dir.name, registry_path, status="finished", stop_reason=stop_reason(trainer),
+                   finished=time.strftime("%Y-%m-%dT%H:%M:%S"), train_time_s=elapsed,
+                   epochs_per_hour=session_epochs * 3600 / elapsed,
+                   images_per_s=session_epochs * len(trainer.train_loader.dataset) / elapsed,
+                   **run_fields(trainer))
+
+    model.add_callback("on_train_start", on_train_start)
+    model.add_callback("on_fit_epoch_end", on_fit_epoch_end)
+    model.add_callback("on_train_end", on_train_end)
+    try:
+        model.train(trainer=trainer_class, **train_args)
+    except BaseException:
+        # Interrupted (Ctrl+C, out of memory...): the run can be resumed from its last.pt
+        if session:
+            update_run(model.trainer.save_dir.name, registry_path, status="interrupted")
+        raise
+    return find_run(load_registry(registry_path), model.trainer.save_dir.name)
+
 
 if __name__ == "__main__":
-    HOME = os.getcwd()
-    HOME = os.path.dirname(HOME)
-    DATA_FOLDER = os.path.join(HOME, 'data')
-    train_folder = os.path.join(DATA_FOLDER, 'images', 'train_data')
-    valid_folder = os.path.join(DATA_FOLDER, 'images', 'valid_data')
-    dict_labels = {'boar': 0, 'deer': 1}
-    config_file_path = os.path.join(HOME, 'config.yaml')
+    parser = argparse.ArgumentParser(description="Train the YOLO model and record the run in the run registry.")
+    parser.add_argument("--weights", default="yolov8n.pt", help="pretrained weights")
+    parser.add_argument("--epochs", type=int, default=NB_EPOCHS)
+    parser.add_argument("--batch", type=int, default=NB_BATCHES)
+    parser.add_argument("--patience", type=int, default=PATIENCE,
+                        help="epochs without improvement before stopping early")
+    parser.add_argument("--max-hours", type=float, help="maximum training time, overrides --epochs")
+    parser.add_argument("--resume", help="id of a run (e.g. train14) or path to its last.pt, to resume it")
+    parser.add_argument("--shards", nargs="?", const=os.path.join(DATA_FOLDER, "shards"),
+                        help="train on the shards packed by dataset_shards.py")
+    parser.add_argument("--name", help="name of the run folder in runs/detect")
+    parser.add_argument("--workers", type=int, default=8, help="data loader workers")
+    data_group = parser.add_mutually_exclusive_group()
+    data_group.add_argument("--config", help="existing config.yaml to train on (it is not rewritten)")
+    data_group.add_argument("--split-dir",
+                            help="folder of train.txt and valid.txt image lists (e.g. data/splits/fold_0)")
+    args = parser.parse_args()
 
-    NB_EPOCHS = 300
-    NB_BATCHES = 7
+    if args.split_dir is not None:
+        train_folder = os.path.abspath(os.path.join(args.split_dir, 'train.txt'))
+        valid_folder = os.path.abspath(os.path.join(args.split_dir, 'valid.txt'))
+    else:
+        train_folder = os.path.join(DATA_FOLDER, 'images', 'train_data')
+        valid_folder = os.path.join(DATA_FOLDER, 'images', 'valid_data')
+    dict_labels = {'boar': 0, 'deer': 1}
+    config_file_path = args.config or os.path.join(PROJECT_ROOT, 'config.yaml')
 
-    create_config_file(DATA_FOLDER, train_folder, valid_folder, dict_labels, config_file_path)
+    if args.resume is None and args.config is None:
+        create_config_file(DATA_FOLDER, train_folder, valid_folder, dict_labels, config_file_path)
 
-    model = YOLO("yolov8n.pt") # load pretrained model
-    
-    results = model.train(data=config_file_path, epochs=NB_EPOCHS, batch = NB_BATCHES)  # train the model
\ No newline at end of file
+    run = train_model(config_file_path, args.weights, args.epochs, args.batch, args.patience, args.max_hours,
+                      args.resume, args.shards, args.name, workers=args.workers)
+    print(f"{run['id']}: stopped by {run['stop_reason']} after {run['epochs_done']} epochs, "
+          f"fitness {run['fitness'] or 0.:.4f}, best weights {run['best_weights']}")
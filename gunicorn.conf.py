@@ -0,0 +1,68 @@
+# Production server: gunicorn -c gunicorn.conf.py app:app
+#
+# Each worker process imports the app, so it loads its own model and starts its
+# own micro-batcher (their threads would not survive a fork of a preloaded app).
+import multiprocessing
+import os
+import subprocess
+import sys
+
+CPU_COUNT = multiprocessing.cpu_count()
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", max(CPU_COUNT // 2, 1)))
+# Threads of a worker share its model: concurrent requests are batched together
+worker_class = "gthread"
+threads = int(os.environ.get("WORKER_THREADS", 8))
+# Connections waiting for a worker; past this the kernel refuses them
+backlog = int(os.environ.get("BACKLOG", 64))
+timeout = int(os.environ.get("WORKER_TIMEOUT", 120))
+graceful_timeout = 30
+keepalive = 5
+preload_app = False
+
+# Torch intra-op threads of each worker, so that the workers together do not
+# use more threads than there are cores
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS", max(CPU_COUNT // workers, 1)))
+
+# Read by the app, its workers share the jobs database
+os.environ["PREFORK_SERVER"] = "1"
+
+# Admission control of each worker (read by the app). A worker never runs more
+# requests than it has threads, so the limits must stay below the threads for
+# requests to ever wait or be rejected with a 503; one thread is left for
+# /healthz and /metrics.
+MAX_INFLIGHT_REQUESTS = int(os.environ.get("MAX_INFLIGHT_REQUESTS", max(threads // 2, 1)))
+MAX_QUEUED_REQUESTS = int(os.environ.get("MAX_QUEUED_REQUESTS", max(threads - MAX_INFLIGHT_REQUESTS - 1, 0)))
+if MAX_INFLIGHT_REQUESTS + MAX_QUEUED_REQUESTS >= threads:
+    raise ValueError(f"MAX_INFLIGHT_REQUESTS + MAX_QUEUED_REQUESTS ({MAX_INFLIGHT_REQUESTS} + {MAX_QUEUED_REQUESTS}) "
+                     f"must be lower than WORKER_THREADS ({threads})")
+os.environ["MAX_INFLIGHT_REQUESTS"] = str(MAX_INFLIGHT_REQUESTS)
+os.environ["MAX_QUEUED_REQUESTS"] = str(MAX_QUEUED_REQUESTS)
+
+
+def on_starting(server):
+    # Jobs left unfinished by a previous server, marked once for every worker
+    from cerf_sanglier_detection.jobs import JobStore
+    JobStore(os.environ.get("JOBS_DB_PATH", "jobs.sqlite")).interrupt_unfinished()
+
+    # Weights of the backend exported once, before the workers start: each of
+    # them would otherwise export the same file at the same time. The export
+    # runs in another process so that the master does not import torch.
+    from cerf_sanglier_detection.backends import exported_weights_path
+    from cerf_sanglier_detection.settings import YOLO_WEIGHTS_PATH
+    backend = os.environ.get("INFERENCE_BACKEND", "torch")
+    int8 = os.environ.get("INFERENCE_INT8", "0") == "1"
+    if backend != "torch" and not os.path.exists(exported_weights_path(YOLO_WEIGHTS_PATH, backend, int8)):
+        server.log.info(f"Exporting {YOLO_WEIGHTS_PATH} for {backend}")
+        subprocess.run([sys.executable, "-m", "cerf_sanglier_detection.backends", "export", "--backend", backend,
+                        "--weights", YOLO_WEIGHTS_PATH] + (["--int8"] if int8 else []), check=True)
+
+
+def post_fork(server, worker):
+    # Set before the worker imports the app and loads its model
+    os.environ["OMP_NUM_THREADS"] = str(TORCH_THREADS)
+    import torch
+    torch.set_num_threads(TORCH_THREADS)
+    torch.set_num_interop_threads(1)
+    server.log.info(f"Worker {worker.pid}: {TORCH_THREADS} torch threads")
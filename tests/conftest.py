@@ -0,0 +1,8 @@
+import os
+import sys
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The tests import the package from the project root, like app.py does, and the
+# scripts of the package with bare imports, like when they are run from cerf_sanglier_detection
+sys.path.insert(0, PROJECT_ROOT)
+sys.path.insert(1, os.path.join(PROJECT_ROOT, "cerf_sanglier_detection"))
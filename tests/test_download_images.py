@@ -0,0 +1,115 @@
+import json
+import os
+import socket
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from download_images import create_session, download_images
+
+IMAGE = b"\xff\xd8\xff\xe0" + bytes(range(256)) * 64
+OTHER_IMAGE = b"\xff\xd8\xff\xe1" + bytes(range(256)) * 32
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # /a.jpg and /a_copy.jpg: the same content, /b.jpg: another content,
+    # /reset.jpg: the connection is reset in the middle of the body, other paths: 404
+    def do_GET(self):
+        bodies = {"/a.jpg": IMAGE, "/a_copy.jpg": IMAGE, "/b.jpg": OTHER_IMAGE, "/reset.jpg": IMAGE}
+        if self.path not in bodies:
+            self.send_error(404)
+            return
+        body = bodies[self.path]
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.path == "/reset.jpg":
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            # Close with a RST instead of a FIN
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+            self.connection.close()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def finish(self):
+        try:
+            super().finish()
+        except OSError:
+            # The socket of /reset.jpg is already closed
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def server_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def write_urls(folder, name, urls):
+    path = os.path.join(folder, name)
+    with open(path, "w") as file:
+        file.write("\n".join(urls) + "\n")
+    return path
+
+
+def run(tmp_path, url_files):
+    return download_images(url_files, str(tmp_path / "images"), manifest_path=str(tmp_path / "manifest.json"),
+                           max_workers=4, session=create_session(retries=0))
+
+
+def test_download_images_statuses(tmp_path, server_url):
+    url_file = write_urls(tmp_path, "boar_urls.txt", [f"{server_url}/a.jpg", f"{server_url}/a_copy.jpg",
+                                                      f"{server_url}/missing.jpg", f"{server_url}/reset.jpg"])
+    counts = run(tmp_path, [url_file])
+
+    assert counts == {"ok": 1, "duplicate": 1, "error": 2, "skipped": 0}
+    images = sorted(os.listdir(tmp_path / "images"))
+    # The same content under two urls is kept once, and no partial download is left
+    assert len(images) == 1 and images[0] in ("boar_1.jpg", "boar_2.jpg")
+    with open(tmp_path / "images" / images[0], "rb") as file:
+        assert file.read() == IMAGE
+
+    with open(tmp_path / "manifest.json") as file:
+        entries = json.load(file)
+    statuses = {url.rsplit("/", 1)[1]: entry["status"] for url, entry in entries.items()}
+    assert statuses["missing.jpg"] == "error" and statuses["reset.jpg"] == "error"
+    assert sorted([statuses["a.jpg"], statuses["a_copy.jpg"]]) == ["duplicate", "ok"]
+
+
+def test_download_images_rerun_skips_everything(tmp_path, server_url):
+    url_files = [write_urls(tmp_path, "boar_urls.txt", [f"{server_url}/a.jpg", f"{server_url}/a_copy.jpg"]),
+                 write_urls(tmp_path, "deer_urls.txt", [f"{server_url}/b.jpg"])]
+    assert run(tmp_path, url_files) == {"ok": 2, "duplicate": 1, "error": 0, "skipped": 0}
+    assert run(tmp_path, url_files) == {"ok": 0, "duplicate": 0, "error": 0, "skipped": 3}
+
+
+def test_download_images_same_url_in_two_files(tmp_path, server_url):
+    url_files = [write_urls(tmp_path, "boar_urls.txt", [f"{server_url}/b.jpg"]),
+                 write_urls(tmp_path, "deer_urls.txt", [f"{server_url}/b.jpg"])]
+    assert run(tmp_path, url_files) == {"ok": 1, "duplicate": 1, "error": 0, "skipped": 0}
+    with open(tmp_path / "manifest.json") as file:
+        entries = json.load(file)
+    assert entries[f"{server_url}/b.jpg"]["status"] == "ok"
+    assert run(tmp_path, url_files) == {"ok": 0, "duplicate": 0, "error": 0, "skipped": 2}
+
+
+def test_download_images_duplicate_of_removed_image_is_downloaded_again(tmp_path, server_url):
+    url_file = write_urls(tmp_path, "boar_urls.txt", [f"{server_url}/a.jpg", f"{server_url}/a_copy.jpg"])
+    run(tmp_path, [url_file])
+    for image in os.listdir(tmp_path / "images"):
+        os.remove(tmp_path / "images" / image)
+
+    counts = run(tmp_path, [url_file])
+    assert counts["skipped"] == 0 and counts["ok"] == 1 and counts["duplicate"] == 1
+    assert len(os.listdir(tmp_path / "images")) == 1
@@ -0,0 +1,105 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+import numpy as np
+import pytest
+from PIL import Image
+from cerf_sanglier_detection.fetch import FetchError, create_session, fetch_image, fetch_images
+
+SLOW_DELAY_S = 1.
+
+
+def make_jpeg(width=64, height=48):
+    buffer = BytesIO()
+    Image.fromarray(np.full((height, width, 3), 127, dtype=np.uint8)).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+JPEG = make_jpeg()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # /image.jpg: an image, /slow.jpg: the same image after SLOW_DELAY_S,
+    # /big.jpg: a large body announced by Content-Length, /big_unsized.jpg: the
+    # same body without Content-Length (only the streamed bytes tell its size)
+    def do_GET(self):
+        if self.path == "/slow.jpg":
+            time.sleep(SLOW_DELAY_S)
+        if self.path in ("/image.jpg", "/slow.jpg"):
+            body, sized = JPEG, True
+        elif self.path in ("/big.jpg", "/big_unsized.jpg"):
+            body, sized = JPEG + bytes(1024 * 1024), self.path == "/big.jpg"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        if sized:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading (e.g. over its max bytes)
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def server_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_image_decodes_to_bgr(server_url):
+    img, img_hash, scale = fetch_image(f"{server_url}/image.jpg", session=create_session())
+    assert img.shape == (48, 64, 3)
+    assert img.dtype == np.uint8
+    assert len(img_hash) == 32
+    assert scale == (1., 1.)
+
+
+def test_fetch_image_times_out(server_url):
+    start = time.perf_counter()
+    with pytest.raises(FetchError):
+        fetch_image(f"{server_url}/slow.jpg", session=create_session(), timeout=(1, SLOW_DELAY_S / 5))
+    assert time.perf_counter() - start < SLOW_DELAY_S
+
+
+def test_fetch_image_rejects_announced_size_over_max_bytes(server_url):
+    with pytest.raises(FetchError, match="larger than"):
+        fetch_image(f"{server_url}/big.jpg", session=create_session(), max_bytes=64 * 1024)
+
+
+def test_fetch_image_rejects_streamed_size_over_max_bytes(server_url):
+    with pytest.raises(FetchError, match="larger than"):
+        fetch_image(f"{server_url}/big_unsized.jpg", session=create_session(), max_bytes=64 * 1024)
+
+
+def test_fetch_image_reports_http_errors(server_url):
+    with pytest.raises(FetchError):
+        fetch_image(f"{server_url}/missing.jpg", session=create_session())
+
+
+def test_fetch_images_yields_each_image_when_its_download_finishes(server_url):
+    sources = [f"{server_url}/slow.jpg", f"{server_url}/image.jpg", f"{server_url}/image.jpg"]
+    arrivals = []
+    start = time.perf_counter()
+    for index, img, _, _ in fetch_images(sources, session=create_session()):
+        arrivals.append((index, time.perf_counter() - start))
+        assert img.shape == (48, 64, 3)
+
+    assert sorted(index for index, _ in arrivals) == [0, 1, 2]
+    # The fast images do not wait for the slow one
+    assert arrivals[-1][0] == 0
+    assert all(elapsed < SLOW_DELAY_S for index, elapsed in arrivals if index != 0)
+    # The downloads run concurrently: about one slow download in total
+    assert arrivals[-1][1] < 2 * SLOW_DELAY_S